@@ -0,0 +1,308 @@
+'''
+Times every export stage over synthetic files of different sizes, and writes
+the results as JSON to compare between commits.
+
+Run from the repository root:
+    python -m benchmarks.run --tiers small medium --output bench.json
+    python -m benchmarks.run --compare before.json after.json
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from osgeo import gdal
+import numpy as np
+
+import params as params
+import helpers as h
+import generateVRT as vrt
+from job import Job, initWorker
+from warpPlan import WarpPlan
+from version import __version__
+
+from export_formats.storageRGB import exportStorageRGB, planStorageRGB
+from export_formats.storageDEM import exportStorageDEM, planStorageDEM
+from export_formats.geoserverRGB import exportGeoserverRGB, planGeoserverRGB
+from export_formats.geoserverDEM import exportGeoserverDEM, planGeoserverDEM
+from export_formats.outlines import exportOutline
+from export_formats.previews import exportStoragePreview
+
+from benchmarks import synthetic
+
+# pixels per side
+TIERS = {
+    'small': 1024,
+    'medium': 4096,
+    'large': 12288
+}
+
+
+def setFolders(root):
+    '''
+    Point all the params folders to the benchmark folder
+    '''
+    params.tmp_folder = f'{root}/tmp'
+    params.output_folder = f'{root}/output'
+    params.output_folder_storage = f'{params.output_folder}/storage'
+    params.output_folder_database = f'{params.output_folder}/database'
+    params.output_folder_database_jsondata = f'{params.output_folder_database}/jsondata'
+    params.output_folder_database_mdevalues = f'{params.output_folder_database}/mdevalues'
+    params.output_folder_database_outlines = f'{params.output_folder_database}/outlines'
+    params.output_folder_geoserver = f'{params.output_folder}/geoserver'
+    params.geoserverRGB['output_folder'] = f'{params.output_folder_geoserver}/rgb'
+    params.geoserverDEM['output_folder'] = f'{params.output_folder_geoserver}/mde'
+    params.geoserverDEMRGB['output_folder'] = f'{params.output_folder_geoserver}/mde_rgb'
+
+    for folder in [params.tmp_folder, params.output_folder_storage,
+                   params.output_folder_database_jsondata, params.output_folder_database_mdevalues,
+                   params.output_folder_database_outlines, params.geoserverRGB['output_folder'],
+                   params.geoserverDEM['output_folder'], params.geoserverDEMRGB['output_folder']]:
+        h.createFolder(folder)
+
+
+def generateInputs(root, tier, size):
+    '''
+    Synthetic inputs of a tier. Files are kept between runs, the generation is seeded
+    '''
+    folder = f'{root}/files/{tier}'
+    h.createFolder(folder)
+
+    inputs = {
+        'ortho_tiled': (synthetic.createOrtho, {'layout': 'tiled'}),
+        'ortho_strip': (synthetic.createOrtho, {'layout': 'strip'}),
+        'dem_nodata': (synthetic.createDEM, {'nodata': 'nodata'}),
+        'dem_nan': (synthetic.createDEM, {'nodata': 'nan'}),
+        'dem_alpha': (synthetic.createDEM, {'nodata': 'alpha', 'layout': 'tiled'}),
+    }
+
+    paths = {}
+
+    for name, (create, kwargs) in inputs.items():
+        path = f'{folder}/{name}.tif'
+        if not os.path.exists(path):
+            print(f'-> Generating {path}')
+            create(path, size, **kwargs)
+        paths[name] = path
+
+    return paths
+
+
+def createJob(path):
+    file_ds = gdal.Open(path, gdal.GA_ReadOnly)
+    job = Job(path, file_ds.RasterCount <= 2, {})
+    h.createFolder(job.outputFolder)
+    job.load(file_ds)
+    # the stages run in this thread
+    job.tuning.applyThreadOptions()
+    return job, file_ds
+
+
+def withPlan(job, file_ds, *planners):
+    '''
+    Fresh warp plan with only the grids of the stage, so its time includes the warps
+    '''
+    job.warpPlan = WarpPlan(job, file_ds)
+    for planner in planners:
+        planner(job, job.warpPlan)
+    job.warpPlan.run()
+
+
+def getStages(job, file_ds):
+    '''
+    Stage name and function to time for a job
+    '''
+
+    def lightVersion():
+        withPlan(job, file_ds, h.planLightVersion)
+        return h.getLightVersion(job)
+
+    # the lightweight version used by the stages that read it is prepared outside the timing
+    withPlan(job, file_ds, h.planLightVersion)
+    lightPath = job.warpPlan.getPath('lightVersion')
+
+    def light():
+        return gdal.Open(lightPath, gdal.GA_ReadOnly)
+
+    stages = {'getLightVersion': lightVersion}
+
+    if job.isDEM:
+        def colorValues():
+            job.colorValues = h.calculateDEMColorValues(job, light())
+
+        def storageDEM():
+            withPlan(job, file_ds, planStorageDEM)
+            exportStorageDEM(job)
+
+        def geoserverDEM():
+            withPlan(job, file_ds, planGeoserverDEM)
+            exportGeoserverDEM(job)
+
+        def preview():
+            exportStoragePreview(job, light())
+
+        stages.update({
+            'calculateDEMColorValues': colorValues,
+            'exportStorageDEM': storageDEM,
+            'exportGeoserverDEM': geoserverDEM,
+            'exportStoragePreview': preview
+        })
+
+    else:
+        def storageRGB():
+            withPlan(job, file_ds, planStorageRGB)
+            exportStorageRGB(job)
+
+        def geoserverRGB():
+            withPlan(job, file_ds, planGeoserverRGB)
+            exportGeoserverRGB(job)
+
+        def outline():
+            exportOutline(job, light())
+
+        def preview():
+            exportStoragePreview(job, light())
+
+        stages.update({
+            'exportStorageRGB': storageRGB,
+            'exportGeoserverRGB': geoserverRGB,
+            'exportOutline': outline,
+            'exportStoragePreview': preview
+        })
+
+    return stages
+
+
+def timeStage(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def runTier(root, tier, size, repeat):
+    results = []
+
+    paths = generateInputs(root, tier, size)
+
+    for name, path in paths.items():
+        job, file_ds = createJob(path)
+
+        for stage, fn in getStages(job, file_ds).items():
+            chosen = len(job.tuning.choices)
+            times = timeStage(fn, repeat)
+            choices = job.tuning.choices[chosen:]
+            print(f'--> {tier} {name} {stage}: {min(times):.3f} s')
+            results.append({
+                'tier': tier,
+                'input': name,
+                'stage': stage,
+                'pixels': size * size,
+                'min': min(times),
+                'median': statistics.median(times),
+                'times': times,
+                # GDAL options chosen for the warps of the stage, the same in each repeat
+                'tuning': choices[:len(choices) // repeat]
+            })
+
+        file_ds = None
+        job.temp.cleanup()
+
+    # tiled folder mosaic for generateVRT, alone in its input folder
+    params.input_folder = f'{root}/mosaics/{tier}'
+    mosaicFolder = f'{params.input_folder}/mosaic'
+    if not os.path.exists(mosaicFolder):
+        synthetic.createMosaic(mosaicFolder, tileSize=max(256, size // 4))
+
+    times = timeStage(vrt.generateVRT, repeat)
+    print(f'--> {tier} mosaic generateVRT: {min(times):.3f} s')
+    results.append({
+        'tier': tier,
+        'input': 'mosaic',
+        'stage': 'generateVRT',
+        'pixels': size * size,
+        'min': min(times),
+        'median': statistics.median(times),
+        'times': times
+    })
+
+    return results
+
+
+def getCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(before, after):
+    '''
+    Print the ratio of the median times of two result files
+    '''
+    with open(before) as file:
+        old = {(r['tier'], r['input'], r['stage']): r for r in json.load(file)['results']}
+    with open(after) as file:
+        new = {(r['tier'], r['input'], r['stage']): r for r in json.load(file)['results']}
+
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key]['median'] / old[key]['median'] if old[key]['median'] else float('nan')
+        print(f'{" ".join(key):60} {old[key]["median"]:9.3f} s -> {new[key]["median"]:9.3f} s  x{ratio:.2f}')
+        if (old[key].get('tuning') != new[key].get('tuning')):
+            print(f'{"":60} GDAL options changed: {new[key].get("tuning")}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the export stages with synthetic files')
+    parser.add_argument('--tiers', nargs='+', choices=TIERS.keys(), default=['small'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--folder', default='benchmark')
+    parser.add_argument('--output', default=None, help='results JSON path')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    initWorker()
+
+    root = os.path.abspath(args.folder)
+
+    setFolders(root)
+
+    results = []
+
+    for tier in args.tiers:
+        results += runTier(root, tier, TIERS[tier], args.repeat)
+
+    output = args.output or f'{args.folder}/results-{datetime.now().strftime("%Y%m%d-%H%M%S")}.json'
+
+    with open(output, 'w') as file:
+        json.dump({
+            'version': __version__,
+            'commit': getCommit(),
+            'gdal': gdal.VersionInfo('RELEASE_NAME'),
+            'numpy': np.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'date': datetime.now().isoformat(),
+            'results': results
+        }, file, indent=2)
+
+    print(f'-> Results saved in {output}')
+
+
+if __name__ == '__main__':
+    main()
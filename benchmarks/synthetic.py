@@ -0,0 +1,166 @@
+'''
+Reproducible synthetic GeoTIFFs, similar to the files exported by the
+photogrammetry software (drone orthos, DEMs and tiled mosaics)
+'''
+
+import os
+import numpy as np
+from osgeo import gdal, osr
+
+# UTM 21S, like most of our surveys
+EPSG = 32721
+
+ORIGIN_X = 300000
+ORIGIN_Y = 6100000
+
+
+def _getCreationOptions(layout):
+    if layout == 'tiled':
+        # DroneDeploy like
+        return ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+    # Pix4D like, one row per strip
+    return ['TILED=NO', 'BLOCKYSIZE=1', 'COMPRESS=LZW', 'BIGTIFF=IF_SAFER']
+
+
+def _create(path, size, bands, dataType, pixelSize, layout, originX=ORIGIN_X, originY=ORIGIN_Y):
+    ds = gdal.GetDriverByName('GTiff').Create(
+        path, size, size, bands, dataType, _getCreationOptions(layout))
+
+    ds.SetGeoTransform([originX, pixelSize, 0, originY, 0, -pixelSize])
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    ds.SetProjection(srs.ExportToWkt())
+
+    return ds
+
+
+def _footprint(rng, size, rows, yoff):
+    '''
+    Irregular survey footprint (noisy ellipse), True inside
+    '''
+    y, x = np.mgrid[yoff:yoff + rows, 0:size]
+    angle = np.arctan2(y - size / 2, x - size / 2)
+    radius = np.hypot((x - size / 2) / (size * 0.45), (y - size / 2) / (size * 0.38))
+    border = 1 + 0.08 * np.sin(angle * 7 + rng) + 0.04 * np.sin(angle * 23)
+    return radius < border
+
+
+def _rows(size, rowsPerChunk=512):
+    for yoff in range(0, size, rowsPerChunk):
+        yield yoff, min(rowsPerChunk, size - yoff)
+
+
+def createOrtho(path, size, layout='tiled', pixelSize=0.03, seed=0):
+    '''
+    RGBA ortho with an alpha band outside the survey footprint
+    '''
+    rng = np.random.default_rng(seed)
+    phase = rng.uniform(0, np.pi)
+
+    ds = _create(path, size, 4, gdal.GDT_Byte, pixelSize, layout)
+
+    for i, interpretation in enumerate([gdal.GCI_RedBand, gdal.GCI_GreenBand, gdal.GCI_BlueBand, gdal.GCI_AlphaBand]):
+        ds.GetRasterBand(i + 1).SetColorInterpretation(interpretation)
+
+    for yoff, rows in _rows(size):
+        y, x = np.mgrid[yoff:yoff + rows, 0:size]
+        inside = _footprint(phase, size, rows, yoff)
+        noise = rng.integers(0, 40, (rows, size))
+
+        red = 90 + 60 * np.sin(x / 97 + phase) + noise
+        green = 110 + 50 * np.cos(y / 131) + noise
+        blue = 70 + 40 * np.sin((x + y) / 173) + noise
+
+        for i, band in enumerate([red, green, blue]):
+            ds.GetRasterBand(i + 1).WriteArray(np.where(inside, band, 0).astype(np.uint8), 0, yoff)
+
+        ds.GetRasterBand(4).WriteArray(np.where(inside, 255, 0).astype(np.uint8), 0, yoff)
+
+    ds = None
+
+    return path
+
+
+def createDEM(path, size, nodata='nodata', layout='strip', pixelSize=0.1, seed=0):
+    '''
+    Float DEM. `nodata` is the way the empty area is stored:
+    - 'nodata': -10000 as noData value (Pix4D Mapper)
+    - 'nan': NaN values and a NaN noData attribute (Pix4DMatic)
+    - 'alpha': a second alpha band (DroneDeploy)
+    '''
+    rng = np.random.default_rng(seed)
+    phase = rng.uniform(0, np.pi)
+
+    bands = 2 if nodata == 'alpha' else 1
+
+    ds = _create(path, size, bands, gdal.GDT_Float32, pixelSize, layout)
+
+    band = ds.GetRasterBand(1)
+
+    if nodata == 'nan':
+        band.SetNoDataValue(float('nan'))
+    elif nodata == 'nodata':
+        band.SetNoDataValue(-10000)
+    else:
+        ds.GetRasterBand(2).SetColorInterpretation(gdal.GCI_AlphaBand)
+
+    for yoff, rows in _rows(size):
+        y, x = np.mgrid[yoff:yoff + rows, 0:size].astype(np.float32)
+        inside = _footprint(phase, size, rows, yoff)
+
+        # hills, a channel and some noise
+        elevation = (
+            20
+            + 8 * np.sin(x / (size / 5) + phase) * np.cos(y / (size / 7))
+            + 12 * np.exp(-(((x - size * 0.6) / (size * 0.15)) ** 2 + ((y - size * 0.4) / (size * 0.2)) ** 2))
+            - 5 * np.exp(-((x - y * 0.8 - size * 0.1) / (size * 0.03)) ** 2)
+            + rng.normal(0, 0.05, (rows, size))
+        ).astype(np.float32)
+
+        if nodata == 'nan':
+            elevation[~inside] = np.nan
+        elif nodata == 'nodata':
+            elevation[~inside] = -10000
+        else:
+            ds.GetRasterBand(2).WriteArray(np.where(inside, 255, 0).astype(np.float32), 0, yoff)
+
+        band.WriteArray(elevation, 0, yoff)
+
+    ds = None
+
+    return path
+
+
+def createMosaic(folder, tiles=4, tileSize=1024, pixelSize=0.03, seed=0):
+    '''
+    Folder of ortho tiles for generateVRT. The corner tiles are left empty
+    (all alpha 0), like the edge tiles exported by the photogrammetry software
+    '''
+    os.makedirs(folder, exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+
+    paths = []
+
+    for row in range(tiles):
+        for col in range(tiles):
+            path = os.path.join(folder, f'tile_{row}_{col}.tif')
+            originX = ORIGIN_X + col * tileSize * pixelSize
+            originY = ORIGIN_Y - row * tileSize * pixelSize
+
+            ds = _create(path, tileSize, 4, gdal.GDT_Byte, pixelSize, 'tiled', originX, originY)
+            ds.GetRasterBand(4).SetColorInterpretation(gdal.GCI_AlphaBand)
+
+            empty = row in (0, tiles - 1) and col in (0, tiles - 1)
+
+            if not empty:
+                for i in range(3):
+                    ds.GetRasterBand(i + 1).WriteArray(
+                        rng.integers(40, 220, (tileSize, tileSize)).astype(np.uint8))
+                ds.GetRasterBand(4).Fill(255)
+
+            ds = None
+            paths.append(path)
+
+    return paths
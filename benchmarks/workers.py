@@ -0,0 +1,165 @@
+'''
+Processes a batch of synthetic files through the shared queue with several
+local workers, and checks that every file was processed exactly once, that
+the RGB and DEM of a registro got the same mapId, and that the job of a
+worker that stopped sending heartbeats was claimed again by another one.
+
+Run from the repository root:
+    python -m benchmarks.workers --registros 4 --workers 4
+The same check runs in tests/test_workers.py with small files.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import params as params
+from cli import setOutputFolder
+from jobQueue import getQueue
+from distributed import enqueueBatch, runWorkers
+
+from benchmarks import synthetic
+
+# a worker that claims a job and dies
+DEAD_WORKER = 'dead-worker'
+DEAD_LEASE = 2
+
+
+def setUp(root, workers):
+    params.input_folder = f'{root}/input'
+    params.tmp_folder = f'{root}/tmp'
+    setOutputFolder(f'{root}/output')
+
+    params.workers = workers
+    params.clean_output_folder = False
+    params.queue['backend'] = 'sqlite'
+    params.queue['poll_interval'] = 1
+
+    os.makedirs(params.input_folder, exist_ok=True)
+    os.makedirs(params.output_folder, exist_ok=True)
+
+
+def generateInputs(registros, size):
+    '''
+    RGB and DEM of each registro. The ids share prefixes (1000, 10001, ...)
+    so a mapId can't be taken from another registro
+    '''
+    files = []
+
+    for i in range(registros):
+        regid = f'1000{i}' if i else '1000'
+
+        rgb = f'{params.input_folder}/{regid}.tif'
+        dem = f'{params.input_folder}/{regid}{params.dem_suffix}.tif'
+
+        synthetic.createOrtho(rgb, size, seed=i)
+        synthetic.createDEM(dem, size // 2, seed=i)
+
+        files += [os.path.basename(rgb), os.path.basename(dem)]
+
+    return sorted(files)
+
+
+def check(files, stolen, elapsed):
+    queue = getQueue()
+
+    jobs = queue._atomic(lambda state: dict(state['jobs']))
+    results = queue.getResults()
+
+    errors = []
+
+    if (sorted(jobs) != files):
+        errors.append(f'queued {sorted(jobs)}, expected {files}')
+
+    for file, entry in sorted(jobs.items()):
+        expected = 2 if file == stolen else 1
+
+        if (entry['status'] != 'done'):
+            errors.append(f'{file} is {entry["status"]}: {entry["result"]}')
+        if (entry['attempts'] != expected):
+            errors.append(f'{file} was claimed {entry["attempts"]} times, expected {expected}')
+        if (entry['worker'] == DEAD_WORKER):
+            errors.append(f'{file} was not claimed again from {DEAD_WORKER}')
+
+    processed = [result['file'] for result in results]
+
+    if (len(processed) != len(set(processed))):
+        errors.append(f'files with more than one result: {processed}')
+
+    # the RGB and DEM of a registro share the mapId, and each registro has its own
+    mapIds = {}
+    for result in results:
+        if result.get('regid'):
+            mapIds.setdefault(result['regid'], set()).add(result['mapId'])
+
+    for regid, ids in mapIds.items():
+        if (len(ids) != 1):
+            errors.append(f'{regid} got {len(ids)} mapIds: {sorted(ids)}')
+
+    if (len({next(iter(ids)) for ids in mapIds.values()}) != len(mapIds)):
+        errors.append('two registros got the same mapId')
+
+    print(json.dumps({'files': len(files), 'stolen': stolen, 'counts': queue.getCounts(),
+                      'seconds': round(elapsed, 2)}, indent=2))
+
+    return errors
+
+
+def runCheck(root, registros, workers, size):
+    '''
+    Run the whole check in `root`, returns the list of errors found
+    '''
+    setUp(root, workers)
+
+    files = generateInputs(registros, size)
+
+    enqueueBatch()
+
+    # never renewed, so the workers must claim it again once it expires
+    stolen, _ = getQueue().claim(DEAD_WORKER, DEAD_LEASE)
+    print(f'-> {DEAD_WORKER} took {stolen}')
+
+    start = time.time()
+    exitCode = runWorkers(workers)
+    elapsed = time.time() - start
+
+    errors = check(files, stolen, elapsed)
+
+    if exitCode:
+        errors.append(f'the workers exited with {exitCode}')
+
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the distributed queue with local workers')
+    parser.add_argument('--registros', type=int, default=4, help='registros, each one with an RGB and a DEM')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--size', type=int, default=1024, help='pixels per side of the orthos')
+    parser.add_argument('--root', help='work folder, a temporary one is used and removed by default')
+    args = parser.parse_args()
+
+    root = args.root or tempfile.mkdtemp(prefix='queue-bench-')
+
+    errors = []
+
+    try:
+        errors = runCheck(root, args.registros, args.workers, args.size)
+    finally:
+        if not args.root:
+            shutil.rmtree(root, ignore_errors=True)
+
+    for error in errors:
+        print(f'ERROR: {error}')
+
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
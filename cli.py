@@ -0,0 +1,188 @@
+'''
+Command line of the processor. The params can be overridden without
+editing params.py, and only some products or files can be processed.
+
+Examples:
+    python cli.py --input /data/input --output /data/output --workers 4
+    python cli.py --products geoserverRGB --files 1234*.tif 5678*.tif --force
+    python cli.py --set storageRGB.gsd_sm_trigger=3 --set previews.width=800
+    python cli.py --watch --workers 2
+    python cli.py --enqueue && python cli.py --worker --workers 4
+    python cli.py --plan plan.json
+
+It can also be used from Python: `cli.main(['--products', 'previews'])`
+'''
+
+import sys
+import json
+import argparse
+
+import params as params
+
+# manifest.PRODUCTS_RGB and PRODUCTS_DEM, without importing GDAL for --help
+PRODUCTS = ['storageRGB', 'outlines', 'previews', 'geoserverRGB', 'tilesRGB',
+            'storageDEM', 'quantities', 'geoserverDEM', 'geoserverDEMRGB', 'tilesDEM']
+
+
+def setOutputFolder(folder):
+    '''
+    Point the output folder and all the paths inside it to `folder`
+    '''
+    params.output_folder = folder
+    params.output_folder_storage = f'{folder}/storage'
+    params.output_folder_database = f'{folder}/database'
+    params.output_folder_database_jsondata = f'{params.output_folder_database}/jsondata'
+    params.output_folder_database_mdevalues = f'{params.output_folder_database}/mdevalues'
+    params.output_folder_database_outlines = f'{params.output_folder_database}/outlines'
+    params.output_folder_geoserver = f'{folder}/geoserver'
+    params.output_folder_tiles = f'{folder}/tiles'
+
+    params.manifest_file = f'{folder}/manifest.json'
+    params.header_cache_file = f'{folder}/headers.json'
+    params.metrics['jsonl_file'] = f'{folder}/metrics.jsonl'
+    params.database['gpkg_file'] = f'{params.output_folder_database}/database.gpkg'
+    params.mosaics['index_folder'] = f'{folder}/mosaics'
+    params.queue['sqlite_file'] = f'{folder}/queue.sqlite'
+
+    params.geoserverRGB['output_folder'] = f'{params.output_folder_geoserver}/rgb'
+    params.geoserverDEM['output_folder'] = f'{params.output_folder_geoserver}/mde'
+    params.geoserverDEMRGB['output_folder'] = f'{params.output_folder_geoserver}/mde_rgb'
+    params.tilesRGB['output_folder'] = f'{params.output_folder_tiles}/rgb'
+    params.tilesDEM['output_folder'] = f'{params.output_folder_tiles}/mde_rgb'
+
+
+def setParam(assignment):
+    '''
+    Override a param from a `name=value` or `dict.key=value` string.
+    The value is read as JSON (numbers, booleans, lists, null), or as text
+    '''
+    if '=' not in assignment:
+        raise ValueError(f'{assignment} must be name=value')
+
+    name, value = assignment.split('=', 1)
+
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+
+    keys = name.strip().split('.')
+
+    if not hasattr(params, keys[0]):
+        raise ValueError(f'Unknown param {keys[0]}')
+
+    if (len(keys) == 1):
+        setattr(params, keys[0], value)
+        return
+
+    target = getattr(params, keys[0])
+
+    for key in keys[1:-1]:
+        if not isinstance(target, dict) or key not in target:
+            raise ValueError(f'Unknown param {name}')
+        target = target[key]
+
+    if not isinstance(target, dict) or keys[-1] not in target:
+        raise ValueError(f'Unknown param {name}')
+
+    target[keys[-1]] = value
+
+
+def getParser():
+    parser = argparse.ArgumentParser(description='Export the GeoTIFF files of the input folder')
+
+    parser.add_argument('--input', help='input folder')
+    parser.add_argument('--output', help='output folder, the manifest and metrics are kept inside')
+    parser.add_argument('--workers', type=int, help='files processed at the same time')
+    parser.add_argument('--stage-workers', type=int, help='exports of the same file run at the same time')
+    parser.add_argument('--products', nargs='+', choices=PRODUCTS, metavar='PRODUCT',
+                        help=f'export only these products: {", ".join(PRODUCTS)}')
+    parser.add_argument('--files', nargs='+', metavar='PATTERN',
+                        help='process only the input files matching these filename patterns')
+    parser.add_argument('--force', action='store_true',
+                        help='export the selected products again, even if they are up to date')
+    parser.add_argument('--clean', action='store_true', help='remove the output folder before starting')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and process the inputs as they arrive (see params.watch)')
+    parser.add_argument('--enqueue', action='store_true',
+                        help='queue the files for the workers of all the nodes (see params.queue)')
+    parser.add_argument('--worker', action='store_true',
+                        help='process the queued files with --workers processes, until the queue is empty')
+    parser.add_argument('--plan', nargs='?', const='', metavar='JSON',
+                        help='dry run: print the time and outputs predicted for the batch, optionally saved as JSON')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', dest='overrides',
+                        help='override any param, ex: storageRGB.gsd_sm_trigger=3 (repeatable)')
+
+    return parser
+
+
+def applyArgs(args):
+    if args.input:
+        params.input_folder = args.input
+
+    if args.output:
+        setOutputFolder(args.output)
+
+    if args.workers:
+        params.workers = args.workers
+
+    if args.stage_workers:
+        params.stage_workers = args.stage_workers
+
+    if args.products:
+        params.only_products = args.products
+
+    if args.files:
+        params.only_files = args.files
+
+    if args.force:
+        params.incremental = False
+
+    if args.clean:
+        params.clean_output_folder = True
+
+    for assignment in args.overrides:
+        setParam(assignment)
+
+
+def main(argv=None):
+    '''
+    Parse the arguments, override the params and run the batch
+    '''
+    parser = getParser()
+    args = parser.parse_args(argv)
+
+    try:
+        applyArgs(args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # GDAL and the exporters are imported once the params are set
+    if args.plan is not None:
+        from planner import runPlan
+        runPlan(args.plan or None)
+        return 0
+
+    if args.enqueue:
+        from distributed import enqueueBatch
+        enqueueBatch()
+        return 0
+
+    if args.worker:
+        from distributed import runWorkers
+        return runWorkers(params.workers)
+
+    if args.watch:
+        from watcher import Watcher
+        Watcher().run()
+        return 0
+
+    from process import ConvertGeotiff
+
+    ConvertGeotiff()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
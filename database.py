@@ -0,0 +1,259 @@
+import os
+import sys
+import importlib.util
+from osgeo import ogr, osr
+
+import params as params
+
+# Tables of the database records. Each row is replaced when a map is processed again
+TABLES = {
+    'gdalinfo': {
+        'key': ['map_id', 'type'],
+        'fields': [
+            ('map_id', 'string'),
+            ('type', 'string'),
+            ('registroid', 'string'),
+            ('product', 'string'),
+            ('info', 'json')
+        ],
+        'geometry': False
+    },
+    'quantities': {
+        'key': ['map_id'],
+        'fields': [
+            ('map_id', 'string'),
+            ('registroid', 'string'),
+            ('quantities', 'string')
+        ],
+        'geometry': False
+    },
+    'dem_stats': {
+        'key': ['map_id'],
+        'fields': [
+            ('map_id', 'string'),
+            ('registroid', 'string'),
+            ('min', 'real'),
+            ('max', 'real'),
+            ('mean', 'real'),
+            ('valid_area', 'real'),
+            ('volume_above_min', 'real'),
+            ('stats', 'json')
+        ],
+        'geometry': False
+    },
+    'outlines': {
+        'key': ['map_id'],
+        'fields': [
+            ('map_id', 'string'),
+            ('registroid', 'string'),
+            ('gsd', 'real'),
+            ('date', 'string'),
+            ('epsg', 'integer')
+        ],
+        'geometry': True
+    }
+}
+
+OGR_TYPES = {
+    'string': (ogr.OFTString, ogr.OFSTNone),
+    'json': (ogr.OFTString, ogr.OFSTJSON),
+    'real': (ogr.OFTReal, ogr.OFSTNone),
+    'integer': (ogr.OFTInteger64, ogr.OFSTNone)
+}
+
+POSTGIS_TYPES = {
+    'string': 'text',
+    'json': 'jsonb',
+    'real': 'double precision',
+    'integer': 'bigint'
+}
+
+
+def getSink():
+    '''
+    Sink of params.database, None if disabled
+    '''
+    if not params.database['enabled']:
+        return None
+
+    if (params.database['driver'] == 'postgis'):
+        # psycopg2 is only imported when PostGIS is used
+        if not importlib.util.find_spec('psycopg2'):
+            sys.exit('ERROR: psycopg2 module was not found, it is needed to write in PostGIS')
+        return PostGISSink(params.database['postgis_dsn'])
+
+    return GeoPackageSink(params.database['gpkg_file'])
+
+
+def transformGeometry(geom, epsg):
+    '''
+    WKB of the geometry in the SRS of the database
+    '''
+    source = osr.SpatialReference()
+    source.ImportFromEPSG(epsg)
+
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(params.database['epsg'])
+
+    # x/y order, like the GeoJSON outlines
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    geom = ogr.ForceToMultiPolygon(geom.Clone())
+    geom.Transform(osr.CoordinateTransformation(source, target))
+
+    return bytes(geom.ExportToWkb(ogr.wkbNDR))
+
+
+def getUniqueRows(table, rows):
+    '''
+    Last row of each key, a map processed twice in the batch is written once
+    '''
+    key = TABLES[table]['key']
+    return list({tuple(row[field] for field in key): row for row in rows}.values())
+
+
+class GeoPackageSink:
+    '''
+    SQLite / GeoPackage database, written with OGR
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        driver = ogr.GetDriverByName('GPKG')
+
+        ds = driver.Open(self.path, 1) if os.path.exists(self.path) else driver.CreateDataSource(self.path)
+
+        ds.StartTransaction()
+
+        try:
+            for table, rows in records.items():
+                rows = getUniqueRows(table, rows)
+                layer = self._getLayer(ds, table)
+
+                self._deleteRows(ds, table, rows)
+
+                defn = layer.GetLayerDefn()
+
+                for row in rows:
+                    feature = ogr.Feature(defn)
+                    for name, fieldType in TABLES[table]['fields']:
+                        if row.get(name) is not None:
+                            feature.SetField(name, row[name])
+                    if (TABLES[table]['geometry']):
+                        feature.SetGeometry(ogr.CreateGeometryFromWkb(row['geometry']))
+                    layer.CreateFeature(feature)
+                    feature = None
+
+            ds.CommitTransaction()
+
+        except RuntimeError:
+            ds.RollbackTransaction()
+            raise
+
+        finally:
+            ds = None
+
+    def _getLayer(self, ds, table):
+        layer = ds.GetLayerByName(table)
+
+        if layer:
+            return layer
+
+        srs = None
+        geomType = ogr.wkbNone
+
+        if (TABLES[table]['geometry']):
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(params.database['epsg'])
+            geomType = ogr.wkbMultiPolygon
+
+        layer = ds.CreateLayer(table, srs=srs, geom_type=geomType)
+
+        for name, fieldType in TABLES[table]['fields']:
+            oftType, subType = OGR_TYPES[fieldType]
+            field = ogr.FieldDefn(name, oftType)
+            field.SetSubType(subType)
+            layer.CreateField(field)
+
+        index = '_'.join(TABLES[table]['key'])
+        ds.ExecuteSQL(f'CREATE UNIQUE INDEX IF NOT EXISTS {table}_{index} ON {table} ({", ".join(TABLES[table]["key"])})')
+
+        return layer
+
+    def _deleteRows(self, ds, table, rows):
+        '''
+        Upsert as delete and insert, in the same transaction
+        '''
+        for row in rows:
+            condition = ' AND '.join(
+                "{} = '{}'".format(field, str(row[field]).replace("'", "''")) for field in TABLES[table]['key'])
+            ds.ExecuteSQL(f'DELETE FROM {table} WHERE {condition}')
+
+
+class PostGISSink:
+    '''
+    PostgreSQL / PostGIS database, needs psycopg2
+    '''
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+
+    def write(self, records):
+        import psycopg2
+
+        connection = psycopg2.connect(self.dsn)
+
+        try:
+            # one transaction for the whole batch
+            with connection:
+                with connection.cursor() as cursor:
+                    for table, rows in records.items():
+                        self._createTable(cursor, table)
+                        self._upsert(cursor, table, getUniqueRows(table, rows))
+        finally:
+            connection.close()
+
+    def _createTable(self, cursor, table):
+        columns = [f'{name} {POSTGIS_TYPES[fieldType]}' for name, fieldType in TABLES[table]['fields']]
+
+        if (TABLES[table]['geometry']):
+            columns.append(f'geom geometry(Geometry, {params.database["epsg"]})')
+
+        columns.append(f'PRIMARY KEY ({", ".join(TABLES[table]["key"])})')
+
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} ({", ".join(columns)})')
+
+    def _upsert(self, cursor, table, rows):
+        import psycopg2
+        from psycopg2.extras import execute_values
+
+        fields = [name for name, fieldType in TABLES[table]['fields']]
+        columns = list(fields)
+        template = ['%s'] * len(fields)
+
+        if (TABLES[table]['geometry']):
+            columns.append('geom')
+            template.append(f'ST_GeomFromWKB(%s, {params.database["epsg"]})')
+
+        values = []
+        for row in rows:
+            value = [row.get(name) for name in fields]
+            if (TABLES[table]['geometry']):
+                value.append(psycopg2.Binary(row['geometry']))
+            values.append(value)
+
+        key = TABLES[table]['key']
+        updates = ', '.join(f'{column} = EXCLUDED.{column}' for column in columns if column not in key)
+
+        execute_values(
+            cursor,
+            f'INSERT INTO {table} ({", ".join(columns)}) VALUES %s '
+            f'ON CONFLICT ({", ".join(key)}) DO UPDATE SET {updates}',
+            values,
+            template=f'({", ".join(template)})',
+            page_size=1000
+        )
@@ -0,0 +1,197 @@
+import math
+import numpy as np
+
+
+class StreamingHistogram:
+    '''
+    Fixed width histogram built block by block, to get percentiles of big
+    rasters without loading (or sorting) all the values at once.
+
+    Percentiles have an error of at most `binWidth` (same units as the values).
+    If the range of values needs more than `maxBins` bins, the width is doubled
+    until it fits, so memory stays constant.
+    '''
+
+    def __init__(self, binWidth, maxBins=2 ** 22):
+        self.binWidth = binWidth
+        self.maxBins = maxBins
+
+        # absolute index of the first bin (value = index * binWidth)
+        self.offset = 0
+        self.counts = None
+
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values):
+        '''
+        Add a 1d array of valid values
+        '''
+        if values.size == 0:
+            return
+
+        vmin = float(values.min())
+        vmax = float(values.max())
+
+        self.count += values.size
+        self.sum += float(values.sum(dtype=np.float64))
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+
+        while (math.floor(self.max / self.binWidth) - math.floor(self.min / self.binWidth) + 1) > self.maxBins:
+            self._coarsen()
+
+        first = math.floor(self.min / self.binWidth)
+        last = math.floor(self.max / self.binWidth)
+
+        if self.counts is None:
+            self.offset = first
+            self.counts = np.zeros(last - first + 1, dtype=np.int64)
+
+        elif first < self.offset or last >= self.offset + self.counts.size:
+            # extend the histogram to the new range
+            newOffset = min(first, self.offset)
+            counts = np.zeros(max(last, self.offset + self.counts.size - 1) - newOffset + 1, dtype=np.int64)
+            counts[self.offset - newOffset:self.offset - newOffset + self.counts.size] = self.counts
+            self.offset = newOffset
+            self.counts = counts
+
+        # in float64 like the range above, so the edges fall in the same bins
+        indexes = np.floor(values.astype(np.float64) / self.binWidth).astype(np.int64)
+        indexes -= self.offset
+        np.clip(indexes, 0, self.counts.size - 1, out=indexes)
+
+        self.counts += np.bincount(indexes, minlength=self.counts.size)
+
+    def _coarsen(self):
+        '''
+        Merge pairs of bins, doubling the bin width
+        '''
+        self.binWidth *= 2
+
+        if self.counts is None:
+            return
+
+        indexes = (np.arange(self.counts.size) + self.offset) // 2
+        newOffset = self.offset // 2
+        self.counts = np.bincount(indexes - newOffset, weights=self.counts).astype(np.int64)
+        self.offset = newOffset
+
+    def percentile(self, q):
+        '''
+        Same definition as np.percentile (linear), within binWidth: it interpolates
+        between the two values around the rank, each one estimated inside its bin
+        '''
+        if self.count == 0:
+            return math.nan
+
+        rank = q / 100 * (self.count - 1)
+
+        cumulative = np.cumsum(self.counts)
+
+        lower = self._getValue(cumulative, math.floor(rank))
+        upper = self._getValue(cumulative, math.ceil(rank))
+
+        return lower + (upper - lower) * (rank - math.floor(rank))
+
+    def _getValue(self, cumulative, k):
+        '''
+        Estimate of the k-th smallest value (from 0), inside the bin that holds it
+        '''
+        if (k == 0):
+            return self.min
+        if (k >= self.count - 1):
+            return self.max
+
+        index = int(np.searchsorted(cumulative, k, side='right'))
+        index = min(index, self.counts.size - 1)
+
+        # assuming the values of the bin are evenly distributed
+        before = cumulative[index] - self.counts[index]
+        position = (k - before + 0.5) / self.counts[index]
+
+        value = (self.offset + index + position) * self.binWidth
+
+        return min(max(value, self.min), self.max)
+
+    def getBins(self, bins):
+        '''
+        (edges, counts) of `bins` equal bins between min and max, merged from
+        the fine bins. Each fine bin goes to the coarse bin of its center
+        '''
+        if self.count == 0:
+            return [], []
+
+        if self.max == self.min:
+            return [self.min, self.max], [self.count]
+
+        width = (self.max - self.min) / bins
+
+        centers = (np.arange(self.counts.size) + self.offset + 0.5) * self.binWidth
+        indexes = np.clip(((centers - self.min) / width).astype(np.int64), 0, bins - 1)
+
+        counts = np.bincount(indexes, weights=self.counts, minlength=bins).astype(np.int64)
+        edges = [self.min + width * i for i in range(bins + 1)]
+
+        return edges, counts.tolist()
+
+    def getStats(self):
+        return {
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+            'mean': self.sum / self.count if self.count else None,
+            'count': self.count
+        }
+
+
+class DEMStats:
+    '''
+    Statistics and volumes of a DEM, updated block by block in the same
+    read of the style values. The volume above each base level is summed
+    exactly, and the volume above the minimum comes from the sum of the values
+    '''
+
+    def __init__(self, pixelArea, baseLevels, binWidth):
+        self.pixelArea = pixelArea
+        self.baseLevels = list(baseLevels)
+        self.histogram = StreamingHistogram(binWidth)
+        self.volumes = [0.0] * len(self.baseLevels)
+
+    def update(self, values):
+        '''
+        Add a 1d array of valid values
+        '''
+        if values.size == 0:
+            return
+
+        self.histogram.update(values)
+
+        for i, base in enumerate(self.baseLevels):
+            above = values[values > base]
+            self.volumes[i] += float((above - base).sum(dtype=np.float64)) * self.pixelArea
+
+    def getReport(self, percentiles, bins):
+        histogram = self.histogram
+        stats = histogram.getStats()
+
+        # sum of (value - min) of every valid pixel
+        aboveMin = (histogram.sum - stats['count'] * stats['min']) * self.pixelArea if stats['count'] else 0
+
+        report = {
+            **stats,
+            'valid_area': round(stats['count'] * self.pixelArea / 10000, 4),  # ha
+            'pixel_area': self.pixelArea,  # m2
+            'percentiles': {str(q): histogram.percentile(q) for q in percentiles} if stats['count'] else {},
+            'volumes': {
+                'above_min': aboveMin,
+                'above_base': {str(base): volume for base, volume in zip(self.baseLevels, self.volumes)}
+            }
+        }
+
+        edges, counts = histogram.getBins(bins)
+
+        report['histogram'] = {'edges': edges, 'counts': counts}
+
+        return report
@@ -0,0 +1,224 @@
+'''
+Batch processed by workers in several nodes that share the input and output
+folders. One node scans the input folder and fills the queue:
+    python cli.py --enqueue
+and every node runs workers that claim the jobs until the queue is empty:
+    python cli.py --worker --workers 4
+'''
+
+import os
+import sys
+import time
+import threading
+import multiprocessing
+
+import params as params
+import generateVRT as vrt
+import metrics
+from job import Job, processJob, findJobs, initWorker, getParamValues
+from manifest import Manifest
+from headers import HeaderCache
+from scheduler import Scheduler
+from database import getSink
+from uploader import getUploader
+from jobQueue import getQueue, getWorkerId
+from process import ConvertGeotiff
+
+
+def describeJob(job):
+    '''
+    What a worker of another node needs to create the same job
+    '''
+    return {
+        'filepath': job.filepath,
+        'isDEM': job.isDEM,
+        'regid': job.regid,
+        'mapId': job.mapId,
+        'products': sorted(job.products),
+        'header': job.header,
+        'fingerprint': job.fingerprint
+    }
+
+
+def restoreJob(description):
+    # the mapId of the queue is the only one known for the registro
+    job = Job(description['filepath'], description['isDEM'], {description['regid']: description['mapId']})
+    job.products = set(description['products'])
+    job.header = description['header']
+    job.fingerprint = description['fingerprint']
+    return job
+
+
+def enqueueBatch():
+    '''
+    Scan the input folder and queue the files with pending products. The mapIds
+    of new registros are assigned in the queue, once for the RGB and DEM
+    '''
+    converter = ConvertGeotiff(run=False)
+    converter.checkDirectories()
+
+    if(os.listdir(params.input_folder)):
+        vrt.generateVRT()
+
+    queue = getQueue()
+
+    headers = HeaderCache()
+    jobs = findJobs(Manifest(), headers, queue.getMapIds())
+    headers.save()
+
+    queued = 0
+
+    for job in jobs:
+        if not job.products:
+            print(f'-> Skipping {job.file}, outputs are up to date')
+            continue
+
+        if (params.filename_prefix not in job.file):
+            mapId = queue.assignMapId(job.regid, job.mapId)
+
+            if (mapId != job.mapId):
+                # assigned by another scan meanwhile
+                job = restoreJob({**describeJob(job), 'mapId': mapId})
+
+        if queue.enqueue(job.file, describeJob(job)):
+            print(f'-> Queued {job.file} as {job.outputFilename}')
+            queued += 1
+        else:
+            print(f'-> {job.file} is being processed, not queued again')
+
+    print(f'-> {queued} files queued')
+
+
+class QueueWorker:
+    '''
+    Claims jobs from the queue until there are no pending ones, renewing the
+    lease while each job runs. The files shared by all the workers (manifest,
+    metrics, database) are written under a lock of the queue
+    '''
+
+    def __init__(self):
+        self.queue = getQueue()
+        self.worker = getWorkerId()
+        self.lease = params.queue['lease_seconds']
+        self.failed = False
+
+    def run(self):
+        # GDAL settings, and the summary written as in a local batch
+        self.converter = ConvertGeotiff(run=False)
+
+        # fails now if the upload is enabled without boto3
+        getUploader()
+
+        self.database = getSink()
+
+        print(f'-> Worker {self.worker} started')
+
+        while True:
+            claimed = self.queue.claim(self.worker, self.lease)
+
+            if claimed:
+                self.process(*claimed)
+                continue
+
+            counts = self.queue.getCounts()
+
+            if not counts.get('pending') and not counts.get('running'):
+                break
+
+            # the jobs running in other workers are claimed again if their lease expires
+            time.sleep(params.queue['poll_interval'])
+
+        self.exportSummary()
+
+        print(f'-> Worker {self.worker} finished')
+
+        return 1 if self.failed else 0
+
+    def process(self, file, description):
+        job = restoreJob(description)
+
+        # GDAL cache and warp memory of its share of the node
+        Scheduler([job], params.workers).next(0)
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(file, stop), daemon=True)
+        heartbeat.start()
+
+        try:
+            result = processJob(job, waitUploads=True)
+        except Exception as e:
+            result = {
+                **job.getSummary(),
+                'status': 'error',
+                'error': repr(e)
+            }
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        print(f'-> Finished {file} ({result["status"]})')
+
+        if (result['status'] == 'error'):
+            self.failed = True
+
+        with self.queue.lock('output', self.worker):
+            self.saveResult(result)
+
+        # the records and metrics are already saved
+        stored = {key: value for key, value in result.items() if key not in ('records', 'metrics')}
+
+        if not self.queue.complete(file, self.worker, stored):
+            print(f'WARNING: The lease of {file} expired while processing it, it was claimed by another worker')
+
+    def heartbeat(self, file, stop):
+        while not stop.wait(self.lease / 3):
+            if not self.queue.heartbeat(file, self.worker, self.lease):
+                print(f'WARNING: Lost the lease of {file}')
+                return
+
+    def saveResult(self, result):
+        if (params.metrics['enabled']):
+            metrics.appendEvents(result.get('metrics', []))
+
+        if (self.database and result.get('records')):
+            self.database.write(result['records'])
+
+        if (result['status'] == 'ok'):
+            # read again, the other workers update it too
+            manifest = Manifest()
+            manifest.update(result)
+            manifest.save()
+
+    def exportSummary(self):
+        '''
+        Summary of the whole queue, the last worker to finish writes the complete one
+        '''
+        with self.queue.lock('output', self.worker):
+            self.converter.exportSummary(self.queue.getResults())
+
+
+def _runWorker(paramValues):
+    initWorker(paramValues)
+    sys.exit(QueueWorker().run())
+
+
+def runWorkers(count):
+    '''
+    Run `count` workers in this node, returns 1 if any of them had errors
+    '''
+    if (count <= 1):
+        return QueueWorker().run()
+
+    # with spawn the params overridden by the command line are passed to the workers
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+
+    processes = [context.Process(target=_runWorker, args=(getParamValues(),)) for _ in range(count)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    return 1 if any(process.exitcode for process in processes) else 0
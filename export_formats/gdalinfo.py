@@ -3,7 +3,8 @@ from osgeo import gdal
 
 import params as params
 
-def exportGdalinfo(self, ds):
+
+def exportGdalinfo(self, ds, product):
     '''
     Export a JSON file with the gdalinfo data
     '''
@@ -19,4 +20,14 @@ def exportGdalinfo(self, ds):
     file = open(gdaloutput, 'w')
     json.dump(data, file)
 
-    file.close()
\ No newline at end of file
+    file.close()
+
+    self.addOutput(product, gdaloutput)
+
+    self.addRecord('gdalinfo', {
+        'map_id': self.mapId,
+        'type': 'DEM' if self.isDEM else 'RGB',
+        'registroid': self.registroid,
+        'product': product,
+        'info': json.dumps(data)
+    })
@@ -1,56 +1,76 @@
-from osgeo import gdal
-import rasterio
-from rasterio.enums import Resampling
 import numpy as np
 
 import helpers as h
 import params as params
 
-TEMP_FOLDER = params.tmp_folder
+# internal tile size of the RGB output, used as the encoding window
+BLOCK_SIZE = 256
 
 
-def exportGeoserverDEM(self, file_ds, file):
-    ''''
-    Exports two geoserver versions:
-    - 32 bits float
-    - RGB color conversion
+def planGeoserverDEM(self, plan):
+    '''
+    Registers the grids used by the geoserver versions. Both are reprojected
+    from the same warp
     '''
 
-    kwargs = {
-        'multithread': True,
-        'xRes': max(0.3, self.pixelSizeX),
-        'yRes': max(0.3, self.pixelSizeY),
-        # force 'none' to fix old error in Drone Deploy exports (https://gdal.org/programs/gdal_translate.html#cmdoption-gdal_translate-a_nodata)
-        'srcNodata': 'none' if self.hasAlphaChannel else self.noDataValue
-    }
+    # force 'none' to fix old error in Drone Deploy exports (https://gdal.org/programs/gdal_translate.html#cmdoption-gdal_translate-a_nodata)
+    srcNodata = 'none' if self.hasAlphaChannel else self.noDataValue
+
+    dstNodata = None
+
+    dstSRS = None
 
     # change all tiff noData values to the same value
-    if (kwargs['srcNodata'] != params.no_data and kwargs['srcNodata'] != 'none'):
-        kwargs['dstNodata'] = params.no_data
+    if (srcNodata != params.no_data and srcNodata != 'none'):
+        dstNodata = params.no_data
         print(
             f'-> Changing noData value from {self.noDataValue} to {params.no_data}')
 
     # if file has diferent epsg, convert
     if (self.epsg != params.geoserver_epsg):
-        kwargs['srcSRS'] = f'EPSG:{self.epsg}'
-        kwargs['dstSRS'] = f'EPSG:{params.geoserver_epsg}'
+        dstSRS = f'EPSG:{params.geoserver_epsg}'
         print(
             f'-> Transforming EPSG:{self.epsg} to EPSG:{params.geoserver_epsg}')
 
-    tmpWarp = TEMP_FOLDER + "\\warpTmp.vrt"
+    if (params.geoserverDEM['enabled']):
+        plan.add(
+            'geoserverDEM',
+            xRes=max(params.geoserverDEM['gsd']/100, self.pixelSizeX),
+            yRes=max(params.geoserverDEM['gsd']/100, self.pixelSizeY),
+            srcNodata=srcNodata,
+            dstNodata=dstNodata,
+            dstSRS=dstSRS
+        )
 
-    # Use the warp to convert projections, change the GSD and correct the noData values
-    file_ds = gdal.Warp(tmpWarp, file_ds, **kwargs)
+    if (params.geoserverDEMRGB['enabled']):
+        plan.add(
+            'geoserverDEMRGB',
+            xRes=max(0.3, self.pixelSizeX),
+            yRes=max(0.3, self.pixelSizeY),
+            srcNodata=srcNodata,
+            dstNodata=dstNodata,
+            dstSRS=dstSRS,
+            # read with rasterio
+            onDisk=True
+        )
+
+
+def exportGeoserverDEM(self):
+    ''''
+    Exports two geoserver versions:
+    - 32 bits float
+    - RGB color conversion
+    '''
 
     outputFilename = f'{self.outputFilename}.tif'
 
     if (params.geoserverDEM['enabled']):
+        file_ds = self.warpPlan.open('geoserverDEM')
         _exportFloat(self, file_ds, outputFilename)
-    
-    file_ds = None
-    
+        file_ds = None
+
     if (params.geoserverDEMRGB['enabled']):
-        _exportRGB(self, tmpWarp, outputFilename)
+        _exportRGB(self, self.warpPlan.getPath('geoserverDEMRGB'), outputFilename)
 
 
 def _exportFloat(self, file_ds, outputFilename):
@@ -70,20 +90,19 @@ def _exportFloat(self, file_ds, outputFilename):
             'TFW=NO',
             'TILED=YES',
             'PHOTOMETRIC=MINISBLACK',
-            'COMPRESS=DEFLATE',
+            *h.getCompressionOptions(params.geoserverDEM)
         ],
         'metadataOptions': self.extra_metadata,
         # to fix old error in Drone Deploy exports (https://gdal.org/programs/gdal_translate.html#cmdoption-gdal_translate-a_nodata)
         'noData': 'none' if self.hasAlphaChannel else params.no_data
     }
 
-    file_ds = gdal.Translate(gdaloutputDEM, file_ds, **kwargs)
-
-    if (params.geoserverDEM['overviews']):
-        h.addOverviews(file_ds)
+    file_ds = h.exportGeotiff(gdaloutputDEM, file_ds, kwargs, params.geoserverDEM)
 
     file_ds = None
 
+    self.addOutput('geoserverDEM', gdaloutputDEM)
+
 
 def _exportRGB(self, tmpFile, outputFilename):
     '''
@@ -99,51 +118,106 @@ def _exportRGB(self, tmpFile, outputFilename):
 
     '''
 
+    # only this product needs rasterio, imported when it's exported
+    import rasterio
+    from rasterio.enums import Resampling
+
     print('-> Exporting geoserver DEM in RGB mode')
 
     gdaloutputDEMRGB = f'{params.geoserverDEMRGB["output_folder"]}/{outputFilename}'
     
     print(f'--> Exporting {gdaloutputDEMRGB}')
 
+    # a COG can't be written by windows, the tiled result is converted at the end
+    cog = params.geoserverDEMRGB['cog'] and h.isCOGAvailable()
+
+    encodedOutput = self.temp.getPath('terrainRGB.tif', onDisk=True) if cog else gdaloutputDEMRGB
+
+    compression = h.getCompressionOptions(params.geoserverDEMRGB)
+
     with rasterio.open(tmpFile) as src:
-        dem = src.read(1)
 
-    shape = dem.shape
-    r = np.zeros(shape)
-    g = np.zeros(shape)
-    b = np.zeros(shape)
+        meta = src.meta
+        meta['dtype'] = rasterio.uint8
+        meta['nodata'] = None
+        meta['count'] = 3
+        meta['driver'] = 'GTiff'
+        # creation options of the compression profile
+        for option in compression:
+            key, value = option.split('=', 1)
+            meta[key.lower()] = value
+        # the output is encoded and written one internal tile at a time,
+        # so memory depends on the block size and not on the raster size
+        meta['tiled'] = True
+        meta['blockxsize'] = BLOCK_SIZE
+        meta['blockysize'] = BLOCK_SIZE
+        meta['BIGTIFF'] = 'IF_SAFER'
+
+        with rasterio.open(encodedOutput, 'w', **meta) as dst:
+
+            for _, window in dst.block_windows(1):
+                dem = src.read(1, window=window)
+                dst.write(encodeTerrainRGB(
+                    dem, self.noDataValue, params.geoserverDEMRGB['encoding']), window=window)
+
+            if (params.geoserverDEMRGB['overviews'] and not cog):
+                print('--> Adding overviews')
+                with rasterio.Env(**h.getOverviewConfig(compression)):
+                    dst.build_overviews(params.overviews, Resampling.average)
+
+    if (cog):
+        h.exportGeotiff(
+            gdaloutputDEMRGB,
+            encodedOutput,
+            {'creationOptions': [*compression, 'BIGTIFF=IF_SAFER']},
+            params.geoserverDEMRGB
+        )
+
+    self.addOutput('geoserverDEMRGB', gdaloutputDEMRGB)
+
+
+def encodeTerrainRGB(dem, noDataValue, encoding):
+    '''
+    Encode a block of elevations to a (3, rows, cols) uint8 array.
+    Uses integer arithmetic over the floored values, which gives the same bytes
+    as the float formulas but without the float64 r/g/b planes. `dem` is modified in place.
+    '''
+
+    rgb = np.empty((3,) + dem.shape, dtype=np.uint8)
+
+    # integer DEMs would overflow with the offsets below
+    if not np.issubdtype(dem.dtype, np.floating):
+        dem = dem.astype(np.float32)
 
     # convert nan values no noData
     dem = np.nan_to_num(dem, nan=params.no_data, copy=False)
 
     # normalize noDataValues
-    if self.noDataValue != None:
-        dem[dem == self.noDataValue] = params.no_data
+    if noDataValue != None:
+        dem[dem == noDataValue] = params.no_data
 
-    if params.geoserverDEMRGB['encoding'] == 'mapbox':
+    if encoding == 'mapbox':
+        # (100000 + dem * 10) computed in the DEM dtype, like the original formula
+        dem *= 10
+        dem += 100000
+        value = np.floor(dem).astype(np.int64)
 
-        r += np.floor_divide((100000 + dem * 10), 65536)
-        g += np.floor_divide((100000 + dem * 10), 256) - r * 256
-        b += np.floor(100000 + dem * 10) - r * 65536 - g * 256
+        # r = value // 65536, g = value // 256 % 256, b = value % 256
+        np.right_shift(value, 16, out=rgb[0], casting='unsafe')
+        np.right_shift(value, 8, out=rgb[1], casting='unsafe')
+        np.copyto(rgb[2], value, casting='unsafe')
 
-    elif params.geoserverDEMRGB['encoding'] == 'terrarium':
+    elif encoding == 'terrarium':
         dem += 32768
-        r += np.floor_divide(dem, 256)
-        g += np.mod(dem, 256)
-        b += np.floor((dem - np.floor(dem)) * 256)
-
-    meta = src.meta
-    meta['dtype'] = rasterio.uint8
-    meta['nodata'] = None
-    meta['count'] = 3
-    meta['driver'] = 'GTiff'
-    meta['compress'] = 'deflate'
-
-    with rasterio.open(gdaloutputDEMRGB, 'w', **meta) as dst:
-        dst.write_band(1, r.astype(rasterio.uint8))
-        dst.write_band(2, g.astype(rasterio.uint8))
-        dst.write_band(3, b.astype(rasterio.uint8))
-
-        if (params.geoserverDEMRGB['overviews']):
-            print('--> Adding overviews')
-            dst.build_overviews(params.overviews, Resampling.average)
+        floor = np.floor(dem)
+        value = floor.astype(np.int64)
+
+        # r = value // 256, g = value % 256, b = fractional part * 256
+        np.right_shift(value, 8, out=rgb[0], casting='unsafe')
+        np.copyto(rgb[1], value, casting='unsafe')
+
+        dem -= floor
+        dem *= 256
+        np.copyto(rgb[2], np.floor(dem, out=dem), casting='unsafe')
+
+    return rgb
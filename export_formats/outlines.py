@@ -3,8 +3,7 @@ from osgeo import gdal, osr, ogr
 import numpy as np
 
 import params as params
-
-TEMP_FOLDER = params.tmp_folder
+from database import transformGeometry
 
 
 def exportOutline(self, file_ds):
@@ -24,31 +23,26 @@ def exportOutline(self, file_ds):
     if res != 0:
         raise RuntimeError(repr(res) + ': EPSG not found')
 
-    tmpFilename = f'{self.outputFilename}{params.outline_suffix}.geojson'
+    mask_ds = getMask(self, file_ds)
+    maskBand = mask_ds.GetRasterBand(1)
 
-    # Temporary vector file
-    tmpGdaloutput = TEMP_FOLDER + "\\" + tmpFilename
+    gt = mask_ds.GetGeoTransform()
+    pixelArea = abs(gt[1] * gt[5])
 
-    if os.path.exists(tmpGdaloutput):
-        geoDriver.DeleteDataSource(tmpGdaloutput)
+    # Remove the specks (and fill the holes) smaller than the minimum area before polygonizing,
+    # noisy masks can give hundreds of thousands of tiny polygons
+    threshold = int(params.outlines['minimum_area'] / pixelArea)
+    if threshold > 1:
+        gdal.SieveFilter(maskBand, None, maskBand, threshold, 4)
 
-    tmpOutDatasource = geoDriver.CreateDataSource(tmpGdaloutput)
+    # Polygons are kept in memory, there is no need for a temporary file
+    tmpOutDatasource = ogr.GetDriverByName('Memory').CreateDataSource('outline')
 
     outLayer = tmpOutDatasource.CreateLayer("outline", srs=srs)
 
-    if self.hasAlphaChannel:
-        maskBand = file_ds.GetRasterBand(4)
-    else:
-        red_band = file_ds.GetRasterBand(1).ReadAsArray()
-        maskBand = np.where(red_band == self.noDataValue, 0, 255).astype(np.uint8)
-        file_ds.GetRasterBand(1).WriteArray(maskBand)
-        maskBand = file_ds.GetRasterBand(1)
-
-    # Create the outline based on the alpha channel
+    # Create the outline based on the mask
     gdal.Polygonize(maskBand, maskBand, outLayer, -1, [], callback=None)
 
-    tmpOutDatasource = None
-    
     if os.path.exists(gdaloutput):
         geoDriver.DeleteDataSource(gdaloutput)
 
@@ -58,12 +52,11 @@ def exportOutline(self, file_ds):
     layer = outDatasource.CreateLayer(
         "outline", srs=srs, geom_type=ogr.wkbPolygon)
 
-    shp = ogr.Open(tmpGdaloutput, 0)
-    tmp_layer = shp.GetLayer()
-
     biggerGeoms = []
 
-    for feature in tmp_layer:
+    outLayer.ResetReading()
+
+    for feature in outLayer:
         geom = feature.geometry()
         area = geom.GetArea()
 
@@ -73,7 +66,9 @@ def exportOutline(self, file_ds):
             # Clone to prevent multiiple GDAL bugs
             biggerGeoms.append(geom.Clone())
 
-    tmp_layer = None
+    outLayer = None
+    tmpOutDatasource = None
+    mask_ds = None
     geom = None
 
     # Convert mutiples Polygons to an unique MultiPolygon
@@ -129,8 +124,59 @@ def exportOutline(self, file_ds):
 
             feature = None
 
+            # the reprojection is only needed by the database
+            if (params.database['enabled']):
+                self.addRecord('outlines', {
+                    'map_id': self.mapId,
+                    'registroid': self.registroid,
+                    'gsd': self.originalGsd,
+                    'date': self.date.strftime('%Y-%m-%d') if self.date else None,
+                    'epsg': self.epsg,
+                    'geometry': transformGeometry(simplifyGeom, self.epsg)
+                })
+
     outDatasource = None
 
+    self.addOutput('outlines', gdaloutput)
+
+
+def getMask(self, file_ds):
+    '''
+    In memory 0/1 mask of the valid pixels (alpha or noData), at params.outlines['gsd'].
+    The dataset is only read, it is shared with other exports
+    '''
+
+    gt = file_ds.GetGeoTransform()
+
+    gsd = params.outlines['gsd']
+
+    # never read at a finer resolution than the dataset
+    factorX = max(1, (gsd / 100) / gt[1]) if gsd else 1
+    factorY = max(1, (gsd / 100) / -gt[5]) if gsd else 1
+
+    width = max(1, round(file_ds.RasterXSize / factorX))
+    height = max(1, round(file_ds.RasterYSize / factorY))
+
+    maskArray = file_ds.GetRasterBand(1).GetMaskBand().ReadAsArray(
+        0, 0, file_ds.RasterXSize, file_ds.RasterYSize, buf_xsize=width, buf_ysize=height)
+
+    # partial alpha values at the borders count as valid
+    np.minimum(maskArray, 1, out=maskArray)
+
+    mask_ds = gdal.GetDriverByName('MEM').Create('', width, height, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform([
+        gt[0],
+        gt[1] * file_ds.RasterXSize / width,
+        gt[2],
+        gt[3],
+        gt[4],
+        gt[5] * file_ds.RasterYSize / height
+    ])
+    mask_ds.SetProjection(file_ds.GetProjection())
+    mask_ds.GetRasterBand(1).WriteArray(maskArray)
+
+    return mask_ds
+
 
 def simplificarGeometria(geom):
     return geom.Simplify(params.outlines['simplify'])
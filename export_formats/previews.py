@@ -1,16 +1,22 @@
 from osgeo import gdal
-from PIL import Image, ImageEnhance, ImageColor
-from osgeo_utils.gdal_calc import Calc
-Image.MAX_IMAGE_PIXELS = None
+import numpy as np
 
 import params as params
 
+# Same style of the previous gdaldem / gdal_calc / PIL chain
+HILLSHADE_AZIMUTH = 90
+HILLSHADE_ALTITUDE = 45
+HILLSHADE_Z_FACTOR = 5
+HILLSHADE_GAMMA = 0.5
+CONTRAST_FACTOR = 1.12
+
 
 def exportStoragePreview(self, geotiff):
 
     # temporary disable the "auxiliary metadata" because JPG doesn't support it,
-    # so this creates an extra file that we don't need (...aux.xml)
-    gdal.SetConfigOption('GDAL_PAM_ENABLED', 'NO')
+    # so this creates an extra file that we don't need (...aux.xml).
+    # Only in this thread, the other exports can run at the same time
+    gdal.SetThreadLocalConfigOption('GDAL_PAM_ENABLED', 'NO')
 
     outputPreviewFilename = f'{self.outputFilename}{params.preview_suffix}.jpg'
 
@@ -38,82 +44,109 @@ def exportStoragePreview(self, geotiff):
         }
     )
 
+    self.addOutput('previews', gdaloutput)
+
     # reenable the internal metadata
-    gdal.SetConfigOption('GDAL_PAM_ENABLED', 'YES')
+    gdal.SetThreadLocalConfigOption('GDAL_PAM_ENABLED', None)
 
 
 def getColoredHillshade(self, geotiff):
     '''
-    Create a colored hillshade result from merging hillshade / DEM
+    Create a colored hillshade result from merging hillshade / DEM.
+    The DEM is read already resampled to the preview width, and the
+    result is rendered in memory
     '''
-    tmpColorRelief = f'{params.tmp_folder}\\colorRelief.tif'
-    tmpHillshade = f'{params.tmp_folder}\\hillshade.tif'
-    tmpGammaHillshade = f'{params.tmp_folder}\\gammaHillshade.tif'
-    tmpColoredHillshade = f'{params.tmp_folder}\\coloredHillshade.tif'
-    tmpColoredHillshadeContrast = f'{params.tmp_folder}\\coloredHillshadeC.tif'
-    tmpFileColorPath = f'{params.tmp_folder}\\colorPalette.txt'
-
-    fileColor = open(tmpFileColorPath, 'w')
-
-    rgbPalette = [' '.join(map(str, ImageColor.getcolor(x, 'RGB')))
-                  for x in params.styleDEM['palette']]
-
-    # Write palette file to be imported in gdal
-    i = 0
-    while i < len(params.styleDEM['palette']):
-        # Generating a color palette merging two structures
-        mergeColor = str(self.colorValues[i]) + ' ' + \
-            str(rgbPalette[i])
-        fileColor.write(mergeColor + '\n')
-        i += 1
-
-    fileColor.close()
-
-    # Using gdaldem to generate color-Relief and hillshade https://gdal.org/programs/gdaldem.html
-    gdal.DEMProcessing(
-        tmpColorRelief,
-        geotiff,
-        **{
-            'format': 'JPEG',
-            'colorFilename': tmpFileColorPath,
-            'processing': 'color-relief'
-        }
-    )
 
-    gdal.DEMProcessing(
-        tmpHillshade,
-        geotiff,
-        **{
-            'format': 'JPEG',
-            'processing': 'hillshade',
-            'azimuth': '90',
-            'zFactor': '5'
-        }
-    )
+    width = params.previews['width']
+    height = max(1, round(geotiff.RasterYSize * width / geotiff.RasterXSize))
+
+    band = geotiff.GetRasterBand(1)
+
+    dem = band.ReadAsArray(buf_xsize=width, buf_ysize=height,
+                           buf_type=gdal.GDT_Float32, resample_alg=gdal.GRIORA_Average)
+
+    # alpha or noData mask
+    valid = band.GetMaskBand().ReadAsArray(buf_xsize=width, buf_ysize=height) > 0
+    valid &= np.isfinite(dem)
+
+    gt = geotiff.GetGeoTransform()
+
+    # resolution of the preview grid
+    ewres = gt[1] * geotiff.RasterXSize / width
+    nsres = gt[5] * geotiff.RasterYSize / height
+
+    from PIL import ImageColor
+
+    colors = [ImageColor.getcolor(x, 'RGB') for x in params.styleDEM['palette']]
+
+    rgb = renderColoredHillshade(dem, valid, ewres, nsres, self.colorValues, colors)
+
+    preview_ds = gdal.GetDriverByName('MEM').Create('', width, height, 3, gdal.GDT_Byte)
+    preview_ds.SetGeoTransform([gt[0], ewres, gt[2], gt[3], gt[4], nsres])
+    preview_ds.SetProjection(geotiff.GetProjection())
+
+    for i in range(3):
+        preview_ds.GetRasterBand(i + 1).WriteArray(rgb[i])
+
+    return preview_ds
+
+
+def renderColoredHillshade(dem, valid, ewres, nsres, colorValues, colors):
+    '''
+    Hillshade (gdaldem Horn algorithm), color relief, gamma, overlay blend
+    and contrast in one pass. Invalid pixels are black. Returns a (3, rows, cols) uint8 array
+    '''
+
+    rows, cols = dem.shape
+
+    dem = np.where(valid, dem, 0).astype(np.float32)
+
+    padded = np.pad(dem, 1, mode='edge')
+    paddedValid = np.pad(valid, 1, mode='constant', constant_values=False)
+
+    def window(row, col):
+        return padded[row:row + rows, col:col + cols]
+
+    # like gdaldem without -compute_edges, pixels next to noData have no shade
+    shaded = np.ones((rows, cols), dtype=bool)
+    for row in range(3):
+        for col in range(3):
+            shaded &= paddedValid[row:row + rows, col:col + cols]
+
+    # Horn's formula, same constants that gdaldem
+    x = ((window(0, 0) + 2 * window(1, 0) + window(2, 0)) - (window(0, 2) + 2 * window(1, 2) + window(2, 2))) / ewres
+    y = ((window(2, 0) + 2 * window(2, 1) + window(2, 2)) - (window(0, 0) + 2 * window(0, 1) + window(0, 2))) / nsres
+
+    zScaled = HILLSHADE_Z_FACTOR / 8
+    altitude = np.radians(HILLSHADE_ALTITUDE)
+    azimuth = np.radians(HILLSHADE_AZIMUTH)
+
+    cang = 254 * (np.sin(altitude) - (y * np.cos(azimuth) - x * np.sin(azimuth)) * np.cos(altitude) * zScaled) \
+        / np.sqrt(1 + zScaled * zScaled * (x * x + y * y))
+
+    hillshade = np.where(cang <= 0, 1, 1 + cang)
+    hillshade[~shaded] = 0
+
+    # gamma, on the byte values like the old gdal_calc expression
+    hillshade = np.floor(np.floor(hillshade) * HILLSHADE_GAMMA) / 255
+
+    # color relief, linear between the breakpoints and clamped outside them
+    rgb = np.empty((3, rows, cols), dtype=np.float32)
+    for i in range(3):
+        rgb[i] = np.interp(dem, colorValues, [color[i] for color in colors]) / 255
+
+    # overlay blend (hillshade as base)
+    rgb = np.where(
+        hillshade < 0.5,
+        2 * hillshade * rgb,
+        1 - 2 * (1 - hillshade) * (1 - rgb)
+    ) * 255
+
+    rgb = np.floor(rgb)
+    rgb[:, ~valid] = 0
+
+    # contrast around the mean gray level, like PIL's ImageEnhance.Contrast
+    mean = np.floor((rgb[0] * 299 + rgb[1] * 587 + rgb[2] * 114).mean() / 1000 + 0.5)
+    rgb = mean + CONTRAST_FACTOR * (rgb - mean)
 
-    # Adjust hillshade gamma values
-    Calc(["uint8(((A/255)*(0.5))*255)"],
-         A=tmpHillshade,
-         outfile=tmpGammaHillshade,
-         overwrite=True
-         )
-
-    # Merge hillshade and color
-    Calc(["uint8( ( \
-                2 * (A/255.)*(B/255.)*(A<128) + \
-                ( 1 - 2 * (1-(A/255.))*(1-(B/255.)) ) * (A>=128) \
-            ) * 255 )"],
-         A=tmpGammaHillshade,
-         B=tmpColorRelief,
-         outfile=tmpColoredHillshade,
-         allBands="B",
-         overwrite=True
-         )
-
-    im = Image.open(tmpColoredHillshade)
-    enhancer = ImageEnhance.Contrast(im)
-    factor = 1.12  # Increase contrast
-    im_output = enhancer.enhance(factor)
-    im_output.save(tmpColoredHillshadeContrast)
-
-    return tmpColoredHillshadeContrast
+    return np.clip(rgb, 0, 255).astype(np.uint8)
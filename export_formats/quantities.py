@@ -1,9 +1,11 @@
+import json
+
 import params as params
 
 
 def exportQuantities(self):
 
-    quantitiesPath = f'{params.output_folder_database_mdevalues}\\{self.outputFilename}.txt'
+    quantitiesPath = f'{params.output_folder_database_mdevalues}/{self.outputFilename}.txt'
 
     print(f'-> Exporting quantities {quantitiesPath}')
 
@@ -22,3 +24,47 @@ def exportQuantities(self):
     fileQuantities = open(quantitiesPath, 'w')
     fileQuantities.write(string)
     fileQuantities.close()
+
+    self.addOutput('quantities', quantitiesPath)
+
+    self.addRecord('quantities', {
+        'map_id': self.mapId,
+        'registroid': self.registroid,
+        'quantities': string
+    })
+
+    if self.demStats:
+        exportStats(self)
+
+
+def exportStats(self):
+    '''
+    Statistics of the DEM (min, max, mean, percentiles, histogram, valid area
+    and volumes), computed in the read of the color values
+    '''
+
+    statsPath = f'{params.output_folder_database_mdevalues}/{self.outputFilename}{params.stats_suffix}.json'
+
+    print(f'-> Exporting DEM statistics {statsPath}')
+
+    report = self.demStats.getReport(params.demStats['percentiles'], params.demStats['histogram_bins'])
+
+    report['resolution'] = 'full' if params.styleDEM['full_resolution'] else 'lightweight'
+
+    print(f'--> Valid area: {report["valid_area"]} ha, volume above min: {round(report["volumes"]["above_min"], 2)} m3')
+
+    with open(statsPath, 'w') as file:
+        json.dump(report, file, indent=2)
+
+    self.addOutput('quantities', statsPath)
+
+    self.addRecord('dem_stats', {
+        'map_id': self.mapId,
+        'registroid': self.registroid,
+        'min': report['min'],
+        'max': report['max'],
+        'mean': report['mean'],
+        'valid_area': report['valid_area'],
+        'volume_above_min': report['volumes']['above_min'],
+        'stats': json.dumps(report)
+    })
@@ -1,13 +1,33 @@
-from osgeo import gdal
-
-from helpers import addOverviews
+from helpers import exportGeotiff, getCompressionOptions
 import params as params
 from export_formats.gdalinfo import exportGdalinfo
 
-TEMP_FOLDER = params.tmp_folder
 
+def planStorageDEM(self, plan):
+    '''
+    Registers the grid used by the storage version
+    '''
+
+    srcNodata = 'none' if self.hasAlphaChannel else self.noDataValue
+
+    dstNodata = None
+
+    # change all tiff noData values to the same value
+    if (srcNodata != params.no_data and srcNodata != 'none'):
+        dstNodata = params.no_data
+        print(
+            f'-> Changing noData value from {self.noDataValue} to {params.no_data}')
 
-def exportStorageDEM(self, file_ds):
+    plan.add(
+        'storageDEM',
+        xRes=max(params.storageDEM['gsd']/100, self.pixelSizeX) if params.storageDEM['gsd'] else self.pixelSizeX,
+        yRes=max(params.storageDEM['gsd']/100, self.pixelSizeY) if params.storageDEM['gsd'] else self.pixelSizeY,
+        srcNodata=srcNodata,
+        dstNodata=dstNodata
+    )
+
+
+def exportStorageDEM(self):
     '''
     Exports highest resolution version
     '''
@@ -20,28 +40,7 @@ def exportStorageDEM(self, file_ds):
 
     print(f'-> Exporting {gdaloutput}')
 
-    tmpWarp = None
-
-    warp = False
-
-    kwargs = {
-        'xRes': max(params.storageDEM['gsd']/100, self.pixelSizeX) if params.storageDEM['gsd'] else self.pixelSizeX,
-        'yRes': max(params.storageDEM['gsd']/100, self.pixelSizeY) if params.storageDEM['gsd'] else self.pixelSizeY,
-        'multithread': True,
-        # force 'none' to fix old error in Drone Deploy exports (https://gdal.org/programs/gdal_translate.html#cmdoption-gdal_translate-a_nodata)
-        'srcNodata': 'none' if self.hasAlphaChannel else self.noDataValue
-    }
-
-    # change all tiff noData values to the same value
-    if (kwargs['srcNodata'] != params.no_data and kwargs['srcNodata'] != 'none'):
-        kwargs['dstNodata'] = params.no_data
-        warp = True
-        print(
-            f'-> Changing noData value from {self.noDataValue} to {params.no_data}')
-
-    if (warp):
-        tmpWarp = f'{TEMP_FOLDER}\\warpTmp.vrt'
-        file_ds = gdal.Warp(tmpWarp, file_ds, **kwargs)
+    file_ds = self.warpPlan.open('storageDEM')
 
     kwargs = {
         'format': 'GTiff',
@@ -53,19 +52,21 @@ def exportStorageDEM(self, file_ds):
             'TFW=NO',
             'TILED=YES',  # forces the creation of a tiled output GeoTiff with default parameters
             'PHOTOMETRIC=MINISBLACK',
-            'COMPRESS=DEFLATE',
+            *getCompressionOptions(params.storageDEM)
         ],
         'metadataOptions': self.extra_metadata,
         # to fix old error in Drone Deploy exports (https://gdal.org/programs/gdal_translate.html#cmdoption-gdal_translate-a_nodata)
         'noData': 'none' if self.hasAlphaChannel else params.no_data
     }
 
-    geotiff = gdal.Translate(gdaloutput, file_ds, **kwargs)
-
-    if params.storageDEM['overviews']:
-        addOverviews(geotiff)
+    # must open in Civil 3D
+    geotiff = exportGeotiff(gdaloutput, file_ds, kwargs, params.storageDEM, cog=False)
 
     if params.storageDEM['gdalinfo']:
-        exportGdalinfo(self, geotiff)
+        exportGdalinfo(self, geotiff, 'storageDEM')
+
+    # closed (and flushed) before the upload starts
+    geotiff = None
+    file_ds = None
 
-    return geotiff
+    self.addOutput('storageDEM', gdaloutput)
@@ -1,42 +1,50 @@
-from osgeo import gdal
-
-from helpers import addOverviews
+from helpers import exportGeotiff, getCompressionOptions
 import params as params
 from export_formats.gdalinfo import exportGdalinfo
 
-TEMP_FOLDER = params.tmp_folder
 
+def planStorageRGB(self, plan):
+    '''
+    Registers the grids used by the storage versions
+    '''
 
-def exportStorageRGB(self, file_ds):
+    srcNodata = 'none' if self.hasAlphaChannel else self.noDataValue
 
-    output_filename = f'{self.outputFilename}.tif'
+    dstNodata = None
 
-    gdaloutput = f'{self.outputFolder}/{output_filename}'
+    # change all tiff noData values to the same value
+    if (srcNodata != params.no_data and srcNodata != 'none'):
+        dstNodata = params.no_data
+        print(
+            f'-> Changing noData value from {self.noDataValue} to {params.no_data}')
 
-    print(f'-> Exporting {gdaloutput}')
+    plan.add(
+        'storageRGB',
+        xRes=max(params.storageRGB['gsd']/100, self.pixelSizeX) if params.storageRGB['gsd'] else self.pixelSizeX,
+        yRes=max(params.storageRGB['gsd']/100, self.pixelSizeY) if params.storageRGB['gsd'] else self.pixelSizeY,
+        srcNodata=srcNodata,
+        dstNodata=dstNodata
+    )
 
-    tmpWarp = None
+    if ((self.pixelSizeX + self.pixelSizeY) / 2) < params.storageRGB['gsd_sm_trigger']:
+        plan.add(
+            'storageRGB_sm',
+            xRes=params.storageRGB['gsd_sm'] / 100,
+            yRes=params.storageRGB['gsd_sm'] / 100,
+            srcNodata=srcNodata,
+            dstNodata=dstNodata
+        )
 
-    warp = False
 
-    kwargs = {
-        'xRes': max(params.storageRGB['gsd']/100, self.pixelSizeX) if params.storageRGB['gsd'] else self.pixelSizeX,
-        'yRes': max(params.storageRGB['gsd']/100, self.pixelSizeY) if params.storageRGB['gsd'] else self.pixelSizeY,
-        'multithread': True,
-        # force 'none' to fix old error in Drone Deploy exports (https://gdal.org/programs/gdal_translate.html#cmdoption-gdal_translate-a_nodata)
-        'srcNodata': 'none' if self.hasAlphaChannel else self.noDataValue
-    }
+def exportStorageRGB(self):
 
-    # change all tiff noData values to the same value
-    if (kwargs['srcNodata'] != params.no_data and kwargs['srcNodata'] != 'none'):
-        kwargs['dstNodata'] = params.no_data
-        warp = True
-        print(
-            f'-> Changing noData value from {self.noDataValue} to {params.no_data}')
+    output_filename = f'{self.outputFilename}.tif'
+
+    gdaloutput = f'{self.outputFolder}/{output_filename}'
 
-    if (warp):
-        tmpWarp = f'{TEMP_FOLDER}\\warpTmp.vrt'
-        file_ds = gdal.Warp(tmpWarp, file_ds, **kwargs)
+    print(f'-> Exporting {gdaloutput}')
+
+    file_ds = self.warpPlan.open('storageRGB')
 
     kwargs = {
         'format': 'GTiff',
@@ -44,12 +52,10 @@ def exportStorageRGB(self, file_ds):
         'xRes': max(params.storageRGB['gsd']/100, self.pixelSizeX) if params.storageRGB['gsd'] else self.pixelSizeX,
         'yRes': max(params.storageRGB['gsd']/100, self.pixelSizeY) if params.storageRGB['gsd'] else self.pixelSizeY,
         'creationOptions': [
-            'JPEG_QUALITY=80',
             'BIGTIFF=YES' if (((self.pixelSizeX + self.pixelSizeY) / 2) < params.storageRGB['gsd_sm_trigger']) else 'BIGTIFF=NO',
             'TFW=YES',
             'TILED=YES',
-            'PHOTOMETRIC=YCBCR',
-            'COMPRESS=JPEG',
+            *getCompressionOptions(params.storageRGB)
         ],
         'metadataOptions': self.extra_metadata,
         # to fix old error in Drone Deploy exports (https://gdal.org/programs/gdal_translate.html#cmdoption-gdal_translate-a_nodata)
@@ -57,15 +63,22 @@ def exportStorageRGB(self, file_ds):
         'maskBand': 4
     }
 
-    geotiff = gdal.Translate(gdaloutput, file_ds, **kwargs)
-  
-    if params.storageRGB['overviews']:
-        addOverviews(geotiff)
+    triggersSm = ((self.pixelSizeX + self.pixelSizeY) / 2) < params.storageRGB['gsd_sm_trigger']
+
+    # without the _sm version, this is the one that must open in Civil 3D
+    geotiff = exportGeotiff(gdaloutput, file_ds, kwargs, params.storageRGB, cog=triggersSm)
 
     if params.storageRGB['gdalinfo']:
-        exportGdalinfo(self, geotiff)
+        exportGdalinfo(self, geotiff, 'storageRGB')
 
-    if ((self.pixelSizeX + self.pixelSizeY) / 2) < params.storageRGB['gsd_sm_trigger']:
+    # closed (and flushed) before the upload starts
+    geotiff = None
+    file_ds = None
+
+    self.addOutput('storageRGB', gdaloutput)
+    self.addOutput('storageRGB', f'{self.outputFolder}/{self.outputFilename}.tfw')
+
+    if triggersSm:
         
         output_filename_sm = f'{self.outputFilename}_sm.tif'
         gdaloutput_sm = f'{self.outputFolder}/{output_filename_sm}'
@@ -75,21 +88,21 @@ def exportStorageRGB(self, file_ds):
         kwargs_sm = {
             **kwargs,
             'creationOptions': [
-                'JPEG_QUALITY=80',
                 'BIGTIFF=IF_NEEDED', # If YES, Civil 3d can't open it.
                 'TFW=YES',
                 'TILED=YES',
-                'PHOTOMETRIC=YCBCR',
-                'COMPRESS=JPEG',
+                *getCompressionOptions(params.storageRGB)
             ],
             'xRes': params.storageRGB['gsd_sm'] / 100,
             'yRes': params.storageRGB['gsd_sm'] / 100,
         }
 
-        geotiff_sm = gdal.Translate(gdaloutput_sm, file_ds, **kwargs_sm)
+        file_ds_sm = self.warpPlan.open('storageRGB_sm')
 
-        if params.storageRGB['overviews']:
-            addOverviews(geotiff_sm)
+        # the returned dataset isn't kept, so it's closed before the upload starts
+        exportGeotiff(gdaloutput_sm, file_ds_sm, kwargs_sm, params.storageRGB, cog=False)
 
+        file_ds_sm = None
 
-    return geotiff
+        self.addOutput('storageRGB', gdaloutput_sm)
+        self.addOutput('storageRGB', f'{self.outputFolder}/{self.outputFilename}_sm.tfw')
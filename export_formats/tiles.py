@@ -0,0 +1,373 @@
+import os
+import math
+import shutil
+import sqlite3
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from osgeo import gdal
+import numpy as np
+
+import params as params
+from export_formats.geoserverDEM import encodeTerrainRGB
+
+TILE_SIZE = 256
+
+# Half of the EPSG:3857 world width, in meters
+ORIGIN_SHIFT = 20037508.342789244
+
+EARTH_RADIUS = 6378137
+
+# Tiles sent to a renderer process at once
+BATCH_SIZE = 64
+
+EXTENSIONS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'WEBP': 'webp'
+}
+
+# State of each renderer process, set by _initRenderer
+_renderer = {}
+
+
+def getResolution(zoom):
+    '''
+    Meters per pixel of a zoom level, in EPSG:3857
+    '''
+    return 2 * ORIGIN_SHIFT / (TILE_SIZE * 2 ** zoom)
+
+
+def getTileBounds(zoom, x, y):
+    '''
+    (minx, miny, maxx, maxy) of a XYZ tile, in EPSG:3857
+    '''
+    size = 2 * ORIGIN_SHIFT / 2 ** zoom
+    minx = -ORIGIN_SHIFT + x * size
+    maxy = ORIGIN_SHIFT - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def getTiles(bounds, zoom):
+    '''
+    XYZ tiles of a zoom level that intersect the bounds
+    '''
+    minx, miny, maxx, maxy = bounds
+    size = 2 * ORIGIN_SHIFT / 2 ** zoom
+    last = 2 ** zoom - 1
+
+    xMin = max(0, int((minx + ORIGIN_SHIFT) // size))
+    xMax = min(last, math.ceil((maxx + ORIGIN_SHIFT) / size) - 1)
+    yMin = max(0, int((ORIGIN_SHIFT - maxy) // size))
+    yMax = min(last, math.ceil((ORIGIN_SHIFT - miny) / size) - 1)
+
+    return [(zoom, x, y) for y in range(yMin, yMax + 1) for x in range(xMin, xMax + 1)]
+
+
+def toLonLat(x, y):
+    lon = x / ORIGIN_SHIFT * 180
+    lat = math.degrees(2 * math.atan(math.exp(y / EARTH_RADIUS)) - math.pi / 2)
+    return lon, lat
+
+
+def getTilesParams(self):
+    return params.tilesDEM if self.isDEM else params.tilesRGB
+
+
+def planTiles(self, plan):
+    '''
+    Registers the EPSG:3857 grid at the resolution of the max zoom. The
+    zoom range is calculated here from the warped header (no pixels are read).
+    The grid is read by the renderer processes, so it's kept on disk
+    '''
+
+    productParams = getTilesParams(self)
+
+    header_ds = gdal.Warp('', plan.file_ds, format='VRT', dstSRS='EPSG:3857')
+    gt = header_ds.GetGeoTransform()
+
+    self.tilesBounds = (
+        gt[0],
+        gt[3] + gt[5] * header_ds.RasterYSize,
+        gt[0] + gt[1] * header_ds.RasterXSize,
+        gt[3]
+    )
+
+    header_ds = None
+
+    maxZoom = productParams['max_zoom']
+    if maxZoom is None:
+        # the closest to the file resolution
+        maxZoom = round(math.log2(2 * ORIGIN_SHIFT / (TILE_SIZE * gt[1])))
+
+    minZoom = productParams['min_zoom']
+    if minZoom is None:
+        # the whole file in about one tile
+        extent = max(self.tilesBounds[2] - self.tilesBounds[0], self.tilesBounds[3] - self.tilesBounds[1])
+        minZoom = math.floor(math.log2(2 * ORIGIN_SHIFT / extent))
+
+    self.tilesMaxZoom = max(0, maxZoom)
+    self.tilesMinZoom = max(0, min(minZoom, self.tilesMaxZoom))
+
+    print(f'-> Tiles from zoom {self.tilesMinZoom} to {self.tilesMaxZoom}')
+
+    # force 'none' to fix old error in Drone Deploy exports (https://gdal.org/programs/gdal_translate.html#cmdoption-gdal_translate-a_nodata)
+    srcNodata = 'none' if self.hasAlphaChannel else self.noDataValue
+
+    dstNodata = None
+
+    # same noData of the geoserver DEMs
+    if (self.isDEM and srcNodata != params.no_data and srcNodata != 'none'):
+        dstNodata = params.no_data
+
+    resolution = getResolution(self.tilesMaxZoom)
+
+    plan.add(
+        'tiles',
+        xRes=resolution,
+        yRes=resolution,
+        srcNodata=srcNodata,
+        dstNodata=dstNodata,
+        dstSRS='EPSG:3857',
+        materialize=True,
+        onDisk=True
+    )
+
+
+def exportTiles(self):
+    '''
+    Pre-rendered EPSG:3857 tile pyramid, in a MBTiles file or z/x/y folders.
+    RGB files are rendered as WEBP/JPEG, DEMs as lossless Terrain-RGB (PNG/WEBP).
+    Tiles are rendered by a pool of processes, the ones without valid
+    pixels (alpha / noData mask) are skipped
+    '''
+
+    productParams = getTilesParams(self)
+
+    product = 'tilesDEM' if self.isDEM else 'tilesRGB'
+
+    if (productParams['container'] == 'mbtiles'):
+        output = f'{productParams["output_folder"]}/{self.outputFilename}.mbtiles'
+        writer = MBTilesWriter(output)
+    else:
+        output = f'{productParams["output_folder"]}/{self.outputFilename}'
+        writer = XYZWriter(output, EXTENSIONS[productParams['format']])
+
+    print(f'-> Exporting tiles {output}')
+
+    path = self.warpPlan.getPath('tiles')
+
+    addOverviews(path, self.tilesMaxZoom - self.tilesMinZoom)
+
+    tiles = [tile for zoom in range(self.tilesMinZoom, self.tilesMaxZoom + 1)
+             for tile in getTiles(self.tilesBounds, zoom)]
+
+    batches = [tiles[i:i + BATCH_SIZE] for i in range(0, len(tiles), BATCH_SIZE)]
+
+    workers = productParams['workers'] or os.cpu_count()
+
+    # daemonic processes (ex: other pools) can't have children
+    if (multiprocessing.current_process().daemon):
+        workers = 1
+
+    # the renderers don't inherit the params overridden by the command line
+    initargs = (path, self.isDEM, productParams, params.no_data)
+
+    rendered = 0
+
+    if (workers > 1 and len(batches) > 1):
+        # not forked, the other stages of the file run GDAL in threads of this process
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_initRenderer, initargs=initargs) as executor:
+            for results in executor.map(_renderTiles, batches):
+                writer.write(results)
+                rendered += len(results)
+    else:
+        _initRenderer(*initargs)
+        for batch in batches:
+            results = _renderTiles(batch)
+            writer.write(results)
+            rendered += len(results)
+
+    lonLatBounds = toLonLat(*self.tilesBounds[:2]) + toLonLat(*self.tilesBounds[2:])
+
+    metadata = {
+        'name': self.outputFilename,
+        'format': EXTENSIONS[productParams['format']],
+        'type': 'overlay',
+        'version': '1.1',
+        'minzoom': self.tilesMinZoom,
+        'maxzoom': self.tilesMaxZoom,
+        'bounds': ','.join(str(round(value, 7)) for value in lonLatBounds),
+        'center': '{},{},{}'.format(
+            round((lonLatBounds[0] + lonLatBounds[2]) / 2, 7),
+            round((lonLatBounds[1] + lonLatBounds[3]) / 2, 7),
+            self.tilesMinZoom)
+    }
+
+    if (self.isDEM):
+        metadata['encoding'] = productParams['encoding']
+
+    writer.close(metadata)
+
+    print(f'--> {rendered} tiles rendered, {len(tiles) - rendered} empty tiles skipped')
+
+    self.addOutput(product, output)
+
+
+def addOverviews(path, levels):
+    '''
+    External overviews of the warped grid, so the lower zooms
+    don't read the full resolution
+    '''
+    if levels < 1:
+        return
+
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    ds.BuildOverviews('AVERAGE', [2 ** level for level in range(1, levels + 1)])
+    ds = None
+
+
+def _initRenderer(path, isDEM, productParams, noData):
+    # PIL is only imported by the processes that render tiles
+    from PIL import Image
+
+    gdal.UseExceptions()
+    _renderer['Image'] = Image
+    _renderer['ds'] = gdal.Open(path, gdal.GA_ReadOnly)
+    _renderer['isDEM'] = isDEM
+    _renderer['params'] = productParams
+    _renderer['noData'] = noData
+
+
+def _renderTiles(tiles):
+    '''
+    Render a batch of tiles, returns (zoom, x, y, bytes) of the non empty ones
+    '''
+    results = []
+
+    for zoom, x, y in tiles:
+        data = _renderTile(zoom, x, y)
+        if data:
+            results.append((zoom, x, y, data))
+
+    return results
+
+
+def _renderTile(zoom, x, y):
+    minx, miny, maxx, maxy = getTileBounds(zoom, x, y)
+
+    # partially outside the grid is filled as noData / alpha 0
+    tile_ds = gdal.Translate(
+        '',
+        _renderer['ds'],
+        **{
+            'format': 'MEM',
+            'projWin': [minx, maxy, maxx, miny],
+            'width': TILE_SIZE,
+            'height': TILE_SIZE,
+            'resampleAlg': 'average'
+        }
+    )
+
+    mask = tile_ds.GetRasterBand(1).GetMaskBand().ReadAsArray()
+
+    if not mask.any():
+        return None
+
+    productParams = _renderer['params']
+    Image = _renderer['Image']
+
+    buffer = BytesIO()
+
+    if (_renderer['isDEM']):
+        dem = tile_ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
+        dem[mask == 0] = _renderer['noData']
+
+        rgb = encodeTerrainRGB(dem, None, productParams['encoding'])
+
+        image = Image.fromarray(np.moveaxis(rgb, 0, -1), 'RGB')
+
+        if (productParams['format'] == 'WEBP'):
+            image.save(buffer, 'WEBP', lossless=True)
+        else:
+            image.save(buffer, 'PNG')
+
+    else:
+        rgb = np.dstack([tile_ds.GetRasterBand(i).ReadAsArray() for i in [1, 2, 3]])
+
+        if (productParams['format'] == 'WEBP'):
+            image = Image.fromarray(np.dstack([rgb, mask]), 'RGBA')
+            image.save(buffer, 'WEBP', quality=productParams['quality'])
+        else:
+            rgb[mask == 0] = 0
+            image = Image.fromarray(rgb, 'RGB')
+            image.save(buffer, 'JPEG', quality=productParams['quality'])
+
+    tile_ds = None
+
+    return buffer.getvalue()
+
+
+class MBTilesWriter:
+    '''
+    https://github.com/mapbox/mbtiles-spec/blob/master/1.3/spec.md
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.tmpPath = f'{path}.tmp'
+
+        if os.path.exists(self.tmpPath):
+            os.remove(self.tmpPath)
+
+        self.connection = sqlite3.connect(self.tmpPath)
+        self.connection.execute('PRAGMA synchronous=OFF')
+        self.connection.execute('PRAGMA journal_mode=OFF')
+        self.connection.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+        self.connection.execute(
+            'CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+
+    def write(self, tiles):
+        # MBTiles rows are counted from the bottom (TMS)
+        self.connection.executemany(
+            'INSERT INTO tiles VALUES (?, ?, ?, ?)',
+            [(zoom, x, 2 ** zoom - 1 - y, sqlite3.Binary(data)) for zoom, x, y, data in tiles])
+
+    def close(self, metadata):
+        self.connection.executemany(
+            'INSERT INTO metadata VALUES (?, ?)', [(name, str(value)) for name, value in metadata.items()])
+        self.connection.execute(
+            'CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+        self.connection.commit()
+        self.connection.close()
+
+        # replaced at the end, the previous version is served until then
+        os.replace(self.tmpPath, self.path)
+
+
+class XYZWriter:
+    '''
+    z/x/y.ext folders, for static hosting
+    '''
+
+    def __init__(self, folder, extension):
+        self.folder = folder
+        self.extension = extension
+
+        # tiles of a previous export could be left out now
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+
+    def write(self, tiles):
+        for zoom, x, y, data in tiles:
+            folder = f'{self.folder}/{zoom}/{x}'
+            os.makedirs(folder, exist_ok=True)
+            with open(f'{folder}/{y}.{self.extension}', 'wb') as file:
+                file.write(data)
+
+    def close(self, metadata):
+        pass
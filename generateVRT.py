@@ -1,29 +1,181 @@
 import os
+import json
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import gdal
 import params as params
+import helpers as h
+
+# Max size of the decimated mask read to find empty tiles
+MASK_SAMPLE_SIZE = 512
+
+
+def getTiles(folder):
+    '''
+    Tiles of a mosaic folder, including subfolders
+    '''
+    tiles = []
+    for path, dirs, files in os.walk(folder):
+        for file in files:
+            if(file.endswith(".tif")):
+                tiles.append(path + os.sep + file)
+    return sorted(tiles)
+
+
+def hasValidPixels(ds):
+    '''
+    True if any pixel of the tile is valid (alpha / noData mask)
+    '''
+    maskBand = ds.GetRasterBand(1).GetMaskBand()
+
+    if (ds.GetRasterBand(1).GetMaskFlags() & gdal.GMF_ALL_VALID):
+        return True
+
+    factor = max(1, max(ds.RasterXSize, ds.RasterYSize) / MASK_SAMPLE_SIZE)
+
+    # averaged as float, so a single valid pixel keeps the sample above 0
+    sample = maskBand.ReadAsArray(
+        buf_xsize=max(1, round(ds.RasterXSize / factor)),
+        buf_ysize=max(1, round(ds.RasterYSize / factor)),
+        buf_type=gdal.GDT_Float32,
+        resample_alg=gdal.GRIORA_Average)
+
+    return bool(sample.max() > 0)
+
+
+def scanTile(path):
+    '''
+    Header, footprint and valid data flag of a tile
+    '''
+    stat = os.stat(path)
+
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    gt = ds.GetGeoTransform()
+
+    tile = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'bands': ds.RasterCount,
+        'footprint': [
+            gt[0],
+            gt[3] + gt[5] * ds.RasterYSize,
+            gt[0] + gt[1] * ds.RasterXSize,
+            gt[3]
+        ],
+        'valid': hasValidPixels(ds) if params.mosaics['prune_empty_tiles'] else True
+    }
+
+    ds = None
+
+    return tile
+
+
+def getIndexSettings():
+    '''
+    Settings used to compute the valid data flags of the tiles
+    '''
+    return {
+        'prune_empty_tiles': params.mosaics['prune_empty_tiles'],
+        # the alpha / noData mask, averaged to this size
+        'valid_rule': f'mask_average_{MASK_SAMPLE_SIZE}'
+    }
+
+
+def loadIndex(path):
+    '''
+    Index of a mosaic folder, empty if it doesn't exist or
+    was built with other settings (all the tiles are scanned again)
+    '''
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            index = json.load(file)
+        if (index.get('settings') == getIndexSettings()):
+            return index
+        print(f'-> Mosaic settings changed, scanning the tiles of {os.path.basename(path)} again')
+    return {'tiles': {}}
+
+
+def saveIndex(index, path):
+    # write and rename, so an interrupted run doesn't leave a broken index
+    tmpPath = f'{path}.tmp'
+
+    with open(tmpPath, 'w') as file:
+        json.dump(index, file, indent=2)
+
+    os.replace(tmpPath, path)
 
 
 def generateVRT():
+    '''
+    Build a .vrt for each tiled mosaic folder of the input folder. The tiles
+    are indexed by folder (size, mtime, footprint and valid data flag), only
+    the changed tiles are scanned again, and the VRT is only rebuilt when
+    the index changes. Tiles without valid pixels are left out of the mosaic
+    '''
 
-    pathList = []
     root_path = params.input_folder
-    cont = os.listdir(root_path)
-    for i in cont:
-        finalpath = root_path + os.sep + i
-        for path, dirs, files in os.walk(finalpath):
-            filepath = params.tmp_folder + '\list.txt'
-            with open(filepath, "w") as l:
-                for file in files:
-                    if(file.endswith(".tif")):
-                        ok = path + os.sep + file
-                        l.write(ok + '\n')
-
-            with open(filepath, 'r') as f:
-                for line in f:
-                    pathList.append(line.split('\n')[0])
-
-            output = root_path + os.sep + i + '.vrt'
+
+    folders = [i for i in sorted(os.listdir(root_path)) if os.path.isdir(root_path + os.sep + i)]
+
+    if not folders:
+        return
+
+    h.createFolder(params.mosaics['index_folder'])
+
+    mosaics = {}
+    pending = []
+
+    for i in folders:
+        indexPath = f'{params.mosaics["index_folder"]}/{i}.json'
+        index = loadIndex(indexPath)
+
+        tiles = {}
+
+        for path in getTiles(root_path + os.sep + i):
+            stat = os.stat(path)
+            cached = index['tiles'].get(path)
+
+            if (cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime):
+                tiles[path] = cached
+            else:
+                pending.append((i, path))
+
+        mosaics[i] = {'indexPath': indexPath, 'index': index, 'tiles': tiles}
+
+    if pending:
+        print(f'-> Scanning {len(pending)} new or changed tiles')
+
+        # GDAL releases the GIL while reading, threads are enough here
+        with ThreadPoolExecutor(max_workers=params.mosaics['workers']) as executor:
+            scanned = executor.map(scanTile, [path for i, path in pending])
+
+            for (i, path), tile in zip(pending, scanned):
+                mosaics[i]['tiles'][path] = tile
+
+    for i, mosaic in mosaics.items():
+        output = root_path + os.sep + i + '.vrt'
+
+        tiles = dict(sorted(mosaic['tiles'].items()))
+
+        pathList = [path for path, tile in tiles.items() if tile['valid']]
+
+        if (tiles == mosaic['index']['tiles'] and mosaic['index'].get('output') == output
+                and (os.path.exists(output) or not pathList)):
+            print(f'-> Mosaic {output} is up to date')
+            continue
+
+        empty = len(tiles) - len(pathList)
+
+        if empty:
+            print(f'-> Leaving out {empty} empty tiles of {i}')
+
+        if not pathList:
+            print(f'WARNING: {i} has no tiles with valid pixels')
+            if os.path.exists(output):
+                os.remove(output)
+        else:
+            print(f'-> Building mosaic {output} with {len(pathList)} tiles')
+
             vrt_options = gdal.BuildVRTOptions(allowProjectionDifference=True)
             gdal.BuildVRT(output, pathList, options=vrt_options)
 
-            pathList.clear()
+        saveIndex({'version': 2, 'settings': getIndexSettings(), 'output': output, 'tiles': tiles}, mosaic['indexPath'])
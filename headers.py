@@ -0,0 +1,85 @@
+import os
+import json
+from osgeo import gdal
+
+import params as params
+import helpers as h
+
+
+def probeHeader(filepath):
+    '''
+    Properties of a file that can be read without reading pixels
+    '''
+    file_ds = gdal.Open(filepath, gdal.GA_ReadOnly)
+
+    gt = file_ds.GetGeoTransform()
+    lastBand = file_ds.GetRasterBand(file_ds.RasterCount)
+
+    try:
+        epsg = h.getEPSGCode(file_ds)
+    except (TypeError, ValueError):
+        # without an EPSG authority
+        epsg = None
+
+    date = h.getDateFromMetadata(file_ds)
+
+    header = {
+        'xSize': file_ds.RasterXSize,
+        'ySize': file_ds.RasterYSize,
+        'bands': file_ds.RasterCount,
+        'dataType': file_ds.GetRasterBand(1).DataType,
+        'geotransform': list(gt),
+        'pixelSizeX': gt[1],
+        'pixelSizeY': -gt[5],
+        'hasAlpha': lastBand.GetColorInterpretation() == gdal.GCI_AlphaBand,
+        'noData': lastBand.GetNoDataValue(),
+        'epsg': epsg,
+        'date': date.isoformat() if date else None
+    }
+
+    file_ds = None
+
+    return header
+
+
+class HeaderCache:
+    '''
+    Headers of the inputs, stored between runs and probed again
+    only when the size or mtime of a file changes
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or params.header_cache_file
+        self.files = {}
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                self.files = json.load(file)
+
+    def get(self, filepath):
+        stat = os.stat(filepath)
+        key = os.path.abspath(filepath)
+
+        cached = self.files.get(key)
+
+        if (cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime):
+            return cached['header']
+
+        header = probeHeader(filepath)
+
+        self.files[key] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'header': header
+        }
+
+        return header
+
+    def save(self):
+        # write and rename, so an interrupted run doesn't leave a broken cache
+        tmpPath = f'{self.path}.tmp'
+
+        with open(tmpPath, 'w') as file:
+            json.dump(self.files, file, indent=2)
+
+        os.replace(tmpPath, self.path)
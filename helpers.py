@@ -8,8 +8,7 @@ import math
 from osgeo import gdal, osr
 
 import params as params
-
-TEMP_FOLDER = params.tmp_folder
+from demStats import StreamingHistogram, DEMStats
 
 
 def createFolder(folderPath):
@@ -59,15 +58,243 @@ def cleanFilename(filename):
     return filename
 
 
-def addOverviews(gdal_dataset):
+def addOverviews(gdal_dataset, creationOptions=()):
     print('--> Adding overviews')
     '''
     Overviews are duplicate versions of your original data, but resampled to a lower resolution
     By default, overviews take the same compression type and transparency masks of the input dataset.
+    The compression options of the dataset (predictor, levels, quality, max error) are set for them too.
 
     This allow to speedup opening and viewing the files on QGis, Autocad, Geoserver, etc.
     '''
-    gdal_dataset.BuildOverviews("AVERAGE", params.overviews)
+    config = getOverviewConfig(creationOptions)
+
+    # the exports of a file run in several threads
+    for key, value in config.items():
+        gdal.SetThreadLocalConfigOption(key, value)
+
+    try:
+        gdal_dataset.BuildOverviews("AVERAGE", params.overviews)
+    finally:
+        for key in config:
+            gdal.SetThreadLocalConfigOption(key, None)
+
+
+# Creation options that have a <KEY>_OVERVIEW config option for the internal overviews
+OVERVIEW_OPTIONS = ['COMPRESS', 'PHOTOMETRIC', 'PREDICTOR', 'ZLEVEL', 'ZSTD_LEVEL',
+                    'JPEG_QUALITY', 'WEBP_LEVEL', 'WEBP_LOSSLESS', 'MAX_Z_ERROR']
+
+
+def getOverviewConfig(creationOptions):
+    '''
+    Config options to write the overviews with the compression of the dataset
+    '''
+    config = {}
+
+    for option in creationOptions:
+        key, value = option.split('=', 1)
+        if key in OVERVIEW_OPTIONS:
+            config[f'{key}_OVERVIEW'] = value
+
+    return config
+
+
+def isCodecAvailable(compress):
+    '''
+    True if the GTiff driver of this GDAL build can write the codec
+    '''
+    available = gdal.GetDriverByName('GTiff').GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    return f'<Value>{compress}</Value>' in available
+
+
+def getScratchCompressionOptions(dataType):
+    '''
+    Fast lossless compression of the intermediate grids: written once and read a few
+    times, so the fastest level is used. Predictor by type, floating point for the DEMs
+    '''
+    isFloat = dataType in (gdal.GDT_Float32, gdal.GDT_Float64)
+
+    options = [f'PREDICTOR={3 if isFloat else 2}']
+
+    if isCodecAvailable('ZSTD'):
+        return ['COMPRESS=ZSTD', 'ZSTD_LEVEL=1', *options]
+
+    return ['COMPRESS=DEFLATE', 'ZLEVEL=1', *options]
+
+
+def getCompressionOptions(productParams):
+    '''
+    Creation options of the compression profile of a product. Codecs that
+    are not in this GDAL build (ZSTD, WEBP, LERC are optional) fall back to DEFLATE
+    '''
+    name = productParams['compression']
+
+    if name not in params.compression_profiles:
+        raise RuntimeError(f'Unknown compression profile {name}')
+
+    options = list(params.compression_profiles[name])
+
+    compress = dict(option.split('=', 1) for option in options).get('COMPRESS')
+
+    if (compress and not isCodecAvailable(compress)):
+        print(f'WARNING: {compress} compression is not available in this GDAL build, using DEFLATE')
+        return ['COMPRESS=DEFLATE']
+
+    return options
+
+
+def getBlockWindows(band, maxPixels=4194304):
+    '''
+    Yields (xoff, yoff, xsize, ysize) windows aligned to the native blocks
+    of the band. Small blocks (like the strips of Pix4D exports) are grouped,
+    so each read has around `maxPixels` pixels
+    '''
+    blockX, blockY = band.GetBlockSize()
+
+    blocksPerWindow = max(1, maxPixels // (blockX * blockY))
+
+    # widen first, full rows are cheaper to read in strip layouts
+    colBlocks = min(math.ceil(band.XSize / blockX), blocksPerWindow)
+    rowBlocks = max(1, blocksPerWindow // colBlocks)
+
+    windowX = colBlocks * blockX
+    windowY = rowBlocks * blockY
+
+    for yoff in range(0, band.YSize, windowY):
+        for xoff in range(0, band.XSize, windowX):
+            yield xoff, yoff, min(windowX, band.XSize - xoff), min(windowY, band.YSize - yoff)
+
+
+def calculateValidArea(self, file_ds):
+    '''
+    Area in ha covered by valid pixels, using the mask band (alpha or noData).
+    The mask is read by blocks and counted with numpy. If params.area['gsd'] is set,
+    each block is read decimated to that resolution, otherwise at full resolution
+    '''
+
+    band = file_ds.GetRasterBand(1)
+
+    # no alpha nor noData, the entire geotiff area is valid
+    if (band.GetMaskFlags() & gdal.GMF_ALL_VALID):
+        self.pixel_num = file_ds.RasterXSize * file_ds.RasterYSize
+        return self.pixel_num * (self.pixel_area / 10000)
+
+    maskBand = band.GetMaskBand()
+
+    gsd = params.area['gsd']
+
+    factorX = max(1, (gsd / 100) / self.pixelSizeX) if gsd else 1
+    factorY = max(1, (gsd / 100) / self.pixelSizeY) if gsd else 1
+
+    pixel_num = 0
+
+    for xoff, yoff, xsize, ysize in getBlockWindows(maskBand):
+        bufX = max(1, round(xsize / factorX))
+        bufY = max(1, round(ysize / factorY))
+
+        array = maskBand.ReadAsArray(
+            xoff, yoff, xsize, ysize, buf_xsize=bufX, buf_ysize=bufY)
+
+        # each decimated pixel represents (xsize * ysize) / (bufX * bufY) original pixels
+        pixel_num += np.count_nonzero(array) * (xsize * ysize) / (bufX * bufY)
+
+    self.pixel_num = pixel_num
+
+    return self.pixel_num * (self.pixel_area / 10000)
+
+
+def isCOGAvailable():
+    # COG driver was added in GDAL 3.1
+    return gdal.GetDriverByName('COG') is not None
+
+
+# GTiff predictor values in the COG driver
+COG_PREDICTORS = {'1': 'NO', '2': 'STANDARD', '3': 'FLOATING_POINT'}
+
+
+def getCOGCreationOptions(creationOptions, overviews):
+    '''
+    Converts the GTiff creation options to the COG driver ones.
+    https://gdal.org/drivers/raster/cog.html
+    '''
+
+    cogOptions = []
+
+    for option in creationOptions:
+        key, value = option.split('=', 1)
+
+        # tiled by definition, and YCbCr is used automatically with JPEG
+        if key in ['TILED', 'PHOTOMETRIC', 'TFW', 'BLOCKXSIZE', 'BLOCKYSIZE']:
+            continue
+
+        if key in ['JPEG_QUALITY', 'WEBP_LEVEL']:
+            key = 'QUALITY'
+        elif key in ['ZLEVEL', 'ZSTD_LEVEL']:
+            key = 'LEVEL'
+        elif key == 'WEBP_LOSSLESS':
+            # lossless WEBP in the COG driver
+            key, value = 'QUALITY', '100'
+        elif key == 'PREDICTOR':
+            value = COG_PREDICTORS.get(value, value)
+
+        cogOptions.append(f'{key}={value}')
+
+    cogOptions.append('OVERVIEWS=IGNORE_EXISTING' if overviews else 'OVERVIEWS=NONE')
+    cogOptions.append('RESAMPLING=AVERAGE')
+
+    return cogOptions
+
+
+def writeWorldFile(ds, path):
+    '''
+    Same .tfw as the GTiff TFW=YES option (coordinates of the center of the first pixel)
+    '''
+    gt = ds.GetGeoTransform()
+
+    with open(path, 'w') as file:
+        file.write('\n'.join(f'{value:.10f}' for value in [
+            gt[1],
+            gt[4],
+            gt[2],
+            gt[5],
+            gt[0] + gt[1] / 2 + gt[2] / 2,
+            gt[3] + gt[4] / 2 + gt[5] / 2
+        ]) + '\n')
+
+
+def exportGeotiff(gdaloutput, file_ds, kwargs, productParams, cog=True):
+    '''
+    Translate to a tiled GTiff and append the overviews, or, if `cog` is enabled
+    for the product, write a Cloud Optimized GeoTIFF with overviews and mask in one pass.
+    Use `cog=False` for the outputs that must open in Civil 3D, they always use the GTiff layout.
+    '''
+
+    creationOptions = kwargs.get('creationOptions', [])
+
+    if (cog and productParams.get('cog') and isCOGAvailable()):
+        print('--> Using COG layout')
+        geotiff = gdal.Translate(
+            gdaloutput,
+            file_ds,
+            **{
+                **kwargs,
+                'format': 'COG',
+                'creationOptions': getCOGCreationOptions(creationOptions, productParams['overviews'])
+            }
+        )
+
+        # the COG driver doesn't write world files
+        if ('TFW=YES' in creationOptions):
+            writeWorldFile(geotiff, f'{removeExtension(gdaloutput)}.tfw')
+
+        return geotiff
+
+    geotiff = gdal.Translate(gdaloutput, file_ds, **kwargs)
+
+    if (productParams['overviews']):
+        addOverviews(geotiff, creationOptions)
+
+    return geotiff
 
 
 def createMapId():
@@ -87,35 +314,54 @@ def calculateDEMColorValues(self, geotiff):
 
     print('-> Evaluating DEM values:')
 
-    array = np.array(geotiff.GetRasterBand(1).ReadAsArray())
+    band = geotiff.GetRasterBand(1)
+
+    # the statistics of the quantities are computed in this same read
+    demStats = None
+
+    if (self.isEnabled('quantities') and params.demStats['enabled']):
+        gt = geotiff.GetGeoTransform()
+        demStats = DEMStats(abs(gt[1] * gt[5]), params.demStats['base_levels'], params.styleDEM['histogram_error'])
+
+    disregardNegatives = params.styleDEM['disregard_values_less_than_0']
 
-    array = np.array(array.flat)
+    # the values are streamed by blocks to a fine histogram, so memory
+    # doesn't depend on the raster size
+    if (demStats and not disregardNegatives):
+        # same values, one histogram is enough
+        histogram = demStats.histogram
+    else:
+        histogram = StreamingHistogram(params.styleDEM['histogram_error'])
+
+    for xoff, yoff, xsize, ysize in getBlockWindows(band):
+        array = band.ReadAsArray(xoff, yoff, xsize, ysize)
+
+        # Remove nan and noData values, they mess up the percentage calculation
+        valid = np.isfinite(array) & (array != params.no_data)
+
+        if (self.noDataValue != None):
+            valid &= array != self.noDataValue
 
-    # convert nan values no noData
-    array = np.nan_to_num(array, nan=params.no_data, copy=False)
+        if demStats:
+            demStats.update(array[valid])
 
-    array = np.ma.masked_equal(array, params.no_data, copy=False)
+        if disregardNegatives:
+            valid &= array >= 0
+            histogram.update(array[valid])
+        elif not demStats:
+            histogram.update(array[valid])
+
+    self.demHistogram = histogram
+    self.demStats = demStats
+
+    stats = histogram.getStats()
+    print(f'--> Min: {stats["min"]}, Max: {stats["max"]}, Mean: {stats["mean"]}, Count: {stats["count"]}')
 
-    # Remove NoDataValue, it doesn't mess up the percentage calculation
-    if (params.styleDEM['disregard_values_less_than_0']):
-        array = np.ma.masked_less(array, 0, False)
-        array = array.compressed()
-    
-    if (self.noDataValue != 'none'):
-        array = np.ma.masked_equal(array, self.noDataValue, copy=False)
-        array = array.compressed()
-    
     # similar to "Cumulative cut count" (Qgis)
-    trimmedMin = np.percentile(
-        array,
-        params.styleDEM['min_percentile']
-    )
+    trimmedMin = histogram.percentile(params.styleDEM['min_percentile'])
     print('--> Trimmed Min:', trimmedMin)
 
-    trimmedMax = np.percentile(
-        array,
-        params.styleDEM['max_percentile']
-    )
+    trimmedMax = histogram.percentile(params.styleDEM['max_percentile'])
     print('--> Trimmed Max:', trimmedMax)
 
     if (math.isnan(trimmedMax) or math.isnan(trimmedMin)):
@@ -138,29 +384,37 @@ def calculateDEMColorValues(self, geotiff):
     return colorValues
 
 
-def getLightVersion(self, file_ds):
+def planLightVersion(self, plan):
     '''
-    Creates a lightweight version to be used in some fast operations
+    Registers the lightweight version to be used in some fast operations
     like previews, mde stats, etc.
     '''
 
-    print('-> Generating lightweight version')
+    srcNodata = 'none' if self.hasAlphaChannel else self.noDataValue
 
-    # tmp file
-    tmpGeotiffCompressed = f'{params.tmp_folder}\\compressedLowRes.vrt'
-
-    geotiff = gdal.Warp(
-        tmpGeotiffCompressed,
-        file_ds,
-        **{
-            'multithread': True,
-            'xRes': max(0.3, self.pixelSizeX),
-            'yRes': max(0.3, self.pixelSizeY),
-            'dstNodata': 'none' if self.hasAlphaChannel else self.noDataValue
-        }
+    # DEM noData is normalized like in the storage export, so both can share the warp
+    dstNodata = params.no_data if (self.isDEM and srcNodata != 'none' and srcNodata != params.no_data) else None
+
+    plan.add(
+        'lightVersion',
+        xRes=max(0.3, self.pixelSizeX),
+        yRes=max(0.3, self.pixelSizeY),
+        srcNodata=srcNodata,
+        dstNodata=dstNodata,
+        # read by the stats, outline and previews
+        materialize=True
     )
 
-    return geotiff
+
+def getLightVersion(self):
+    '''
+    Lightweight version to be used in some fast operations
+    like previews, mde stats, etc.
+    '''
+
+    print('-> Generating lightweight version')
+
+    return self.warpPlan.open('lightVersion')
 
 
 def checkFileProcessed(self, isMDE, processed, file):
@@ -169,14 +423,12 @@ def checkFileProcessed(self, isMDE, processed, file):
     instead of generating a new one (process rgb and dem at the same time).
     '''
 
-    hasProcessed = False
     regid = file.split(params.dem_suffix)[
         0] if isMDE else removeExtension(file)
-    for i in processed:  # dictionary elements
-        if(regid in i):
-            hasProcessed = True  
-            self.mapId = processed.get(regid)  # take existing hash
-            break
-    if not hasProcessed:
+
+    # exact match, '1234' must not take the hash of '12345'
+    if(regid in processed):
+        self.mapId = processed[regid]  # take existing hash
+    else:
         # if it was never processed, I add it to the dict
         processed[regid] = self.mapId
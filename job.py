@@ -0,0 +1,423 @@
+import os
+import sys
+import math
+import types
+import fnmatch
+import time
+
+import params as params
+import helpers as h
+
+from warpPlan import WarpPlan
+from manifest import getEnabledProducts, getFingerprint
+from metrics import Metrics
+from tempStorage import TempStorage
+from stageGraph import StageGraph
+from tuning import Tuning
+from uploader import getUploader, isUploaded
+
+from export_formats.storageRGB import exportStorageRGB, planStorageRGB
+from export_formats.storageDEM import exportStorageDEM, planStorageDEM
+from export_formats.geoserverDEM import exportGeoserverDEM, planGeoserverDEM
+from export_formats.geoserverRGB import exportGeoserverRGB, planGeoserverRGB
+from export_formats.previews import exportStoragePreview
+from export_formats.quantities import exportQuantities
+from export_formats.outlines import exportOutline
+from export_formats.tiles import exportTiles, planTiles
+
+from osgeo import gdal
+
+
+def getParamValues():
+    '''
+    Current values of the params, with the ones overridden by the command line.
+    The workers started with spawn import params.py again and need them
+    '''
+    return {name: value for name, value in vars(params).items()
+            if not name.startswith('_') and not isinstance(value, types.ModuleType) and not callable(value)}
+
+
+def initWorker(paramValues=None):
+    '''
+    GDAL settings needed in every process that runs jobs, and
+    the params of the parent process if they are given
+    '''
+    for name, value in (paramValues or {}).items():
+        setattr(params, name, value)
+
+    # Allows GDAL to throw Python Exceptions
+    gdal.UseExceptions()
+
+    gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
+
+
+class Job:
+    '''
+    Holds the state of a single input file. This is the `self` that
+    the exporters receive, so each file can be processed independently
+    (and in a different process) from the others.
+    '''
+
+    def __init__(self, filepath, isDEM, processed):
+        self.filepath = filepath
+        self.file = os.path.basename(filepath)
+        self.isDEM = isDEM
+
+        file = self.file
+
+        filenameHasMapId = params.filename_prefix in file
+
+        if (self.isDEM):
+
+            # Generating output filename for DME case
+            self.mapId = h.removeExtension(file.split(
+                params.filename_prefix)[1].split(params.dem_suffix)[0]) if filenameHasMapId else h.createMapId()
+
+            if(not filenameHasMapId):
+                h.checkFileProcessed(
+                    self, True, processed, file)
+
+            self.registroid = file.split(
+                params.filename_prefix)[0] if filenameHasMapId else h.cleanFilename(h.removeExtension(file.split(params.dem_suffix)[0]))
+        else:
+
+            self.mapId = h.removeExtension(
+                file.split(params.filename_prefix)[1]) if filenameHasMapId else h.createMapId()
+
+            if(not filenameHasMapId):
+                h.checkFileProcessed(
+                    self, False, processed, file)
+
+            self.registroid = file.split(
+                "_")[0] if filenameHasMapId else h.cleanFilename(h.removeExtension(file))
+
+        output = f'{self.registroid}{params.filename_prefix}{self.mapId}'
+
+        self.outputFolder = f'{params.output_folder_storage}/{output}'
+
+        self.outputFilename = output if not self.isDEM else '{}{}'.format(
+            output, params.dem_suffix)
+
+        # Every job writes its intermediates in its own folder, so
+        # parallel jobs don't overwrite each other's files
+        self.temp = TempStorage(self.outputFilename)
+
+        # used to pair the RGB and DEM of the same registro
+        self.regid = file.split(params.dem_suffix)[0] if self.isDEM else h.removeExtension(file)
+
+        # products to export, the manifest can remove the ones already up to date
+        self.products = getEnabledProducts(self.isDEM)
+
+        # exported files by product
+        self.outputs = {}
+
+        # rows for the database, by table
+        self.records = {}
+
+        self.fingerprint = None
+
+        # size of the file, read from the header before processing
+        self.header = None
+
+        # set by the scheduler
+        self.cacheMax = None
+        self.warpMemory = None
+
+        # GDAL options for the layout of the file, set when it's loaded
+        self.tuning = None
+
+        self.metrics = Metrics(self)
+
+        self.area = None
+
+    def load(self, file_ds):
+        '''
+        Read the file properties used by the exporters
+        '''
+
+        # Number of bands
+        bands_count = file_ds.RasterCount
+
+        lastBand = file_ds.GetRasterBand(bands_count)
+        self.hasAlphaChannel = (
+            lastBand.GetColorInterpretation() == 6)  # https://github.com/rasterio/rasterio/issues/100
+        self.noDataValue = lastBand.GetNoDataValue()  # take any band
+
+        # Pix4DMatic injects an erroneous 'nan' value as noData attribute
+        if ((self.noDataValue != None) and (math.isnan(self.noDataValue))):
+            self.noDataValue = 0
+
+        # File GSD
+        gt = file_ds.GetGeoTransform()
+        self.pixelSizeX = gt[1]
+        self.pixelSizeY = -gt[5]
+
+        print(f'-> Pixel size: {self.pixelSizeX} x {self.pixelSizeY}')
+
+        self.pixel_area = self.pixelSizeX * abs(self.pixelSizeY)
+
+        # valid area, counted from the alpha/nodata mask
+        self.area = h.calculateValidArea(self, file_ds)
+
+        print('-> Area in ha:', self.area)
+
+        # file's GSD: get average x and y values
+        self.originalGsd = round(
+            (self.pixelSizeY + self.pixelSizeX) / 2 * 100, 2)  # cm
+
+        # File Projection
+        self.epsg = h.getEPSGCode(file_ds)
+
+        self.date = h.getDateFromMetadata(file_ds)
+
+        self.tuning = Tuning(self, file_ds)
+
+        # copy, so the registroId/mapId of one file don't leak into the next one
+        self.extra_metadata = list(params.metadata)
+
+        self.extra_metadata.append(
+            'registroId={}'.format(self.registroid))
+
+        self.extra_metadata.append(
+            'mapId={}'.format(self.mapId))
+
+    def isEnabled(self, product):
+        return product in self.products
+
+    def addOutput(self, product, path):
+        '''
+        Register a file exported for a product, the storage
+        files start uploading now if enabled
+        '''
+        self.outputs.setdefault(product, []).append(path)
+
+        self.metrics.addOutput(path)
+
+        if (isUploaded(path)):
+            getUploader().submit(path, self.file)
+
+    def addRecord(self, table, record):
+        '''
+        Register a row for the database, written by the batch at the end
+        '''
+        if (params.database['enabled']):
+            self.records.setdefault(table, []).append(record)
+
+    def hasTiles(self):
+        return self.isEnabled('tilesDEM') or self.isEnabled('tilesRGB')
+
+    def needsLightVersion(self):
+        return self.isEnabled('storageDEM') or self.isEnabled('previews') or self.isEnabled('quantities') or self.isEnabled('outlines')
+
+    def planWarps(self, file_ds):
+        '''
+        Collect the grids needed by the enabled exports, and warp
+        the source once per grid
+        '''
+
+        self.warpPlan = WarpPlan(self, file_ds)
+
+        if self.needsLightVersion():
+            h.planLightVersion(self, self.warpPlan)
+
+        if (self.isDEM):
+            if self.isEnabled('storageDEM'):
+                planStorageDEM(self, self.warpPlan)
+
+            if (self.isEnabled('geoserverDEM') or self.isEnabled('geoserverDEMRGB')):
+                planGeoserverDEM(self, self.warpPlan)
+        else:
+            if self.isEnabled('storageRGB'):
+                planStorageRGB(self, self.warpPlan)
+
+            if (self.isEnabled('geoserverRGB')):
+                planGeoserverRGB(self, self.warpPlan)
+
+        if (self.hasTiles()):
+            planTiles(self, self.warpPlan)
+
+        self.warpPlan.run()
+
+    def calculateColorValues(self):
+        if (params.styleDEM['full_resolution']):
+            geotiff = gdal.Open(self.filepath, gdal.GA_ReadOnly)
+        else:
+            geotiff = h.getLightVersion(self)
+
+        self.colorValues = h.calculateDEMColorValues(self, geotiff)
+
+        geotiff = None
+
+    def getStageGraph(self):
+        '''
+        Exports of the file and their dependencies. The warp plan already
+        wrote the lightweight version and the shared grids, so only the
+        DEM style values are a dependency. Each stage opens its own datasets
+        '''
+
+        graph = StageGraph(self.metrics, self.tuning.applyThreadOptions if self.tuning else None)
+
+        if (self.isDEM):
+            if self.isEnabled('storageDEM') or self.isEnabled('previews') or self.isEnabled('quantities'):
+                graph.add('colorValues', self.calculateColorValues)
+
+            if self.isEnabled('storageDEM'):
+                graph.add('storageDEM', lambda: exportStorageDEM(self))
+
+            if self.isEnabled('quantities'):
+                graph.add('quantities', lambda: exportQuantities(self), after=['colorValues'])
+
+        else:
+            if (self.isEnabled('outlines')):
+                graph.add('outlines', lambda: exportOutline(self, h.getLightVersion(self)))
+
+            if self.isEnabled('storageRGB'):
+                graph.add('storageRGB', lambda: exportStorageRGB(self))
+
+        if (self.isEnabled('previews')):
+            graph.add('previews', lambda: exportStoragePreview(self, h.getLightVersion(self)), after=['colorValues'])
+
+        if (self.isDEM):
+            if (self.isEnabled('geoserverDEM') or self.isEnabled('geoserverDEMRGB')):
+                graph.add('geoserverDEM', lambda: exportGeoserverDEM(self))
+        else:
+            if (self.isEnabled('geoserverRGB')):
+                graph.add('geoserverRGB', lambda: exportGeoserverRGB(self))
+
+        if (self.hasTiles()):
+            graph.add('tiles', lambda: exportTiles(self))
+
+        return graph
+
+    def runExports(self):
+
+        print('EXPORTING FILES')
+
+        self.getStageGraph().run(params.stage_workers)
+
+    def getSummary(self):
+        return {
+            'file': self.file,
+            'type': 'DEM' if self.isDEM else 'RGB',
+            'mapId': self.mapId,
+            'registroid': self.registroid,
+            'regid': self.regid,
+            'output': self.outputFilename,
+            'fingerprint': self.fingerprint,
+            'products': sorted(self.products),
+            'outputs': self.outputs,
+            'records': self.records,
+            'metrics': self.metrics.events,
+            'area': self.area,
+            'temp': None
+        }
+
+
+def processJob(job, waitUploads=False):
+    '''
+    Run the whole export chain for one file. Returns the summary of the job,
+    with `status` 'error' if GDAL failed, so a pool can keep processing
+    the other files. Use `waitUploads` in the pool workers, so the results
+    of the uploads are in the summary.
+    '''
+
+    print(f'--> PROCESSING FILE {job.file} <--')
+
+    start = time.time()
+
+    summary = job.getSummary()
+
+    if (job.cacheMax):
+        gdal.SetCacheMax(job.cacheMax)
+
+    try:
+        # Create parent folder for mapId
+        h.createFolder(job.outputFolder)
+
+        file_ds = gdal.Open(job.filepath, gdal.GA_ReadOnly)
+
+        print(f'-> File {job.file} is {"DEM" if job.isDEM else "RGB"} type')
+
+        print(
+            f'-> Files for {job.outputFilename} will be exported')
+
+        with job.metrics.stage('load'):
+            job.load(file_ds)
+
+        with job.metrics.stage('warpPlan'):
+            job.planWarps(file_ds)
+
+        job.runExports()
+
+        # Once we're done, close properly the dataset
+        file_ds = None
+
+        summary['status'] = 'ok'
+
+    except RuntimeError as e:
+        print(f'ERROR: Unable to process {job.filepath}')
+        print(e)
+        summary['status'] = 'error'
+        summary['error'] = str(e)
+
+    finally:
+        file_ds = None
+        summary['temp'] = job.temp.getReport()
+        job.temp.cleanup()
+
+    summary['area'] = job.area
+    summary['elapsed'] = round(time.time() - start, 2)
+
+    if (waitUploads and getUploader()):
+        summary['uploads'] = getUploader().collect(job.file).get(job.file, [])
+
+    return summary
+
+
+def isSelected(file):
+    return params.only_files is None or any(fnmatch.fnmatch(file, pattern) for pattern in params.only_files)
+
+
+def findJobs(manifest, headers, processed=None, failed=None):
+    '''
+    One job for each file of the input folder, with the mapIds of
+    the previous runs and the products pending since them. Only the
+    headers are read, from the cache when the file didn't change.
+    `processed` adds mapIds by registro to the ones of the manifest.
+    The batch exits if a header can't be read, unless a `failed` list is
+    given: then the file is skipped and its error result appended to it
+    '''
+
+    # reuse the mapIds of the previous runs
+    processed = {**manifest.getMapIds(), **(processed or {})}
+
+    jobs = []
+
+    for subdir, dirs, files in os.walk(params.input_folder):
+        is_subdir = subdir != params.input_folder
+        if(is_subdir):
+            continue
+
+        for file in sorted(files):
+            filepath = subdir + os.sep + file
+            if (h.getExtension(file) in params.extensions and isSelected(file)):
+                try:
+                    header = headers.get(filepath)
+                except RuntimeError as e:
+                    print(f'ERROR: Unable to process {filepath}')
+                    print(e)
+                    if failed is None:
+                        sys.exit(1)
+                    failed.append({'file': file, 'output': None, 'status': 'error', 'error': str(e)})
+                    continue
+
+                job = Job(filepath, header['bands'] <= 2, processed)
+                job.header = header
+                job.fingerprint = getFingerprint(filepath)
+
+                if (params.incremental):
+                    job.products = manifest.getPendingProducts(job)
+
+                jobs.append(job)
+
+    return jobs
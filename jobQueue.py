@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+from contextlib import contextmanager
+
+import params as params
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Kinds of entries of the queue
+KINDS = ['jobs', 'mapids', 'locks']
+
+
+def getQueue():
+    '''
+    Queue shared by the workers of all the nodes
+    '''
+    if (params.queue['backend'] == 'redis'):
+        if not redis:
+            sys.exit('ERROR: redis module was not found, it is needed to use the Redis queue')
+        return RedisQueue(params.queue['redis_url'], params.queue['redis_prefix'])
+
+    return SQLiteQueue(params.queue['sqlite_file'])
+
+
+def getWorkerId():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class JobQueue:
+    '''
+    Lease based queue of jobs. A worker claims a job for `lease` seconds and renews
+    the lease with heartbeats while processing it. The jobs of workers that stop
+    sending heartbeats are claimed again by others, up to `max_attempts`.
+    The mapIds are assigned once by registro, so the RGB and DEM of the same
+    registro get the same one even if they are found in different scans.
+
+    The backends only implement `_atomic(fn)`: `fn` receives the state as
+    {kind: {key: value}} and modifies it, and the changes are saved in one transaction
+    '''
+
+    def assignMapId(self, regid, mapId):
+        '''
+        Stored mapId of the registro, `mapId` if it's the first one
+        '''
+        def assign(state):
+            return state['mapids'].setdefault(regid, mapId)
+
+        return self._atomic(assign)
+
+    def getMapIds(self):
+        return self._atomic(lambda state: dict(state['mapids']))
+
+    def enqueue(self, file, job):
+        '''
+        Add a job, unless the file is already queued or running.
+        Returns False if it was skipped
+        '''
+        def add(state):
+            entry = state['jobs'].get(file)
+
+            if (entry and entry['status'] == 'running'):
+                return False
+
+            state['jobs'][file] = {
+                'job': job,
+                'status': 'pending',
+                'worker': None,
+                'lease_until': None,
+                'attempts': 0,
+                'result': None,
+                'updated': time.time()
+            }
+
+            return True
+
+        return self._atomic(add)
+
+    def claim(self, worker, lease):
+        '''
+        (file, job) of the next pending job or of an expired lease, None if there are none.
+        The expired jobs that reached max_attempts are marked as errors
+        '''
+        def claimNext(state):
+            now = time.time()
+
+            for file, entry in sorted(state['jobs'].items()):
+                expired = entry['status'] == 'running' and entry['lease_until'] < now
+
+                if (expired and entry['attempts'] >= params.queue['max_attempts']):
+                    print(f'WARNING: {file} was abandoned by {entry["worker"]} {entry["attempts"]} times')
+                    entry['status'] = 'error'
+                    entry['result'] = {'file': file, 'output': None, 'status': 'error', 'error': 'lease expired'}
+                    entry['updated'] = now
+                    continue
+
+                if (entry['status'] == 'pending' or expired):
+                    if expired:
+                        print(f'-> Reclaiming {file} from {entry["worker"]}')
+                    entry['status'] = 'running'
+                    entry['worker'] = worker
+                    entry['lease_until'] = now + lease
+                    entry['attempts'] += 1
+                    entry['updated'] = now
+                    return file, entry['job']
+
+            return None
+
+        return self._atomic(claimNext)
+
+    def heartbeat(self, file, worker, lease):
+        '''
+        Renew the lease, False if the job was claimed by another worker
+        '''
+        def renew(state):
+            entry = state['jobs'].get(file)
+            if (not entry or entry['status'] != 'running' or entry['worker'] != worker):
+                return False
+            entry['lease_until'] = time.time() + lease
+            return True
+
+        return self._atomic(renew)
+
+    def complete(self, file, worker, result):
+        '''
+        Store the result of a job, False if the lease was lost meanwhile
+        '''
+        def store(state):
+            entry = state['jobs'].get(file)
+            if (not entry or entry['status'] != 'running' or entry['worker'] != worker):
+                return False
+            entry['status'] = 'done' if result['status'] == 'ok' else 'error'
+            entry['result'] = result
+            entry['lease_until'] = None
+            entry['updated'] = time.time()
+            return True
+
+        return self._atomic(store)
+
+    def getCounts(self):
+        def count(state):
+            counts = {}
+            for entry in state['jobs'].values():
+                counts[entry['status']] = counts.get(entry['status'], 0) + 1
+            return counts
+
+        return self._atomic(count)
+
+    def getResults(self):
+        return self._atomic(lambda state: [entry['result'] for file, entry in sorted(state['jobs'].items())
+                                           if entry['result']])
+
+    @contextmanager
+    def lock(self, name, owner, ttl=600):
+        '''
+        Lock shared by all the nodes, for the files written by every worker
+        (manifest, metrics, database). Expires after `ttl` if the owner dies
+        '''
+        def acquire(state):
+            entry = state['locks'].get(name)
+            if (entry and entry['owner'] != owner and entry['lease_until'] > time.time()):
+                return False
+            state['locks'][name] = {'owner': owner, 'lease_until': time.time() + ttl}
+            return True
+
+        def release(state):
+            if (state['locks'].get(name, {}).get('owner') == owner):
+                del state['locks'][name]
+
+        while not self._atomic(acquire):
+            time.sleep(0.2)
+
+        try:
+            yield
+        finally:
+            self._atomic(release)
+
+
+class SQLiteQueue(JobQueue):
+    '''
+    Queue in a SQLite file of the shared output folder. Uses the rollback
+    journal (WAL doesn't work over NFS), so the locks of the filesystem must work
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+        db = self._connect()
+        try:
+            db.execute('CREATE TABLE IF NOT EXISTS entries (kind TEXT, key TEXT, value TEXT, PRIMARY KEY (kind, key))')
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.execute('PRAGMA journal_mode=DELETE')
+        return db
+
+    def _atomic(self, fn):
+        db = self._connect()
+
+        try:
+            # write lock from the start, the read and the update are one step
+            db.execute('BEGIN IMMEDIATE')
+
+            rows = db.execute('SELECT kind, key, value FROM entries').fetchall()
+
+            state = {kind: {} for kind in KINDS}
+            for kind, key, value in rows:
+                state[kind][key] = json.loads(value)
+
+            stored = {(kind, key): value for kind, key, value in rows}
+
+            result = fn(state)
+
+            current = {(kind, key): json.dumps(value, default=str) for kind in KINDS for key, value in state[kind].items()}
+
+            for (kind, key), value in current.items():
+                if (stored.get((kind, key)) != value):
+                    db.execute('INSERT OR REPLACE INTO entries (kind, key, value) VALUES (?, ?, ?)', (kind, key, value))
+
+            for kind, key in stored.keys() - current.keys():
+                db.execute('DELETE FROM entries WHERE kind = ? AND key = ?', (kind, key))
+
+            db.execute('COMMIT')
+
+            return result
+
+        except BaseException:
+            if db.in_transaction:
+                db.execute('ROLLBACK')
+            raise
+
+        finally:
+            db.close()
+
+
+class RedisQueue(JobQueue):
+    '''
+    Queue in a Redis server, one hash by kind. The updates are optimistic
+    transactions, retried if another worker changed the queue meanwhile
+    '''
+
+    def __init__(self, url, prefix):
+        self.client = redis.Redis.from_url(url)
+        self.keys = {kind: f'{prefix}:{kind}' for kind in KINDS}
+
+    def _atomic(self, fn):
+        result = {}
+
+        def update(pipe):
+            stored = {kind: pipe.hgetall(key) for kind, key in self.keys.items()}
+
+            state = {kind: {key.decode(): json.loads(value) for key, value in values.items()}
+                     for kind, values in stored.items()}
+
+            result['value'] = fn(state)
+
+            pipe.multi()
+
+            for kind, key in self.keys.items():
+                current = {field: json.dumps(value, default=str) for field, value in state[kind].items()}
+                previous = {field.decode(): value.decode() for field, value in stored[kind].items()}
+
+                changed = {field: value for field, value in current.items() if previous.get(field) != value}
+                removed = previous.keys() - current.keys()
+
+                if changed:
+                    pipe.hset(key, mapping=changed)
+                if removed:
+                    pipe.hdel(key, *removed)
+
+        self.client.transaction(update, *self.keys.values())
+
+        return result['value']
@@ -0,0 +1,183 @@
+import os
+import json
+import hashlib
+from osgeo import gdal
+
+import params as params
+
+# Size of each block read to fingerprint the inputs
+SAMPLE_SIZE = 65536
+SAMPLE_COUNT = 8
+
+PRODUCTS_RGB = ['storageRGB', 'outlines', 'previews', 'geoserverRGB', 'tilesRGB']
+PRODUCTS_DEM = ['storageDEM', 'quantities', 'previews', 'geoserverDEM', 'geoserverDEMRGB', 'tilesDEM']
+
+
+def getEnabledProducts(isDEM):
+    '''
+    Products enabled in params for a file type
+    '''
+    enabled = {
+        'storageRGB': params.storageRGB['enabled'],
+        'outlines': params.outlines['enabled'],
+        'previews': params.previews['enabled'],
+        'geoserverRGB': params.geoserverRGB['enabled'],
+        'storageDEM': params.storageDEM['enabled'],
+        'quantities': params.storageDEM['quantities'],
+        'geoserverDEM': params.geoserverDEM['enabled'],
+        'geoserverDEMRGB': params.geoserverDEMRGB['enabled'],
+        'tilesRGB': params.tilesRGB['enabled'],
+        'tilesDEM': params.tilesDEM['enabled']
+    }
+
+    return {product for product in (PRODUCTS_DEM if isDEM else PRODUCTS_RGB)
+            if enabled[product] and (params.only_products is None or product in params.only_products)}
+
+
+def getProductParams(product):
+    '''
+    Params that change the result of a product. If any of them changes
+    between runs, the product is exported again
+    '''
+
+    common = {
+        'no_data': params.no_data,
+        'overviews': params.overviews,
+        'metadata': params.metadata,
+        'area': params.area
+    }
+
+    specific = {
+        'storageRGB': {'storageRGB': params.storageRGB},
+        'storageDEM': {'storageDEM': params.storageDEM},
+        'quantities': {'styleDEM': params.styleDEM, 'demStats': params.demStats},
+        'previews': {'previews': params.previews, 'styleDEM': params.styleDEM},
+        'outlines': {'outlines': params.outlines},
+        'geoserverRGB': {'geoserverRGB': params.geoserverRGB, 'geoserver_epsg': params.geoserver_epsg},
+        'geoserverDEM': {'geoserverDEM': params.geoserverDEM, 'geoserver_epsg': params.geoserver_epsg},
+        'geoserverDEMRGB': {'geoserverDEMRGB': params.geoserverDEMRGB, 'geoserver_epsg': params.geoserver_epsg},
+        'tilesRGB': {'tilesRGB': params.tilesRGB},
+        'tilesDEM': {'tilesDEM': params.tilesDEM}
+    }
+
+    productParams = {**common, **specific[product]}
+
+    # the options of the profile, so editing a profile exports its products again
+    compression = getattr(params, product, {}).get('compression')
+    if compression:
+        productParams['compression_options'] = params.compression_profiles.get(compression)
+
+    # normalized, so it can be compared with the values stored in the json
+    return json.loads(json.dumps(productParams, sort_keys=True, default=str))
+
+
+def getFingerprint(filepath):
+    '''
+    Fast fingerprint of an input: size, mtime and a hash of some blocks
+    spread over the file. VRT mosaics are regenerated on each run, so
+    their hash includes the size and mtime of the tiles instead of the VRT mtime
+    '''
+
+    stat = os.stat(filepath)
+
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(filepath, 'rb') as file:
+        step = max(SAMPLE_SIZE, stat.st_size // SAMPLE_COUNT)
+        for offset in range(0, stat.st_size, step):
+            file.seek(offset)
+            digest.update(file.read(SAMPLE_SIZE))
+
+    fingerprint = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime
+    }
+
+    if filepath.lower().endswith('.vrt'):
+        del fingerprint['mtime']
+        vrt_ds = gdal.Open(filepath, gdal.GA_ReadOnly)
+        for tile in sorted(vrt_ds.GetFileList()[1:]):
+            tileStat = os.stat(tile)
+            digest.update(f'{tile}:{tileStat.st_size}:{tileStat.st_mtime}'.encode())
+        vrt_ds = None
+
+    fingerprint['hash'] = digest.hexdigest()
+
+    return fingerprint
+
+
+class Manifest:
+    '''
+    Record of the processed inputs, stored next to the outputs. For each input keeps
+    its fingerprint, mapId, and the params and outputs of each product,
+    so the next runs only export what changed.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or params.manifest_file
+        self.files = {}
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as file:
+                self.files = json.load(file).get('files', {})
+
+    def getMapIds(self):
+        '''
+        Stored mapIds by registro, used to keep the same hash between runs
+        '''
+        return {entry['regid']: entry['mapId'] for entry in self.files.values()}
+
+    def getPendingProducts(self, job):
+        '''
+        Products of the job that must be exported again: new file, changed
+        file, changed params, different mapId or missing outputs
+        '''
+
+        entry = self.files.get(job.file)
+
+        if (not entry or entry['fingerprint'] != job.fingerprint or entry['mapId'] != job.mapId):
+            return set(job.products)
+
+        pending = set()
+
+        for product in job.products:
+            stored = entry['products'].get(product)
+
+            if (not stored
+                    or stored['params'] != getProductParams(product)
+                    or not all(os.path.exists(path) for path in stored['outputs'])):
+                pending.add(product)
+
+        return pending
+
+    def update(self, result):
+        '''
+        Store the result of a finished job
+        '''
+
+        entry = self.files.get(result['file'])
+
+        if (not entry or entry['fingerprint'] != result['fingerprint'] or entry['mapId'] != result['mapId']):
+            entry = {
+                'fingerprint': result['fingerprint'],
+                'mapId': result['mapId'],
+                'regid': result['regid'],
+                'output': result['output'],
+                'products': {}
+            }
+            self.files[result['file']] = entry
+
+        for product in result['products']:
+            entry['products'][product] = {
+                'params': getProductParams(product),
+                'outputs': result['outputs'].get(product, [])
+            }
+
+    def save(self):
+        # write and rename, so an interrupted run doesn't leave a broken manifest
+        tmpPath = f'{self.path}.tmp'
+
+        with open(tmpPath, 'w') as file:
+            json.dump({'version': 1, 'files': self.files}, file, indent=2)
+
+        os.replace(tmpPath, self.path)
@@ -0,0 +1,240 @@
+import os
+import sys
+import time
+import json
+import threading
+from contextlib import contextmanager
+from osgeo import gdal
+
+import params as params
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def getPeakRss():
+    '''
+    Peak resident memory of the process in bytes, None if it can't be read
+    '''
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # KB in Linux, bytes in macOS
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if psutil:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    return None
+
+
+def getIoCounters():
+    '''
+    (read, written) bytes by the process, including the reads served
+    from the page cache. None if they can't be read
+    '''
+    try:
+        with open('/proc/self/io') as file:
+            counters = dict(line.split(': ') for line in file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        pass
+    if psutil:
+        try:
+            counters = psutil.Process().io_counters()
+            return counters.read_bytes, counters.write_bytes
+        except (AttributeError, psutil.Error):
+            pass
+    return None
+
+
+def getFileSize(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class Metrics:
+    '''
+    Per stage metrics of a job: wall and CPU time, peak RSS, GDAL cache
+    usage, bytes read by the process, bytes of the files exported in the stage
+    and intermediates left at its end. CPU time and bytes read are counted
+    for the whole process, so they overlap when stages run at the same time
+    '''
+
+    def __init__(self, job):
+        self.job = job
+        self.events = []
+        # outputs of the stage running in each thread
+        self.local = threading.local()
+
+    def __getstate__(self):
+        # sent to the pool workers before any stage runs
+        return {'job': self.job, 'events': self.events}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.local = threading.local()
+
+    def addOutput(self, path):
+        outputs = getattr(self.local, 'outputs', None)
+        if outputs is not None:
+            outputs.append(path)
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        startCpu = time.process_time()
+        startIo = getIoCounters()
+        self.local.outputs = []
+
+        status = 'ok'
+
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            endIo = getIoCounters()
+            temp = self.job.temp.getUsage()
+            newOutputs = set(self.local.outputs)
+            self.local.outputs = None
+
+            self.events.append({
+                'event': 'stage',
+                'time': time.time(),
+                'file': self.job.file,
+                'mapId': self.job.mapId,
+                'type': 'DEM' if self.job.isDEM else 'RGB',
+                'stage': name,
+                # used by the planner to fit the cost of each stage
+                'pixels': self.job.header['xSize'] * self.job.header['ySize'] if self.job.header else None,
+                'status': status,
+                'wall_seconds': round(time.perf_counter() - start, 4),
+                'cpu_seconds': round(time.process_time() - startCpu, 4),
+                'peak_rss_bytes': getPeakRss(),
+                'gdal_cache_used_bytes': gdal.GetCacheUsed(),
+                'gdal_cache_max_bytes': gdal.GetCacheMax(),
+                'read_bytes': endIo[0] - startIo[0] if startIo and endIo else None,
+                'written_bytes': endIo[1] - startIo[1] if startIo and endIo else None,
+                'output_bytes': sum(getFileSize(path) for path in newOutputs),
+                'temp_memory_bytes': temp['memory_bytes'],
+                'temp_disk_bytes': temp['disk_bytes']
+            })
+
+
+def appendEvents(events, path=None):
+    '''
+    Append the events as JSON lines
+    '''
+    path = path or params.metrics['jsonl_file']
+
+    with open(path, 'a') as file:
+        for event in events:
+            file.write(json.dumps(event, default=str) + '\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def writePrometheus(summary, elapsed, path=None):
+    '''
+    Export the batch metrics for the node_exporter textfile collector.
+    https://github.com/prometheus/node_exporter#textfile-collector
+    '''
+
+    path = path or params.metrics['prometheus_file']
+
+    stageSeconds = {}
+    stageCpu = {}
+    stageOutput = {}
+    peakRss = 0
+    peakTemp = {'memory': 0, 'disk': 0}
+
+    for result in summary:
+        for event in result.get('metrics', []):
+            if (event['event'] != 'stage'):
+                continue
+            key = (event['stage'], event['type'])
+            stageSeconds[key] = stageSeconds.get(key, 0) + event['wall_seconds']
+            stageCpu[key] = stageCpu.get(key, 0) + event['cpu_seconds']
+            stageOutput[key] = stageOutput.get(key, 0) + event['output_bytes']
+            peakRss = max(peakRss, event['peak_rss_bytes'] or 0)
+
+    for result in summary:
+        temp = result.get('temp') or {}
+        peakTemp['memory'] = max(peakTemp['memory'], temp.get('peak_memory_bytes', 0))
+        peakTemp['disk'] = max(peakTemp['disk'], temp.get('peak_disk_bytes', 0))
+
+    statuses = {}
+    for result in summary:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+
+    processed = [result for result in summary if result['status'] == 'ok']
+
+    lines = [
+        '# HELP geotiff_processor_batch_seconds Wall time of the last batch.',
+        '# TYPE geotiff_processor_batch_seconds gauge',
+        f'geotiff_processor_batch_seconds {elapsed}',
+        '# HELP geotiff_processor_last_run_timestamp_seconds End time of the last batch.',
+        '# TYPE geotiff_processor_last_run_timestamp_seconds gauge',
+        f'geotiff_processor_last_run_timestamp_seconds {time.time()}',
+        '# HELP geotiff_processor_files Files of the last batch by status.',
+        '# TYPE geotiff_processor_files gauge'
+    ]
+
+    lines += [f'geotiff_processor_files{_labels(status=status)} {count}' for status, count in statuses.items()]
+
+    lines += [
+        '# HELP geotiff_processor_area_hectares Valid area processed in the last batch.',
+        '# TYPE geotiff_processor_area_hectares gauge',
+        f'geotiff_processor_area_hectares {sum(result["area"] or 0 for result in processed)}',
+        '# HELP geotiff_processor_input_bytes Size of the files processed in the last batch.',
+        '# TYPE geotiff_processor_input_bytes gauge',
+        f'geotiff_processor_input_bytes {sum((result["fingerprint"] or {}).get("size", 0) for result in processed)}',
+        '# HELP geotiff_processor_peak_rss_bytes Highest peak RSS of the jobs of the last batch.',
+        '# TYPE geotiff_processor_peak_rss_bytes gauge',
+        f'geotiff_processor_peak_rss_bytes {peakRss}',
+        '# HELP geotiff_processor_temp_peak_bytes Highest intermediate files usage of the jobs of the last batch.',
+        '# TYPE geotiff_processor_temp_peak_bytes gauge'
+    ]
+
+    lines += [f'geotiff_processor_temp_peak_bytes{_labels(storage=storage)} {value}' for storage, value in peakTemp.items()]
+
+    lines += [
+        '# HELP geotiff_processor_stage_seconds Wall time by stage in the last batch.',
+        '# TYPE geotiff_processor_stage_seconds gauge'
+    ]
+
+    lines += [f'geotiff_processor_stage_seconds{_labels(stage=stage, type=type)} {value}' for (stage, type), value in stageSeconds.items()]
+
+    lines += [
+        '# HELP geotiff_processor_stage_cpu_seconds CPU time by stage in the last batch.',
+        '# TYPE geotiff_processor_stage_cpu_seconds gauge'
+    ]
+
+    lines += [f'geotiff_processor_stage_cpu_seconds{_labels(stage=stage, type=type)} {value}' for (stage, type), value in stageCpu.items()]
+
+    lines += [
+        '# HELP geotiff_processor_stage_output_bytes Bytes exported by stage in the last batch.',
+        '# TYPE geotiff_processor_stage_output_bytes gauge'
+    ]
+
+    lines += [f'geotiff_processor_stage_output_bytes{_labels(stage=stage, type=type)} {value}' for (stage, type), value in stageOutput.items()]
+
+    # write and rename, so the collector never reads a half written file
+    tmpPath = f'{path}.{os.getpid()}.tmp'
+
+    with open(tmpPath, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+    os.replace(tmpPath, path)
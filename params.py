@@ -12,15 +12,72 @@ output_folder_database_jsondata = f'{output_folder_database}/jsondata'
 output_folder_database_mdevalues = f'{output_folder_database}/mdevalues'
 output_folder_database_outlines = f'{output_folder_database}/outlines'
 output_folder_geoserver = f'{output_folder}/geoserver'
+output_folder_tiles = f'{output_folder}/tiles'
 
 filename_prefix = '_MapId-'
 dem_suffix = '_mde'
 outline_suffix = '_outline'
 gdalinfo_suffix = '_gdalinfo'
 preview_suffix = '_preview'
+stats_suffix = '_stats'
 
 # To clean the output folder before starting
-clean_output_folder = True
+clean_output_folder = False
+
+# Only export the files and products that changed since the last run (file content, params
+# or missing outputs). The manifest of the processed files is saved in the output folder
+incremental = True
+manifest_file = f'{output_folder}/manifest.json'
+
+# Headers of the inputs (size, bands, noData, EPSG, date...), only probed again when a file changes
+header_cache_file = f'{output_folder}/headers.json'
+
+# Process only some products (ex: ['geoserverRGB']) or input files (filename patterns, ex: ['1234*.tif']).
+# None for all of them. Usually set with the command line (cli.py)
+only_products = None
+only_files = None
+
+# Batches shared by several nodes with the same input and output folders (python cli.py --enqueue / --worker).
+# The jobs are claimed with leases renewed while they run, and claimed again by other workers if they expire
+queue = {
+    # sqlite: file in the shared output folder (needs working file locks, ex: NFS v4) | redis: needs the redis module
+    'backend': 'sqlite',
+    'sqlite_file': f'{output_folder}/queue.sqlite',
+    'redis_url': 'redis://localhost:6379/0',
+    'redis_prefix': 'geotiff-processor',
+
+    # Seconds of each lease, renewed every third of it
+    'lease_seconds': 300,
+    # Claims of a job whose worker stopped before marking it as an error
+    'max_attempts': 3,
+    # Seconds between checks while the jobs of other workers are running
+    'poll_interval': 10
+}
+
+# Service mode (python cli.py --watch): the input folder is watched and the new or changed
+# files are processed as soon as they are completely written
+watch = {
+    # Seconds between scans. With inotify (needs the watchdog module) the changes also wake up the scan
+    'poll_interval': 10,
+    'inotify': True,
+
+    # An input is ready when its size and mtime don't change during these seconds...
+    'stable_seconds': 30,
+    # ...or, if set, when a sentinel file is created next to it (ex: '.done' for 12345678.tif.done)
+    'sentinel_suffix': None,
+
+    # GET /health returns the queue and the last batch as JSON. None to disable
+    'health_host': '127.0.0.1',
+    'health_port': 8080
+}
+
+# Number of files processed at the same time, each one in its own process.
+# Use 1 to process the files one after another
+workers = 1
+
+# Exports of the same file that run at the same time (threads), when they don't depend on each other.
+# Use 1 to run them one after another
+stage_workers = 4
 
 no_data = -10000
 
@@ -28,6 +85,136 @@ overviews = [2, 4, 8, 16, 32, 64, 128, 256]
 
 geoserver_epsg = 3857
 
+# Jobs are started only while their estimated peak memory (from the file size, bands and products)
+# fits in the budget with the running ones. The share of the budget of each job sets its GDAL cache and warp memory
+scheduler = {
+    'memory_budget': None,  # bytes, None to use 75% of the RAM
+
+    # small_first | priority | longest_first (time predicted from the metrics, see planner.py) | input
+    'order': 'small_first',
+
+    # Used with the 'priority' order, higher first. Filename patterns, ex: {'12345678*': 10}
+    'priorities': {},
+
+    # Max GDAL cache and warp memory of each job
+    'max_cache': 2048 * 1024 * 1024,  # bytes
+    'max_warp_memory': 1024 * 1024 * 1024  # bytes
+}
+
+# GDAL options chosen for each input from its block layout, compression and size: GDAL cache, warp memory,
+# threads, working type and error threshold of the reprojections. The choices are logged in the metrics
+tuning = {
+    'enabled': True,
+
+    # Max error of the approximated transformer when reprojecting, in pixels. None for the GDAL default (0.125)
+    'error_threshold': None,
+
+    # CPUs shared by the workers and the exports of each file, None to use all of them
+    'threads': None
+}
+
+# Per stage metrics (time, CPU, memory, GDAL cache, bytes read and written)
+metrics = {
+    # Events of each stage, appended as JSON lines
+    'enabled': True,
+    'jsonl_file': f'{output_folder}/metrics.jsonl',
+
+    # File for the node_exporter textfile collector (ex: '/var/lib/node_exporter/geotiff_processor.prom'), None to disable
+    'prometheus_file': None
+}
+
+# Write the database records (gdalinfo, quantities, DEM statistics and outlines) in a database at the end of each
+# batch, in one transaction. The rows of a mapId are replaced when it's processed again.
+# The files of the database folder are still exported
+database = {
+    'enabled': False,
+    'driver': 'gpkg',  # gpkg | postgis (needs psycopg2)
+    'gpkg_file': f'{output_folder_database}/database.gpkg',
+    'postgis_dsn': 'host=localhost dbname=geotiff user=postgres',
+
+    # SRS of the outlines in the database
+    'epsg': 4326
+}
+
+# Upload the storage files to an S3 compatible bucket (AWS S3, MinIO...) as soon as each
+# one is exported, while the next ones are processed. Needs boto3 (pip install boto3)
+upload = {
+    'enabled': False,
+
+    # None for AWS, ex: 'http://localhost:9000' for a local MinIO
+    'endpoint_url': None,
+    'region': None,
+    'bucket': 'geotiff-processor',
+    'prefix': 'storage',  # key prefix, the rest of the key is the path in the storage folder
+
+    # None to use the environment variables / aws config
+    'access_key': None,
+    'secret_key': None,
+
+    # Files uploaded at the same time, also the parts of each file
+    'workers': 8,
+    'multipart_threshold': 64 * 1024 * 1024,  # bytes
+    'multipart_chunksize': 16 * 1024 * 1024  # bytes
+}
+
+# Tiled mosaics (folders of tiles in the input folder), merged in a .vrt
+mosaics = {
+    # Index of the tiles of each folder, the .vrt is only rebuilt when a tile changes
+    'index_folder': f'{output_folder}/mosaics',
+
+    # Threads used to read the headers of the new or changed tiles
+    'workers': 8,
+
+    # Leave out the tiles without valid pixels (empty edge tiles)
+    'prune_empty_tiles': True
+}
+
+# Intermediate files of each job. Files estimated smaller than vsimem_max_size are kept in
+# memory (GDAL /vsimem/), bigger ones are written to scratch_folder (use a fast local disk).
+# With several workers, each one can hold up to vsimem_max_size per intermediate.
+# The written grids are compressed (ZSTD, or DEFLATE, with predictor). The biggest one is the
+# tiles grid at the max zoom resolution, up to the uncompressed size of the input before compression
+temp_storage = {
+    'vsimem_max_size': 256 * 1024 * 1024,  # bytes
+
+    # None to use tmp_folder
+    'scratch_folder': None
+}
+
+# Valid area (ha) calculation, used in the outputs and to choose the geoserver gsd
+area = {
+    # Resolution used to count the valid pixels of the alpha/noData mask.
+    # None to count them at full resolution (exact, but slower on big mosaics)
+    'gsd': 50  # cm
+}
+
+# Compression of the GeoTIFF products, selected by name with the 'compression' key of each product.
+# The overviews are written with the same options. If the GDAL build doesn't have a codec, DEFLATE is used
+# https://gdal.org/drivers/raster/gtiff.html#creation-options
+compression_profiles = {
+    # RGB, lossy
+    'jpeg': ['COMPRESS=JPEG', 'JPEG_QUALITY=80', 'PHOTOMETRIC=YCBCR'],
+    'webp': ['COMPRESS=WEBP', 'WEBP_LEVEL=80'],
+
+    # RGB, lossless
+    'webp_lossless': ['COMPRESS=WEBP', 'WEBP_LOSSLESS=YES'],
+    'deflate_rgb': ['COMPRESS=DEFLATE', 'PREDICTOR=2'],
+
+    # any type, lossless
+    'deflate': ['COMPRESS=DEFLATE'],
+    'zstd': ['COMPRESS=ZSTD', 'ZSTD_LEVEL=9'],
+
+    # float DEMs, lossless. The floating point predictor usually makes them 20-40% smaller
+    'deflate_float': ['COMPRESS=DEFLATE', 'PREDICTOR=3'],
+    'zstd_float': ['COMPRESS=ZSTD', 'PREDICTOR=3', 'ZSTD_LEVEL=9'],
+    # faster to decode and write, a little bigger
+    'zstd_float_fast': ['COMPRESS=ZSTD', 'PREDICTOR=3', 'ZSTD_LEVEL=1'],
+
+    # float DEMs, lossy with a max error of the elevations (m)
+    'lerc_1cm': ['COMPRESS=LERC_ZSTD', 'MAX_Z_ERROR=0.01'],
+    'lerc_5cm': ['COMPRESS=LERC_ZSTD', 'MAX_Z_ERROR=0.05']
+}
+
 # https://gdal.org/drivers/raster/gtiff.html#metadata
 metadata = [
     'TIFFTAG_ARTIST=Dirección Provincial de Hidráulica, Provincia de Buenos Aires'
@@ -39,7 +226,10 @@ geoserverRGB = {
     'gsd': 20, # cm
     'ha_sm_trigger': 150, # If raster is less than these ha, increase the quality of the geoserver images
     'gsd_sm': 10, # cm
-    'overviews': True
+    'overviews': True,
+    # Cloud Optimized GeoTIFF layout (overviews and mask written in one pass, better for range reads)
+    'cog': False,
+    'compression': 'jpeg'  # name of compression_profiles
 }
 
 # outlines are exported only in RGB mode
@@ -49,6 +239,10 @@ outlines = {
     # Polygons bigger than this area are preserved in the outlines
     'minimum_area': 10,  # m2
 
+    # Resolution of the mask used to create the outline (None to use the lightweight version resolution).
+    # Specks and holes smaller than minimum_area are removed before polygonizing
+    'gsd': 50,  # cm
+
     # Use to simplify the geometry
     # https://gdal.org/python/osgeo.ogr.Geometry-class.html#Simplify
     'simplify': 1,
@@ -62,6 +256,8 @@ geoserverDEM = {
     'enabled': True,
     'output_folder': output_folder_geoserver + '/mde',
     'overviews': True,
+    'cog': False,
+    'compression': 'deflate',
     'gsd': 50  # cm
 }
 
@@ -69,15 +265,44 @@ geoserverDEMRGB = {
     'enabled': True,
     'output_folder': output_folder_geoserver + '/mde_rgb',
     'overviews': True,
+    'cog': False,
+    # must be lossless (deflate, zstd, webp_lossless), the colors are the elevations
+    'compression': 'deflate',
     'encoding': 'terrarium' # mapbox | terrarium
 }
 
+# Pre-rendered EPSG:3857 tile pyramids, served without rendering in the geoserver
+tilesRGB = {
+    'enabled': False,
+    'output_folder': output_folder_tiles + '/rgb',
+    'container': 'mbtiles',  # mbtiles | xyz (z/x/y folders)
+    'format': 'WEBP',  # WEBP | JPEG
+    'quality': 80,
+    'min_zoom': None,  # None to start in the zoom where the whole file fits in one tile
+    'max_zoom': None,  # None to use the zoom closest to the file resolution
+    'workers': None  # rendering processes, None to use all the CPUs
+}
+
+tilesDEM = {
+    'enabled': False,
+    'output_folder': output_folder_tiles + '/mde_rgb',
+    'container': 'mbtiles',  # mbtiles | xyz (z/x/y folders)
+    'format': 'PNG',  # PNG | WEBP, both lossless
+    'encoding': 'terrarium',  # mapbox | terrarium
+    'min_zoom': None,
+    'max_zoom': None,
+    'workers': None
+}
+
 storageRGB = {
     'enabled': True,
     'gsd': None,  # None to use original | cm
     'gsd_sm_trigger': 5,  # cm 
     'gsd_sm': 10,  # cm Used if the default gsd is less than gsd_limit
     'overviews': True,
+    # Only the full resolution version when there is an _sm one, the outputs that must open in Civil 3D use GTiff
+    'cog': False,
+    'compression': 'jpeg',
     'gdalinfo': True
 }
 
@@ -85,6 +310,10 @@ storageDEM = {
     'enabled': True,
     'gsd': 20,  # cm
     'overviews': True,
+    # Ignored while the output must open in Civil 3D
+    'cog': False,
+    # Check that the predictor and codec can be read by Civil 3D before changing it
+    'compression': 'deflate',
     'quantities': True,
     'gdalinfo': True
 }
@@ -94,6 +323,17 @@ previews = {
     'width': 650  # px
 }
 
+# Statistics of the DEMs, exported with the quantities (storageDEM['quantities']) as a JSON in the mdevalues folder.
+# Computed in the same read of the style values, so with styleDEM['full_resolution'] False they use the lightweight version
+demStats = {
+    'enabled': True,
+    'percentiles': [1, 5, 25, 50, 75, 95, 99],
+    'histogram_bins': 50,
+
+    # Volume (m3) above each of these levels (m), besides the volume above the min. Ex: [0, 100.5]
+    'base_levels': []
+}
+
 styleDEM = {
 
     # Remove negative values from dem from the style calculations. Otherwhise, removes only the noData values.
@@ -104,6 +344,12 @@ styleDEM = {
     'min_percentile': 0.5,
     'max_percentile': 96,
 
+    # Max error (m) of the percentiles, used as the bin width of the histogram
+    'histogram_error': 0.01,
+
+    # Calculate the values over the original file instead of the lightweight version
+    'full_resolution': False,
+
     # min to max
     'palette': [
         "#0000bb",
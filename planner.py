@@ -0,0 +1,278 @@
+'''
+Dry run of the next batch: reads only the headers of the inputs (cached
+between runs) and predicts the time and output size of each job, with
+a cost model fitted on the stage metrics of the previous batches.
+
+Run from the repository root:
+    python planner.py --output plan.json
+or from the command line of the processor:
+    python cli.py --plan plan.json
+
+The same model orders the batch with `scheduler['order'] = 'longest_first'`.
+'''
+
+import os
+import sys
+import json
+import argparse
+
+import params as params
+from job import findJobs, initWorker
+from manifest import Manifest
+from headers import HeaderCache
+
+# Minimum number of events of a stage to fit the line, otherwise a rate by pixel is used
+MIN_FIT_POINTS = 3
+
+
+def loadEvents(path=None):
+    '''
+    Stage events of the previous batches that can be used to fit the costs
+    '''
+    path = path or params.metrics['jsonl_file']
+
+    events = []
+
+    if not os.path.exists(path):
+        return events
+
+    with open(path, 'r') as file:
+        for line in file:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # a line cut by an interrupted batch
+                continue
+            if (event.get('event') == 'stage' and event.get('status') == 'ok' and event.get('pixels')):
+                events.append(event)
+
+    return events
+
+
+def fitLine(points):
+    '''
+    Least squares (intercept, slope) of y over x. Returns None if the
+    x values are all the same
+    '''
+    n = len(points)
+    meanX = sum(x for x, y in points) / n
+    meanY = sum(y for x, y in points) / n
+
+    varX = sum((x - meanX) ** 2 for x, y in points)
+
+    if (varX == 0):
+        return None
+
+    slope = sum((x - meanX) * (y - meanY) for x, y in points) / varX
+
+    return meanY - slope * meanX, slope
+
+
+class CostModel:
+    '''
+    Wall seconds and output bytes of each stage by file type, as a
+    function of the number of pixels of the input
+    '''
+
+    def __init__(self, events):
+        self.models = {}
+
+        samples = {}
+        for event in events:
+            samples.setdefault((event['type'], event['stage']), []).append(event)
+
+        for key, stageEvents in samples.items():
+            self.models[key] = {
+                'seconds': self._fit([(e['pixels'], e['wall_seconds']) for e in stageEvents]),
+                'bytes': self._fit([(e['pixels'], e['output_bytes'] or 0) for e in stageEvents]),
+                'samples': len(stageEvents)
+            }
+
+    def _fit(self, points):
+        line = fitLine(points) if len(points) >= MIN_FIT_POINTS else None
+
+        # the line can go below zero for files smaller than the measured ones
+        if (line and line[0] >= 0 and line[1] >= 0):
+            return line
+
+        pixels = sum(x for x, y in points)
+        return 0, sum(y for x, y in points) / pixels
+
+    def predict(self, fileType, stage, pixels):
+        '''
+        (seconds, bytes) of a stage, None if it was never measured
+        '''
+        model = self.models.get((fileType, stage))
+
+        if not model:
+            return None
+
+        return tuple(intercept + slope * pixels for intercept, slope in (model['seconds'], model['bytes']))
+
+
+def getMapIdSource(job, stored):
+    '''
+    Where the mapId of the job comes from, same rules as Job
+    '''
+    if (params.filename_prefix in job.file):
+        return 'filename'
+
+    if (job.regid in stored):
+        return 'manifest'
+
+    return 'new'
+
+
+def planJob(job, model, stored):
+    header = job.header
+    pixels = header['xSize'] * header['ySize']
+    fileType = 'DEM' if job.isDEM else 'RGB'
+
+    gsd = (header['pixelSizeX'] + header['pixelSizeY']) / 2
+    triggersSm = not job.isDEM and job.isEnabled('storageRGB') and gsd < params.storageRGB['gsd_sm_trigger']
+
+    plan = {
+        'file': job.file,
+        'type': fileType,
+        'mapId': job.mapId,
+        'mapIdSource': getMapIdSource(job, stored),
+        'output': job.outputFilename,
+        'epsg': header['epsg'],
+        'date': header['date'],
+        'size': [header['xSize'], header['ySize']],
+        'bands': header['bands'],
+        'gsd': round(gsd * 100, 2),  # cm
+        # extent of the file, the valid area is only known after reading the pixels
+        'extentArea': round(pixels * header['pixelSizeX'] * header['pixelSizeY'] / 10000, 2),  # ha
+        'products': sorted(job.products),
+        'storageSm': triggersSm,
+        'bigtiff': triggersSm,
+        'stages': {},
+        'seconds': 0,
+        'outputBytes': 0,
+        'unknownStages': []
+    }
+
+    if not job.products:
+        return plan
+
+    plan['stages'], plan['unknownStages'] = predictStages(job, model)
+
+    # serial sum, the concurrent stages usually finish before
+    plan['seconds'] = round(sum(stage['seconds'] for stage in plan['stages'].values()), 2)
+    plan['outputBytes'] = sum(stage['outputBytes'] for stage in plan['stages'].values())
+
+    return plan
+
+
+def predictStages(job, model):
+    '''
+    ({stage: {seconds, outputBytes}}, stages never measured) of the stages that processJob runs
+    '''
+    pixels = job.header['xSize'] * job.header['ySize']
+    fileType = 'DEM' if job.isDEM else 'RGB'
+
+    predicted = {}
+    unknown = []
+
+    # the same stages that processJob runs, without running them
+    for stage in ['load', 'warpPlan'] + list(job.getStageGraph().stages):
+        prediction = model.predict(fileType, stage, pixels)
+
+        if prediction is None:
+            unknown.append(stage)
+            continue
+
+        seconds, outputBytes = prediction
+        predicted[stage] = {'seconds': round(seconds, 2), 'outputBytes': int(outputBytes)}
+
+    return predicted, unknown
+
+
+def estimateSeconds(job, model):
+    '''
+    Predicted seconds of a job, used by the scheduler to start the longest ones first
+    '''
+    predicted, unknown = predictStages(job, model)
+    return sum(stage['seconds'] for stage in predicted.values())
+
+
+def getPlan():
+    manifest = Manifest()
+    stored = manifest.getMapIds()
+
+    headers = HeaderCache()
+    jobs = findJobs(manifest, headers)
+    headers.save()
+
+    model = CostModel(loadEvents())
+
+    jobs = [planJob(job, model, stored) for job in jobs]
+    pending = [job for job in jobs if job['products']]
+
+    totalSeconds = sum(job['seconds'] for job in pending)
+
+    return {
+        'jobs': jobs,
+        'pending': len(pending),
+        'skipped': len(jobs) - len(pending),
+        'seconds': round(totalSeconds, 2),
+        # the longest job is a lower bound when there are more workers than jobs
+        'wallSeconds': round(max(totalSeconds / params.workers, max([job['seconds'] for job in pending] or [0])), 2),
+        'outputBytes': sum(job['outputBytes'] for job in pending),
+        'extentArea': round(sum(job['extentArea'] for job in pending), 2),
+        'newMapIds': len([job for job in pending if job['mapIdSource'] == 'new']),
+        'calibrated': sorted(f'{fileType}/{stage}' for fileType, stage in model.models)
+    }
+
+
+def printPlan(plan):
+    for job in plan['jobs']:
+        if not job['products']:
+            print(f'-> {job["file"]}: up to date')
+            continue
+
+        print(f'-> {job["file"]} ({job["type"]}, EPSG {job["epsg"]}, {job["extentArea"]} ha) '
+              f'as {job["output"]} [mapId from {job["mapIdSource"]}]')
+        print(f'   products: {", ".join(job["products"])}'
+              f'{" (_sm, BIGTIFF)" if job["storageSm"] else ""}')
+        print(f'   ~{job["seconds"]} s, ~{job["outputBytes"] / 1024 / 1024:.1f} MB'
+              f'{" (not measured: " + ", ".join(job["unknownStages"]) + ")" if job["unknownStages"] else ""}')
+
+    print(f'{plan["pending"]} files to process, {plan["skipped"]} up to date, {plan["newMapIds"]} new mapIds')
+    print(f'Estimated ~{plan["wallSeconds"]} s with {params.workers} workers '
+          f'({plan["seconds"]} s of work), ~{plan["outputBytes"] / 1024 / 1024:.1f} MB of outputs')
+
+
+def runPlan(output=None):
+    '''
+    Print the plan of the next batch, and write it as JSON to `output`
+    '''
+    if not os.path.exists(params.input_folder):
+        sys.exit(f'ERROR: Input folder {params.input_folder} was not found')
+
+    initWorker()
+
+    os.makedirs(params.output_folder, exist_ok=True)
+
+    plan = getPlan()
+
+    printPlan(plan)
+
+    if output:
+        with open(output, 'w') as file:
+            json.dump(plan, file, indent=2)
+
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dry run of the next batch')
+    parser.add_argument('--output', help='write the plan as JSON')
+    args = parser.parse_args()
+
+    runPlan(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,22 @@
 import sys
 import os
 import shutil
+import json
+import time
 from pathlib import Path
-import math
-import struct
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import params as params
 import helpers as h
 import generateVRT as vrt
-
-from export_formats.storageRGB import exportStorageRGB
-from export_formats.storageDEM import exportStorageDEM
-from export_formats.geoserverDEM import exportGeoserverDEM
-from export_formats.geoserverRGB import exportGeoserverRGB
-from export_formats.previews import exportStoragePreview
-from export_formats.quantities import exportQuantities
-from export_formats.outlines import exportOutline
+from job import initWorker, getParamValues, processJob, findJobs
+from manifest import Manifest
+from headers import HeaderCache
+import metrics
+from tempStorage import getScratchFolder
+from uploader import getUploader
+from database import getSink
+from scheduler import Scheduler
 
 from version import __version__
 
@@ -36,22 +37,33 @@ class ConvertGeotiff:
 
     '''
 
-    def __init__(self):
+    def __init__(self, run=True):
+        '''
+        Use `run=False` to only set up GDAL, and process the
+        input folder later with `run()` (once or many times)
+        '''
         print(f'SCRIPT Version: {__version__}')
-        
+
         version_num = int(gdal.VersionInfo('VERSION_NUM'))
         print(f'GDAL Version: {version_num}')
 
-        print('OPERATION STARTED')
+        initWorker()
+
+        # the serial batch stops on the first failed file, the watcher processes all of them
+        self.stopOnError = True
 
-        # Allows GDAL to throw Python Exceptions
-        gdal.UseExceptions()
+        if run:
+            self.run()
 
-        gdal.SetConfigOption('GDAL_TIFF_INTERNAL_MASK', 'YES')
+    def run(self):
+        print('OPERATION STARTED')
 
-        self.checkDirectories()
-        self.processTifs()
-        self.cleanTempFolder()
+        try:
+            self.checkDirectories()
+            self.processTifs()
+        finally:
+            # also when a job fails and the batch exits
+            self.cleanTempFolder()
 
         print('OPERATION FINISHED')
 
@@ -84,211 +96,221 @@ class ConvertGeotiff:
         h.createFolder(params.geoserverDEM['output_folder'])
         h.createFolder(params.geoserverDEMRGB['output_folder'])
 
+        # tiles folders
+        h.createFolder(params.tilesRGB['output_folder'])
+        h.createFolder(params.tilesDEM['output_folder'])
+
+    def getJobs(self, failed=None):
+        '''
+        Find files in the input folder and create one job for each of them.
+        The mapIds are assigned here, so RGB and DEM of the same registro
+        share the hash even if they are processed in different processes.
+        '''
+
+        headers = HeaderCache()
+
+        jobs = findJobs(self.manifest, headers, failed=failed)
+
+        headers.save()
+
+        return jobs
+
     def processTifs(self):
 
+        # results of the last batch, read by the watcher
+        self.summary = []
+
         if(os.listdir(params.input_folder)):
             vrt.generateVRT()
 
-        processed = {}
+        self.manifest = Manifest()
+
+        # fails now if the upload is enabled without boto3
+        getUploader()
+
+        self.database = getSink()
+        self.records = {}
+
+        start = time.time()
+
+        summary = self.summary
+
+        # without stopping on errors, the files that can't be read are results of the batch
+        jobs = self.getJobs(None if self.stopOnError else summary)
+
+        for job in [job for job in jobs if not job.products]:
+            print(f'-> Skipping {job.file}, outputs are up to date')
+            summary.append({**job.getSummary(), 'status': 'skipped'})
+
+        jobs = [job for job in jobs if job.products]
+
+        if (params.workers > 1 and len(jobs) > 1):
+            summary += self.processPool(jobs)
+
+        else:
+            scheduler = Scheduler(jobs, 1)
+
+            while scheduler.pending:
+                job = scheduler.next(0)
+                result = processJob(job)
+                summary.append(result)
+                self.updateManifest(result)
+
+                if (result['status'] == 'error' and self.stopOnError):
+                    self.collectUploads(summary)
+                    self.writeDatabase()
+                    self.exportSummary(summary)
+                    sys.exit(1)
+
+            self.collectUploads(summary)
+
+        self.writeDatabase()
 
-        # Find files in the input folder
-        for subdir, dirs, files in os.walk(params.input_folder):
-            is_subdir = subdir != params.input_folder
-            if(is_subdir):
-                continue
+        self.exportSummary(summary)
 
-            for file in files:
-                filepath = subdir + os.sep + file
-                if (h.getExtension(file) in params.extensions):
+        if (params.metrics['prometheus_file']):
+            metrics.writePrometheus(summary, round(time.time() - start, 2))
+
+        if any(result['status'] == 'error' for result in summary):
+            sys.exit(1)
+
+        if any(upload['status'] == 'error' for result in summary for upload in result.get('uploads', [])):
+            sys.exit(1)
+
+    def processPool(self, jobs):
+        '''
+        Run each file as an independent job in a process pool. The
+        scheduler starts them while they fit in the memory budget
+        '''
+
+        print(f'-> Processing {len(jobs)} files with {params.workers} workers')
+
+        summary = []
+
+        scheduler = Scheduler(jobs, params.workers)
+
+        # the workers don't inherit the params overridden by the command line when they are spawned
+        with ProcessPoolExecutor(max_workers=params.workers, initializer=initWorker,
+                                 initargs=(getParamValues(),)) as executor:
+            running = {}
+
+            while scheduler.pending or running:
+                while len(running) < params.workers:
+                    job = scheduler.next(len(running))
+                    if not job:
+                        break
+                    running[executor.submit(processJob, job, True)] = job
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    job = running.pop(future)
+                    scheduler.release(job)
                     try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {
+                            **job.getSummary(),
+                            'status': 'error',
+                            'error': repr(e)
+                        }
+                    print(f'-> Finished {result["file"]} ({result["status"]})')
+                    summary.append(result)
+                    self.updateManifest(result)
+
+        return summary
+
+    def collectUploads(self, summary):
+        '''
+        Wait for the uploads still running in this process, and add their results to the summary
+        '''
+        uploader = getUploader()
+
+        if not uploader:
+            return
 
-                        print(f'--> PROCESSING FILE {file} <--')
-
-                        file_ds = gdal.Open(filepath, gdal.GA_ReadOnly)
-                        # Number of bands
-                        bands_count = file_ds.RasterCount
-                        self.isDEM = bands_count <= 2
-
-                        lastBand = file_ds.GetRasterBand(bands_count)
-                        self.hasAlphaChannel = (
-                            lastBand.GetColorInterpretation() == 6)  # https://github.com/rasterio/rasterio/issues/100
-                        self.noDataValue = lastBand.GetNoDataValue()  # take any band
-
-                        # Pix4DMatic injects an erroneous 'nan' value as noData attribute
-                        if ((self.noDataValue != None) and (math.isnan(self.noDataValue))):
-                            self.noDataValue = 0
-
-                        filenameHasMapId = params.filename_prefix in file
-
-                        if (self.isDEM):
-
-                            print(f'-> File {file} is DEM type')
-
-                            # Generating output filename for DME case
-                            self.mapId = h.removeExtension(file.split(
-                                params.filename_prefix)[1].split(params.dem_suffix)[0]) if filenameHasMapId else h.createMapId()
-
-                            if(not filenameHasMapId):
-                                h.checkFileProcessed(
-                                    self, True, processed, file)
-
-                            self.registroid = file.split(
-                                params.filename_prefix)[0] if filenameHasMapId else h.cleanFilename(h.removeExtension(file.split(params.dem_suffix)[0]))
-                        else:
-
-                            print(f'-> File {file} is RGB type')
-
-                            self.mapId = h.removeExtension(
-                                file.split(params.filename_prefix)[1]) if filenameHasMapId else h.createMapId()
-
-                            if(not filenameHasMapId):
-                                h.checkFileProcessed(
-                                    self, False, processed, file)
-
-                            self.registroid = file.split(
-                                "_")[0] if filenameHasMapId else h.cleanFilename(h.removeExtension(file))
-
-                        output = f'{self.registroid}{params.filename_prefix}{self.mapId}'
-
-                        # Create parent folder for mapId
-                        self.outputFolder = f'{params.output_folder_storage}/{output}'
-                        h.createFolder(self.outputFolder)
-
-                        self.outputFilename = output if not self.isDEM else '{}{}'.format(
-                            output, params.dem_suffix)
-
-                        print(
-                            f'-> Files for {self.outputFilename} will be exported')
-
-                        # File GSD
-                        gt = file_ds.GetGeoTransform()
-                        self.pixelSizeX = gt[1]
-                        self.pixelSizeY = -gt[5]
-                        
-                        print(f'-> Pixel size: {self.pixelSizeX} x {self.pixelSizeY}')
-
-                        self.pixel_area = self.pixelSizeX * abs(self.pixelSizeY)                        
-                        
-                        if (self.hasAlphaChannel):
-                            # generate an ultralight version to calculate the area
-                            xsmall_version = gdal.Translate(
-                                params.tmp_folder + "\\tmpArea.vrt",
-                                file_ds,
-                                **{                         
-                                    'format': 'GTiff',
-                                    'xRes': 20,
-                                    'yRes': 20
-                                }
-                            )
-                            
-                            xsmall_version_lastBand = xsmall_version.GetRasterBand(bands_count)
-
-                            BandType = gdal.GetDataTypeName(xsmall_version_lastBand.DataType)
-                            fmttypes = {'Byte':'B', 'UInt16':'H', 'Int16':'h', 'UInt32':'I', 'Int32':'i', 'Float32':'f', 'Float64':'d'}
-                            
-                            self.pixel_num = 0
-
-                            for y in range(xsmall_version_lastBand.YSize):
-                            
-                                scanline = xsmall_version_lastBand.ReadRaster(0, y, xsmall_version_lastBand.XSize, 1, xsmall_version_lastBand.XSize, 1, xsmall_version_lastBand.DataType)
-                                values = struct.unpack(fmttypes[BandType] * xsmall_version_lastBand.XSize, scanline)
-                            
-                                for value in values:
-                                    if value > 0:
-                                        self.pixel_num = self.pixel_num + 1
-                            gt = xsmall_version.GetGeoTransform()
-                            pixelSizeX = gt[1]
-                            pixelSizeY = -gt[5]
-                            pixel_area = pixelSizeX * abs(pixelSizeY)
-                            self.area = self.pixel_num * (pixel_area / 10000)
-                            xsmall_version = None
-                            
-                        else:
-                            # entire geotiff area (including alpha and nodata)
-                            self.pixel_num = file_ds.RasterXSize * file_ds.RasterYSize                        
-                            self.area = self.pixel_num * (self.pixel_area / 10000)
-                        
-                        print('-> Area in ha:', self.area)
-
-                        # file's GSD: get average x and y values
-                        self.originalGsd = round(
-                            (self.pixelSizeY + self.pixelSizeX) / 2 * 100, 2)  # cm
-
-                        # File Projection
-                        self.epsg = h.getEPSGCode(file_ds)
-
-                        self.date = h.getDateFromMetadata(file_ds)
-
-                        self.extra_metadata = params.metadata
-
-                        self.extra_metadata.append(
-                            'registroId={}'.format(self.registroid))
-
-                        self.extra_metadata.append(
-                            'mapId={}'.format(self.mapId))
-
-                        self.exportStorageFiles(file_ds)
-
-                        if ((self.isDEM and (params.geoserverDEM['enabled'] or params.geoserverDEMRGB['enabled'])) or params.geoserverRGB['enabled']):
-                            self.exportGeoserverFiles(file_ds, file)
-
-                        # Once we're done, close properly the dataset
-                        file_ds = None
-
-                    except RuntimeError as e:
-                        print(f'ERROR: Unable to process {filepath}')
-                        print(e)
-                        sys.exit(1)
-
-    def exportStorageFiles(self, file_ds):
+        print('-> Waiting for the uploads')
+
+        uploads = uploader.collect()
+
+        for result in summary:
+            if result['file'] in uploads:
+                result['uploads'] = result.get('uploads', []) + uploads[result['file']]
+
+    def writeDatabase(self):
         '''
-        Export high and low res files
+        Write the records of the batch in one transaction
         '''
+        if not self.database or not self.records:
+            return
 
-        print('EXPORTING STORAGE FILES')
+        count = sum(len(rows) for rows in self.records.values())
 
-        # creates and low res for some fast operations
-        if params.storageDEM['enabled'] or params.previews['enabled'] or params.storageDEM['quantities']:
-            compressedGeotiff = h.getLightVersion(self, file_ds)
+        print(f'-> Writing {count} records in the database')
 
-        if (self.isDEM):
-            if params.storageDEM['enabled'] or params.previews['enabled'] or params.storageDEM['quantities']:
-                self.colorValues = h.calculateDEMColorValues(
-                    self, compressedGeotiff)
-            
-            if params.storageDEM['enabled']:
-                exportStorageDEM(self, file_ds)
+        self.database.write(self.records)
 
-            if params.storageDEM['quantities']:
-                exportQuantities(self)
+        self.records = {}
 
-        else:
-            if (params.outlines['enabled']):
-                exportOutline(self, compressedGeotiff)
+    def updateManifest(self, result):
+        '''
+        Saved after each job, so an interrupted batch keeps the finished files
+        '''
+        if (params.metrics['enabled']):
+            metrics.appendEvents(result.get('metrics', []))
 
-            if params.storageRGB['enabled']:
-                exportStorageRGB(self, file_ds)
+        # buffered for the whole batch, also the ones of the failed jobs
+        for table, rows in result.get('records', {}).items():
+            self.records.setdefault(table, []).extend(rows)
 
-        if (params.previews['enabled']):
-            exportStoragePreview(self, compressedGeotiff)
+        if result['status'] == 'ok':
+            self.manifest.update(result)
+            self.manifest.save()
 
-        compressedGeotiff = None
+    def exportSummary(self, summary):
+        '''
+        Print and save the merged results of all the jobs
+        '''
 
-    def exportGeoserverFiles(self, file_ds, file):
+        print('SUMMARY')
 
-        print('EXPORTING GEOSERVER FILES')
+        for result in summary:
+            line = f'--> {result["file"]}: {result["status"]}, {result["output"]}'
+            if result['status'] == 'error':
+                line += f', {result["error"]}'
+            elif result['status'] == 'ok':
+                line += f', {result["area"]} ha, {result["elapsed"]} s'
+                if result.get('temp'):
+                    line += ', temp peak {:.1f} MB in memory / {:.1f} MB on disk'.format(
+                        result['temp']['peak_memory_bytes'] / 1048576, result['temp']['peak_disk_bytes'] / 1048576)
+            print(line)
 
-        if (self.isDEM):
-            if (params.geoserverDEM['enabled'] or params.geoserverDEMRGB['enabled']):
-                exportGeoserverDEM(self, file_ds, file)
-        else:
-            if (params.geoserverRGB['enabled']):
-                exportGeoserverRGB(self, file_ds)
+        failed = len([result for result in summary if result['status'] == 'error'])
+
+        skipped = len([result for result in summary if result['status'] == 'skipped'])
+
+        print(f'-> {len(summary) - failed - skipped} files processed, {skipped} skipped, {failed} with errors')
+
+        uploads = [upload for result in summary for upload in result.get('uploads', [])]
+
+        if uploads:
+            counts = {status: len([upload for upload in uploads if upload['status'] == status])
+                      for status in ['uploaded', 'skipped', 'error']}
+            print(f'-> {counts["uploaded"]} files uploaded, {counts["skipped"]} already uploaded, {counts["error"]} with errors')
+
+        summaryPath = f'{params.output_folder}/summary.json'
+
+        with open(summaryPath, 'w') as file:
+            # the records are in the database
+            json.dump([{key: value for key, value in result.items() if key != 'records'} for result in summary],
+                      file, indent=2, default=str)
 
     def cleanTempFolder(self):
-        if os.path.exists(params.tmp_folder):
-            print('-> Removing temp folder')
-            shutil.rmtree(params.tmp_folder)
+        for folder in {params.tmp_folder, getScratchFolder()}:
+            if os.path.exists(folder):
+                print(f'-> Removing temp folder {folder}')
+                shutil.rmtree(folder, ignore_errors=True)
 
 
-ConvertGeotiff()
+if __name__ == '__main__':
+    ConvertGeotiff()
@@ -0,0 +1,164 @@
+import os
+import fnmatch
+from osgeo import gdal
+
+import params as params
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MB = 1024 * 1024
+
+# Python, GDAL and numpy of an idle worker
+PROCESS_OVERHEAD = 300 * MB
+
+# Pixels of the windows read by the streaming stages (helpers.getBlockWindows)
+WINDOW_PIXELS = 4194304
+
+MIN_CACHE = 64 * MB
+MIN_WARP_MEMORY = 64 * MB
+
+
+def getTotalMemory():
+    '''
+    RAM of the node in bytes, None if it can't be read
+    '''
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        pass
+    if psutil:
+        return psutil.virtual_memory().total
+    return None
+
+
+def getBudget():
+    if params.scheduler['memory_budget']:
+        return params.scheduler['memory_budget']
+
+    total = getTotalMemory()
+
+    # leave room for the OS and the page cache
+    return int(total * 0.75) if total else 4096 * MB
+
+
+def estimateMemory(job):
+    '''
+    Peak memory of a job without the GDAL cache and the warp buffers,
+    from the size of the file and its enabled products
+    '''
+    header = job.header
+
+    pixels = header['xSize'] * header['ySize']
+    valueSize = gdal.GetDataTypeSize(header['dataType']) // 8
+
+    # float64 copies of a window in the area and histogram passes, by concurrent stage
+    working = min(WINDOW_PIXELS, pixels) * max(valueSize * header['bands'], 8) * 4 * params.stage_workers
+
+    if job.isEnabled('outlines'):
+        gsd = max((params.outlines['gsd'] or 30) / 100, header['pixelSizeX'])
+        maskPixels = pixels * (header['pixelSizeX'] / gsd) * (header['pixelSizeY'] / gsd)
+        # mask, sieve and polygonize buffers
+        working = max(working, maskPixels * 8)
+
+    if job.hasTiles():
+        # the renderer processes, while this one waits
+        tilesParams = params.tilesDEM if job.isDEM else params.tilesRGB
+        working = max(working, (tilesParams['workers'] or os.cpu_count()) * PROCESS_OVERHEAD)
+
+    if job.needsLightVersion():
+        # the materialized lightweight version can be kept in /vsimem/
+        scale = min(1, header['pixelSizeX'] / 0.3) * min(1, header['pixelSizeY'] / 0.3)
+        working += min(params.temp_storage['vsimem_max_size'], pixels * scale * valueSize * header['bands'])
+
+    return int(PROCESS_OVERHEAD + working)
+
+
+def getPriority(job):
+    for pattern, priority in params.scheduler['priorities'].items():
+        if fnmatch.fnmatch(job.file, pattern):
+            return priority
+    return 0
+
+
+def sortByCost(jobs):
+    '''
+    Longest predicted jobs first (cost model of the planner), so the
+    batch doesn't end with one big file running alone
+    '''
+    # the planner imports the exporters, only needed with this order
+    from planner import CostModel, loadEvents, estimateSeconds
+
+    model = CostModel(loadEvents())
+
+    for job in jobs:
+        job.estimatedSeconds = estimateSeconds(job, model)
+
+    return sorted(jobs, key=lambda job: (-job.estimatedSeconds, -job.memoryEstimate))
+
+
+class Scheduler:
+    '''
+    Admits jobs while their estimated peak memory fits in the budget. Each job
+    gets its share of the budget: what is left after its estimate goes to its
+    GDAL cache and warp memory. A job bigger than its share runs anyway,
+    but with fewer jobs at the same time.
+    '''
+
+    def __init__(self, jobs, workers):
+        self.budget = getBudget()
+        self.reserved = 0
+
+        share = self.budget // workers
+
+        for job in jobs:
+            self.assign(job, share)
+
+        order = params.scheduler['order']
+
+        if (order == 'small_first'):
+            jobs = sorted(jobs, key=lambda job: job.memoryEstimate)
+        elif (order == 'priority'):
+            jobs = sorted(jobs, key=lambda job: (-getPriority(job), job.memoryEstimate))
+        elif (order == 'longest_first'):
+            jobs = sortByCost(jobs)
+
+        self.pending = list(jobs)
+
+        print(f'-> Memory budget {self.budget // MB} MB for {workers} workers')
+
+    def assign(self, job, share):
+        job.memoryEstimate = estimateMemory(job)
+
+        free = max(0, share - job.memoryEstimate)
+
+        job.cacheMax = max(MIN_CACHE, min(free * 2 // 3, params.scheduler['max_cache']))
+        job.warpMemory = max(MIN_WARP_MEMORY, min(free // 3, params.scheduler['max_warp_memory']))
+
+        job.memoryReserved = job.memoryEstimate + job.cacheMax + job.warpMemory
+
+    def next(self, running):
+        '''
+        Next job to start, None if it doesn't fit now. Only the first one
+        is checked, so the big jobs aren't postponed forever
+        '''
+        if not self.pending:
+            return None
+
+        job = self.pending[0]
+
+        if (running and self.reserved + job.memoryReserved > self.budget):
+            return None
+
+        self.pending.pop(0)
+        self.reserved += job.memoryReserved
+
+        print(f'-> Starting {job.file}: estimated {job.memoryReserved // MB} MB '
+              f'(GDAL cache {job.cacheMax // MB} MB, warp memory {job.warpMemory // MB} MB)')
+
+        return job
+
+    def release(self, job):
+        self.reserved -= job.memoryReserved
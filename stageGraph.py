@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class StageGraph:
+    '''
+    Exports of a file as a dependency graph. The stages whose dependencies
+    are done run at the same time in a thread pool: most of their time is
+    spent inside GDAL (encoding, compression, overviews), which releases the GIL.
+    Each stage must open its own dataset handles.
+    '''
+
+    def __init__(self, metrics, setup=None):
+        self.metrics = metrics
+        # called in the thread of each stage before running it (thread local GDAL options)
+        self.setup = setup
+        self.stages = {}
+
+    def add(self, name, fn, after=()):
+        '''
+        Add a stage. Dependencies not in the graph (disabled products)
+        are ignored, so they must be added before the stages that use them
+        '''
+        self.stages[name] = {
+            'fn': fn,
+            'after': [dependency for dependency in after if dependency in self.stages]
+        }
+
+    def run(self, workers):
+        '''
+        Run all the stages. After the first error no more stages are
+        started, and the error is raised once the running ones finish
+        '''
+
+        if (workers <= 1):
+            # the stages were added in dependency order
+            for name in self.stages:
+                self._run(name)
+            return
+
+        pending = dict(self.stages)
+        running = {}
+        done = set()
+        error = None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                if error is None:
+                    ready = [name for name, stage in pending.items()
+                             if all(dependency in done for dependency in stage['after'])]
+
+                    for name in ready:
+                        del pending[name]
+                        running[executor.submit(self._run, name)] = name
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                    except Exception as e:
+                        error = error or e
+
+        if error:
+            raise error
+
+    def _run(self, name):
+        if self.setup:
+            self.setup()
+
+        with self.metrics.stage(name):
+            self.stages[name]['fn']()
@@ -0,0 +1,100 @@
+import os
+import shutil
+from osgeo import gdal
+
+import params as params
+
+
+def getScratchFolder():
+    '''
+    Folder for the intermediates too big to be kept in memory
+    '''
+    if params.temp_storage['scratch_folder']:
+        return f'{params.temp_storage["scratch_folder"]}/geotiff-processor'
+    return params.tmp_folder
+
+
+def estimateSize(xSize, ySize, bands, dataType):
+    '''
+    Uncompressed size in bytes of a raster
+    '''
+    return xSize * ySize * bands * gdal.GetDataTypeSize(dataType) // 8
+
+
+def _getMemoryFiles(folder):
+    files = gdal.ReadDirRecursive(folder) or []
+    # folders are listed with a trailing slash
+    return [f'{folder}/{file}' for file in files if not file.endswith('/')]
+
+
+def _getDiskFiles(folder):
+    return [os.path.join(path, file) for path, dirs, files in os.walk(folder) for file in files]
+
+
+class TempStorage:
+    '''
+    Intermediate files of a job. Files estimated smaller than
+    params.temp_storage['vsimem_max_size'] are kept in GDAL's /vsimem/,
+    bigger ones spill to the scratch folder.
+
+    /vsimem/ is only visible to GDAL in this process, so the files
+    read or written by other libraries (rasterio, PIL) must use `onDisk`
+    '''
+
+    def __init__(self, name):
+        self.memoryFolder = f'/vsimem/geotiff-processor/{name}'
+        self.diskFolder = f'{getScratchFolder()}/{name}'
+        self.peakMemory = 0
+        self.peakDisk = 0
+
+    def getPath(self, filename, estimatedSize=0, onDisk=False):
+        '''
+        Path for a new intermediate file
+        '''
+        if (onDisk or estimatedSize > params.temp_storage['vsimem_max_size']):
+            os.makedirs(self.diskFolder, exist_ok=True)
+            return f'{self.diskFolder}/{filename}'
+
+        return f'{self.memoryFolder}/{filename}'
+
+    def writeText(self, filename, text):
+        '''
+        Small text intermediate (ex: color palettes), readable by GDAL
+        '''
+        path = self.getPath(filename)
+        gdal.FileFromMemBuffer(path, text.encode())
+        return path
+
+    def getUsage(self):
+        '''
+        Current bytes in memory and disk. Also updates the peaks
+        '''
+        memory = sum(gdal.VSIStatL(path).size for path in _getMemoryFiles(self.memoryFolder))
+
+        disk = 0
+        for path in _getDiskFiles(self.diskFolder):
+            try:
+                disk += os.path.getsize(path)
+            except OSError:
+                pass
+
+        self.peakMemory = max(self.peakMemory, memory)
+        self.peakDisk = max(self.peakDisk, disk)
+
+        return {'memory_bytes': memory, 'disk_bytes': disk}
+
+    def getReport(self):
+        return {
+            **self.getUsage(),
+            'peak_memory_bytes': self.peakMemory,
+            'peak_disk_bytes': self.peakDisk
+        }
+
+    def cleanup(self):
+        '''
+        Remove every intermediate of the job, safe to call more than once
+        '''
+        for path in _getMemoryFiles(self.memoryFolder):
+            gdal.Unlink(path)
+
+        shutil.rmtree(self.diskFolder, ignore_errors=True)
@@ -0,0 +1,59 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from demStats import StreamingHistogram
+
+
+def test_float32_values_on_bin_edges():
+    # 95.82 / 0.01 is 9582 in float32 but 9581.99... in float64
+    values = np.array([40.48, 59.38, 95.82], dtype=np.float32)
+
+    histogram = StreamingHistogram(0.01)
+    histogram.update(values)
+
+    assert histogram.counts.sum() == values.size
+    assert histogram.percentile(100) <= float(values.max()) + 0.01
+
+
+def test_random_float32_dems():
+    rng = np.random.default_rng(0)
+
+    for _ in range(50):
+        histogram = StreamingHistogram(0.01)
+
+        for _ in range(4):
+            values = (rng.random(10000) * 100).astype(np.float32)
+            histogram.update(values)
+
+        assert histogram.counts.sum() == histogram.count == 40000
+
+
+def test_percentiles_within_bin_width():
+    rng = np.random.default_rng(1)
+
+    # dense center and sparse tails, where consecutive values are far apart
+    values = np.concatenate([
+        rng.normal(50, 2, 20000),
+        rng.uniform(0, 200, 30),
+        np.array([0.0, 0.0, 1.0, 1.0])
+    ]).astype(np.float32)
+
+    for binWidth in [0.01, 0.1]:
+        histogram = StreamingHistogram(binWidth)
+        for block in np.array_split(values, 7):
+            histogram.update(block)
+
+        for q in [0, 0.5, 1, 5, 25, 50, 75, 95, 99, 99.5, 100]:
+            expected = np.percentile(values.astype(np.float64), q)
+            assert abs(histogram.percentile(q) - expected) <= histogram.binWidth
+
+
+def test_percentile_between_distant_values():
+    histogram = StreamingHistogram(0.01)
+    histogram.update(np.array([0, 0, 1, 1], dtype=np.float32))
+
+    assert abs(histogram.percentile(50) - 0.5) <= 0.01
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('osgeo')
+
+import params as params
+from job import findJobs, initWorker
+from manifest import Manifest
+from headers import HeaderCache
+from benchmarks import synthetic
+
+
+@pytest.fixture
+def inputFolder(tmp_path, monkeypatch):
+    folder = tmp_path / 'input'
+    folder.mkdir()
+
+    monkeypatch.setattr(params, 'input_folder', str(folder))
+    monkeypatch.setattr(params, 'only_files', None)
+
+    initWorker()
+
+    synthetic.createOrtho(str(folder / '1000.tif'), 64)
+
+    # a file still being copied, or broken
+    (folder / '2000.tif').write_bytes(b'II*\x00' + b'\x00' * 100)
+
+    return tmp_path
+
+
+def test_corrupt_file_is_an_error_result(inputFolder):
+    failed = []
+
+    jobs = findJobs(Manifest(str(inputFolder / 'manifest.json')), HeaderCache(str(inputFolder / 'headers.json')),
+                    failed=failed)
+
+    assert [job.file for job in jobs] == ['1000.tif']
+    assert [(result['file'], result['status']) for result in failed] == [('2000.tif', 'error')]
+
+
+def test_corrupt_file_stops_the_batch(inputFolder):
+    with pytest.raises(SystemExit):
+        findJobs(Manifest(str(inputFolder / 'manifest.json')), HeaderCache(str(inputFolder / 'headers.json')))
@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import params as params
+from jobQueue import SQLiteQueue
+
+
+def _work(path, worker, claimed):
+    queue = SQLiteQueue(path)
+
+    while True:
+        job = queue.claim(worker, 60)
+        if not job:
+            counts = queue.getCounts()
+            # wait for the jobs of other workers, claimed again if their lease expires
+            if counts.get('running'):
+                time.sleep(0.1)
+                continue
+            return
+        file, description = job
+        claimed.put((worker, file))
+        queue.complete(file, worker, {'file': file, 'output': description['output'], 'status': 'ok'})
+
+
+def test_every_job_is_claimed_once(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    queue = SQLiteQueue(path)
+
+    files = [f'{i:04d}.tif' for i in range(100)]
+    for file in files:
+        assert queue.enqueue(file, {'output': file})
+
+    context = multiprocessing.get_context('spawn')
+    claimed = context.Queue()
+
+    workers = [context.Process(target=_work, args=(path, f'worker{i}', claimed)) for i in range(6)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert all(worker.exitcode == 0 for worker in workers)
+
+    claims = [claimed.get(timeout=5) for _ in files]
+    assert claimed.empty()
+    assert sorted(file for worker, file in claims) == files
+
+    assert queue.getCounts() == {'done': len(files)}
+    assert [result['file'] for result in queue.getResults()] == files
+
+
+def test_workers_claim_the_job_of_a_dead_worker(tmp_path):
+    path = str(tmp_path / 'queue.sqlite')
+    queue = SQLiteQueue(path)
+
+    files = [f'{i:04d}.tif' for i in range(20)]
+    for file in files:
+        queue.enqueue(file, {'output': file})
+
+    # claimed by a worker that dies without sending heartbeats
+    stolen, _ = queue.claim('dead', 1)
+
+    context = multiprocessing.get_context('spawn')
+    claimed = context.Queue()
+
+    workers = [context.Process(target=_work, args=(path, f'worker{i}', claimed)) for i in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    claims = [claimed.get(timeout=5) for _ in files]
+
+    assert sorted(file for worker, file in claims) == files
+    assert queue.getCounts() == {'done': len(files)}
+
+    entry = queue._atomic(lambda state: state['jobs'][stolen])
+    assert entry['attempts'] == 2
+    assert entry['worker'] != 'dead'
+
+
+def test_expired_lease_is_claimed_again(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / 'queue.sqlite'))
+    queue.enqueue('a.tif', {})
+
+    # a worker that stops sending heartbeats
+    assert queue.claim('dead', 0.1)[0] == 'a.tif'
+    assert queue.claim('alive', 60) is None
+
+    time.sleep(0.2)
+
+    assert queue.claim('alive', 60)[0] == 'a.tif'
+    assert not queue.heartbeat('a.tif', 'dead', 60)
+    assert not queue.complete('a.tif', 'dead', {'file': 'a.tif', 'status': 'ok'})
+    assert queue.complete('a.tif', 'alive', {'file': 'a.tif', 'status': 'ok'})
+
+    assert queue.getCounts() == {'done': 1}
+
+
+def test_abandoned_job_is_an_error(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / 'queue.sqlite'))
+    queue.enqueue('a.tif', {})
+
+    for attempt in range(params.queue['max_attempts']):
+        assert queue.claim(f'dead{attempt}', 0) is not None
+        time.sleep(0.01)
+
+    assert queue.claim('alive', 60) is None
+    assert queue.getCounts() == {'error': 1}
+    assert queue.getResults()[0]['error'] == 'lease expired'
+
+
+def test_mapid_is_assigned_once(tmp_path):
+    queue = SQLiteQueue(str(tmp_path / 'queue.sqlite'))
+
+    assert queue.assignMapId('1234', 'aaa') == 'aaa'
+    assert queue.assignMapId('1234', 'bbb') == 'aaa'
+    assert queue.assignMapId('12345', 'ccc') == 'ccc'
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('osgeo')
+
+from tuning import getWarpMemory, getCacheSize, MB, MIN_CACHE
+
+# scheduler share of a job in a big node
+RESERVED_CACHE = 2048 * MB
+RESERVED_WARP = 1024 * MB
+
+
+def getSource(layout, compression='DEFLATE'):
+    return {
+        'layout': layout,
+        'compression': compression,
+        'xSize': 40000,
+        'ySize': 40000,
+        'blockX': 40000 if layout == 'strips' else 256,
+        'blockY': 1 if layout == 'strips' else 256,
+        'pixelBytes': 4
+    }
+
+
+def test_layouts_get_different_settings():
+    settings = {}
+
+    for layout in ['strips', 'tiles', 'mosaic']:
+        warpMemory = getWarpMemory(layout, RESERVED_WARP)
+        settings[layout] = (warpMemory, getCacheSize(getSource(layout), warpMemory, RESERVED_CACHE))
+
+    assert len({warpMemory for warpMemory, cache in settings.values()}) == 3
+    # whole width strips need more cache than two rows of tiles
+    assert settings['strips'][1] > settings['tiles'][1]
+
+
+def test_uncompressed_source_uses_the_minimum_cache():
+    source = getSource('tiles', compression=None)
+    assert getCacheSize(source, getWarpMemory('tiles', RESERVED_WARP), RESERVED_CACHE) == MIN_CACHE
+
+
+def test_scheduler_share_is_the_ceiling():
+    assert getWarpMemory('strips', 100 * MB) == 100 * MB
+    assert getCacheSize(getSource('strips'), 512 * MB, 100 * MB) == 100 * MB
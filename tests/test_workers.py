@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('osgeo')
+
+import params as params
+from benchmarks import workers
+
+
+@pytest.fixture
+def savedParams():
+    # runCheck points the params to the test folder
+    saved = {name: getattr(params, name) for name in dir(params) if not name.startswith('_')}
+    saved = {name: dict(value) if isinstance(value, dict) else value for name, value in saved.items()}
+
+    yield
+
+    for name, value in saved.items():
+        setattr(params, name, value)
+
+
+def test_workers_process_every_file_once(tmp_path, savedParams):
+    # small files, only the products that don't need other libraries
+    params.only_products = ['storageRGB', 'storageDEM', 'geoserverRGB', 'geoserverDEM']
+
+    errors = workers.runCheck(str(tmp_path), registros=3, workers=3, size=256)
+
+    assert errors == []
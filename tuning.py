@@ -0,0 +1,202 @@
+import os
+import math
+import time
+from osgeo import gdal
+
+import params as params
+
+MB = 1024 * 1024
+
+MIN_CACHE = 64 * MB
+
+# warp memory by layout, never above the share reserved by the scheduler
+DEFAULT_WARP_MEMORY = {
+    'strips': 512 * MB,
+    'tiles': 128 * MB,
+    'mosaic': 256 * MB
+}
+
+# ranges of the working types chosen for the warps
+TYPE_RANGES = {
+    gdal.GDT_Byte: (0, 255),
+    gdal.GDT_UInt16: (0, 65535),
+    gdal.GDT_Int16: (-32768, 32767),
+    gdal.GDT_Float32: (-3.4e38, 3.4e38)
+}
+
+
+def inspectSource(file_ds):
+    '''
+    Block layout, compression and size of a source
+    '''
+    band = file_ds.GetRasterBand(1)
+    blockX, blockY = band.GetBlockSize()
+
+    driver = file_ds.GetDriver().ShortName
+
+    if (driver == 'VRT'):
+        layout = 'mosaic'
+    elif (blockX >= file_ds.RasterXSize and file_ds.RasterXSize > blockY):
+        layout = 'strips'
+    else:
+        layout = 'tiles'
+
+    return {
+        'driver': driver,
+        'layout': layout,
+        'blockX': blockX,
+        'blockY': blockY,
+        'compression': file_ds.GetMetadataItem('COMPRESSION', 'IMAGE_STRUCTURE'),
+        'xSize': file_ds.RasterXSize,
+        'ySize': file_ds.RasterYSize,
+        'bands': file_ds.RasterCount,
+        'dataType': band.DataType,
+        # bytes of a pixel with all the bands, the blocks of all the bands are read together
+        'pixelBytes': gdal.GetDataTypeSize(band.DataType) // 8 * file_ds.RasterCount
+    }
+
+
+def getThreads(concurrent):
+    '''
+    Threads for each of `concurrent` calls running at the same time in all the workers
+    '''
+    cpus = params.tuning['threads'] or os.cpu_count() or 1
+    return max(1, cpus // (params.workers * concurrent))
+
+
+def getWarpMemory(layout, reserved=None):
+    '''
+    Warp memory for the layout of the source, the share reserved by the scheduler is the ceiling
+    '''
+    warpMemory = DEFAULT_WARP_MEMORY[layout]
+    return min(warpMemory, reserved) if reserved else warpMemory
+
+
+def getCacheSize(source, warpMemory, reserved=None):
+    '''
+    GDAL cache that holds the blocks a warp chunk reads from the source, so they
+    aren't decompressed twice. The share reserved by the scheduler is the ceiling
+    '''
+    rowBytes = source['xSize'] * source['pixelBytes']
+
+    if not source['compression']:
+        # uncompressed sources are read from the page cache
+        needed = 0
+    elif (source['layout'] == 'strips'):
+        # a chunk of the warp reads whole strips, for all its rows
+        chunkRows = math.sqrt(warpMemory / max(1, source['pixelBytes']))
+        needed = rowBytes * max(chunkRows, source['blockY']) * 2
+    else:
+        # two rows of tiles
+        needed = rowBytes * source['blockY'] * 2
+
+    cacheMax = min(needed, params.scheduler['max_cache'])
+
+    if reserved:
+        cacheMax = min(cacheMax, reserved)
+
+    return int(max(MIN_CACHE, cacheMax))
+
+
+def fitsType(value, dataType):
+    if value is None or value == 'none':
+        return True
+    limits = TYPE_RANGES.get(dataType)
+    return bool(limits) and limits[0] <= float(value) <= limits[1]
+
+
+class Tuning:
+    '''
+    GDAL execution options of a job chosen from its source layout: GDAL cache,
+    warp memory, threads, working type and error threshold of the reprojections.
+    Strip organized inputs (Pix4D) are read whole width, so they get bigger warp
+    chunks and a cache that holds the strips of a chunk. The choices are logged,
+    and stored as 'tuning' events in the metrics
+    '''
+
+    def __init__(self, job, file_ds):
+        self.job = job
+        self.source = inspectSource(file_ds)
+        self.choices = []
+
+        self.enabled = params.tuning['enabled']
+
+        # the warps run alone, the exports of a file at the same time
+        self.warpThreads = getThreads(1)
+        self.stageThreads = getThreads(params.stage_workers)
+
+        self.warpMemory = getWarpMemory(self.source['layout'], self.job.warpMemory)
+
+        if self.enabled:
+            self.applyCache()
+            self.log('translate', {'GDAL_NUM_THREADS': self.stageThreads})
+
+    def applyCache(self):
+        '''
+        Set the GDAL cache of the process for the layout of the source
+        '''
+        cacheMax = getCacheSize(self.source, self.warpMemory, self.job.cacheMax)
+
+        if (cacheMax != gdal.GetCacheMax()):
+            gdal.SetCacheMax(cacheMax)
+
+        self.log('cache', {'GDAL_CACHEMAX': cacheMax})
+
+    def getWarpOptions(self, reproject, srcNodata, dstNodata):
+        '''
+        Options for a gdal.Warp of the source (or a grid written from it)
+        '''
+        if not self.enabled:
+            options = {'multithread': True}
+            if (self.job.warpMemory):
+                options['warpMemoryLimit'] = self.job.warpMemory
+            return options
+
+        options = {
+            'multithread': True,
+            'warpMemoryLimit': self.warpMemory,
+            'warpOptions': [f'NUM_THREADS={self.warpThreads}']
+        }
+
+        # the type of the source when the noData values fit in it, so
+        # GDAL doesn't promote the whole chunk to a bigger type
+        if (fitsType(srcNodata, self.source['dataType']) and fitsType(dstNodata, self.source['dataType'])):
+            options['workingType'] = gdal.GetDataTypeName(self.source['dataType'])
+
+        if (reproject and params.tuning['error_threshold'] is not None):
+            options['errorThreshold'] = params.tuning['error_threshold']
+
+        self.log('warp', options)
+
+        return options
+
+    def applyThreadOptions(self):
+        '''
+        Threads of the compression of the exports that run in this thread
+        '''
+        if not self.enabled:
+            return
+
+        gdal.SetThreadLocalConfigOption('GDAL_NUM_THREADS', str(self.stageThreads))
+
+    def log(self, call, options):
+        choice = {
+            'call': call,
+            'layout': self.source['layout'],
+            'options': {key: value for key, value in options.items() if key != 'multithread'}
+        }
+
+        self.choices.append(choice)
+
+        print(f'--> Tuning {call} for {self.source["layout"]} source: ' +
+              ', '.join(f'{key}={value}' for key, value in choice['options'].items()))
+
+        self.job.metrics.events.append({
+            'event': 'tuning',
+            'time': time.time(),
+            'file': self.job.file,
+            'mapId': self.job.mapId,
+            'type': 'DEM' if self.job.isDEM else 'RGB',
+            'source': self.source,
+            **choice
+        })
@@ -0,0 +1,179 @@
+import os
+import sys
+import time
+import hashlib
+import importlib.util
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import params as params
+
+# One uploader by process, the pools of the parent can't be used after a fork
+_uploaders = {}
+_lock = threading.Lock()
+
+
+def getUploader():
+    '''
+    Uploader of this process, None if the upload is disabled
+    '''
+    if not params.upload['enabled']:
+        return None
+
+    pid = os.getpid()
+
+    # the exports of a file can run in several threads
+    with _lock:
+        if pid not in _uploaders:
+            # boto3 is only imported when the upload is enabled
+            if not importlib.util.find_spec('boto3'):
+                sys.exit('ERROR: boto3 module was not found, it is needed to upload the storage files')
+            _uploaders[pid] = Uploader()
+
+    return _uploaders[pid]
+
+
+def isUploaded(path):
+    '''
+    Only the storage files are uploaded
+    '''
+    storage = os.path.abspath(params.output_folder_storage) + os.sep
+    return params.upload['enabled'] and os.path.abspath(path).startswith(storage)
+
+
+def getKey(path):
+    relative = os.path.relpath(path, params.output_folder_storage).replace(os.sep, '/')
+    return f'{params.upload["prefix"]}/{relative}' if params.upload['prefix'] else relative
+
+
+def getChecksums(path, chunkSize):
+    '''
+    MD5 of the file and the ETag that S3 gives to it when
+    uploaded in parts of `chunkSize`
+    '''
+    digest = hashlib.md5()
+    parts = []
+
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunkSize), b''):
+            digest.update(chunk)
+            parts.append(hashlib.md5(chunk).digest())
+
+    md5 = digest.hexdigest()
+
+    if (os.path.getsize(path) < params.upload['multipart_threshold']):
+        etag = md5
+    else:
+        etag = f'{hashlib.md5(b"".join(parts)).hexdigest()}-{len(parts)}'
+
+    return md5, etag
+
+
+class Uploader:
+    '''
+    Uploads the storage files to an S3 compatible bucket (AWS, MinIO...)
+    in background threads, as soon as they are exported. Big files are sent
+    in concurrent parts, and the objects with the same checksum are skipped
+    '''
+
+    def __init__(self):
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config
+
+        config = params.upload
+
+        self.client = boto3.client(
+            's3',
+            endpoint_url=config['endpoint_url'],
+            region_name=config['region'],
+            aws_access_key_id=config['access_key'],
+            aws_secret_access_key=config['secret_key'],
+            config=Config(max_pool_connections=config['workers'] * 2)
+        )
+
+        self.transferConfig = TransferConfig(
+            multipart_threshold=config['multipart_threshold'],
+            multipart_chunksize=config['multipart_chunksize'],
+            max_concurrency=config['workers']
+        )
+
+        self.executor = ThreadPoolExecutor(max_workers=config['workers'])
+        self.futures = {}
+        self.lock = threading.Lock()
+
+    def submit(self, path, file):
+        '''
+        Queue a file, `file` is the input it was exported from
+        '''
+        future = self.executor.submit(self.upload, path)
+        with self.lock:
+            self.futures.setdefault(file, []).append(future)
+
+    def upload(self, path):
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        key = getKey(path)
+        bucket = params.upload['bucket']
+
+        start = time.time()
+
+        result = {
+            'path': path,
+            'key': key,
+            'bytes': os.path.getsize(path)
+        }
+
+        try:
+            md5, etag = getChecksums(path, params.upload['multipart_chunksize'])
+
+            if (self.exists(bucket, key, md5, etag)):
+                result['status'] = 'skipped'
+            else:
+                print(f'--> Uploading {key}')
+                contentType = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+                self.client.upload_file(
+                    path,
+                    bucket,
+                    key,
+                    ExtraArgs={'Metadata': {'md5': md5}, 'ContentType': contentType},
+                    Config=self.transferConfig
+                )
+                result['status'] = 'uploaded'
+
+        except (BotoCoreError, ClientError, OSError) as e:
+            print(f'ERROR: Unable to upload {path}')
+            print(e)
+            result['status'] = 'error'
+            result['error'] = str(e)
+
+        result['elapsed'] = round(time.time() - start, 2)
+
+        return result
+
+    def exists(self, bucket, key, md5, etag):
+        '''
+        True if the object is already uploaded with the same content
+        '''
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+        return head.get('Metadata', {}).get('md5') == md5 or head['ETag'].strip('"') == etag
+
+    def collect(self, file=None):
+        '''
+        Wait for the uploads of an input (all of them if None),
+        returns their results by input
+        '''
+        with self.lock:
+            files = [file] if file else list(self.futures.keys())
+            futures = {file: self.futures.pop(file, []) for file in files}
+
+        return {file: [future.result() for future in pending] for file, pending in futures.items()}
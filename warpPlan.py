@@ -0,0 +1,201 @@
+import math
+from osgeo import gdal
+
+import helpers as h
+from tempStorage import estimateSize
+
+
+class WarpPlan:
+    '''
+    Per file plan of the warps needed by the enabled exports.
+
+    Each export registers the grid it needs from the source (resolution, SRS
+    and noData policy). Requests with the same SRS and noData policy share one
+    warp at the finest of their resolutions (the ones coarser than the source
+    are never grouped with the ones at its resolution), the grids used by more than one
+    export are written once to the temp folder, and the reprojected grids are
+    warped from a written native grid when there is one, so the full resolution
+    source is read about once per file.
+    '''
+
+    def __init__(self, job, file_ds):
+        self.job = job
+        self.file_ds = file_ds
+        self.requests = {}
+        self.paths = {}
+
+    def add(self, name, xRes, yRes, srcNodata, dstNodata=None, dstSRS=None, materialize=False, onDisk=False):
+        '''
+        Register the grid needed by an export. Use `materialize` for
+        datasets that are read several times (like the lightweight version),
+        and `onDisk` for the ones read by other libraries than GDAL (rasterio)
+        '''
+        self.requests[name] = {
+            'xRes': xRes,
+            'yRes': yRes,
+            'srcNodata': srcNodata,
+            'dstNodata': dstNodata,
+            'dstSRS': dstSRS,
+            'materialize': materialize,
+            'onDisk': onDisk
+        }
+
+    def run(self):
+        '''
+        Run the minimum number of warps for the registered requests
+        '''
+
+        grids = {}
+
+        for name, request in self.requests.items():
+            # the lightweight versions must not end up reading the full resolution source
+            coarser = self._isCoarser(request)
+
+            key = (str(request['srcNodata']), str(request['dstNodata']), request['dstSRS'], coarser)
+
+            if key not in grids:
+                grids[key] = {
+                    'names': [],
+                    'xRes': math.inf,
+                    'yRes': math.inf,
+                    'srcNodata': request['srcNodata'],
+                    'dstNodata': request['dstNodata'],
+                    'dstSRS': request['dstSRS'],
+                    'materialize': False,
+                    'onDisk': False
+                }
+
+            grid = grids[key]
+            grid['names'].append(name)
+            grid['xRes'] = min(grid['xRes'], request['xRes'])
+            grid['yRes'] = min(grid['yRes'], request['yRes'])
+            grid['materialize'] = grid['materialize'] or request['materialize']
+            grid['onDisk'] = grid['onDisk'] or request['onDisk']
+
+        for grid in grids.values():
+            grid['coarser'] = self._isCoarser(grid)
+            # writing a copy at the source resolution is not cheaper than reading the source
+            grid['materialize'] = grid['coarser'] and (grid['materialize'] or len(grid['names']) > 1)
+
+        # native grids that can feed the reprojected ones
+        for grid in grids.values():
+            if grid['dstSRS']:
+                grid['source'] = self._findSourceGrid(grid, grids.values())
+                if grid['source']:
+                    grid['source']['materialize'] = True
+                    # a grid on disk can't reference one in /vsimem/
+                    grid['source']['onDisk'] = grid['source']['onDisk'] or grid['onDisk']
+
+        # native grids first, so they can be used as source of the reprojected ones
+        ordered = sorted(grids.values(), key=lambda grid: grid['dstSRS'] is not None)
+
+        for i, grid in enumerate(ordered):
+            self._runGrid(grid, i)
+
+    def _isCoarser(self, request):
+        return request['xRes'] > self.job.pixelSizeX * 1.001 or request['yRes'] > self.job.pixelSizeY * 1.001
+
+    def _findSourceGrid(self, grid, grids):
+        candidates = [
+            native for native in grids
+            if not native['dstSRS']
+            and native['coarser']
+            and str(native['srcNodata']) == str(grid['srcNodata'])
+            and native['xRes'] <= grid['xRes']
+            and native['yRes'] <= grid['yRes']
+        ]
+
+        # the coarsest one that is still fine enough is the cheapest to read
+        return max(candidates, key=lambda native: native['xRes'], default=None)
+
+    def _runGrid(self, grid, index):
+        temp = self.job.temp
+
+        needsWarp = grid['dstSRS'] or grid['dstNodata'] != None or grid['materialize'] or grid['coarser']
+
+        if not needsWarp:
+            # at the source resolution, the exports read it directly
+            for name in grid['names']:
+                self.paths[name] = self.job.filepath
+            return
+
+        src_ds = self.file_ds
+        srcNodata = grid['srcNodata']
+
+        if grid.get('source'):
+            source = grid['source']
+            src_ds = source['path']
+            # the noData of the written grid is the one to read now
+            srcNodata = source['dstNodata'] if source['dstNodata'] != None else source['srcNodata']
+
+        dstNodata = grid['dstNodata'] if grid['dstNodata'] != None else grid['srcNodata']
+
+        kwargs = {
+            # warp memory, threads, working type and error threshold for the layout of the source
+            **self.job.tuning.getWarpOptions(grid['dstSRS'] is not None, srcNodata, dstNodata),
+            'xRes': grid['xRes'],
+            'yRes': grid['yRes'],
+            # force 'none' to fix old error in Drone Deploy exports (https://gdal.org/programs/gdal_translate.html#cmdoption-gdal_translate-a_nodata)
+            'srcNodata': srcNodata
+        }
+
+        if (dstNodata != srcNodata):
+            kwargs['dstNodata'] = dstNodata
+
+        if (grid['dstSRS']):
+            kwargs['srcSRS'] = f'EPSG:{self.job.epsg}'
+            kwargs['dstSRS'] = grid['dstSRS']
+
+        if (grid['materialize']):
+            path = temp.getPath(f'grid{index}.tif', self._estimateSize(grid), grid['onDisk'])
+            kwargs['format'] = 'GTiff'
+            kwargs['creationOptions'] = [
+                'TILED=YES',
+                'BIGTIFF=IF_SAFER',
+                # the tiles grid of a big ortho is tens of GB uncompressed
+                *h.getScratchCompressionOptions(self.file_ds.GetRasterBand(1).DataType)
+            ]
+            print(f'--> Warping shared grid for {", ".join(grid["names"])}')
+        else:
+            path = temp.getPath(f'grid{index}.vrt', onDisk=grid['onDisk'])
+            kwargs['format'] = 'VRT'
+
+        gdal.Warp(path, src_ds, **kwargs)
+
+        grid['path'] = path
+
+        for name in grid['names']:
+            request = self.requests[name]
+
+            if (request['xRes'] == grid['xRes'] and request['yRes'] == grid['yRes']):
+                self.paths[name] = path
+            else:
+                # virtual resample of the shared grid to the resolution of this export
+                self.paths[name] = temp.getPath(f'{name}.vrt', onDisk=request['onDisk'])
+                gdal.Translate(
+                    self.paths[name],
+                    path,
+                    **{
+                        'format': 'VRT',
+                        'xRes': request['xRes'],
+                        'yRes': request['yRes']
+                    }
+                )
+
+    def _estimateSize(self, grid):
+        '''
+        Size of a written grid, reprojection changes it a little
+        '''
+        ds = self.file_ds
+        xSize = math.ceil(ds.RasterXSize * self.job.pixelSizeX / grid['xRes'])
+        ySize = math.ceil(ds.RasterYSize * self.job.pixelSizeY / grid['yRes'])
+        return estimateSize(xSize, ySize, ds.RasterCount, ds.GetRasterBand(1).DataType)
+
+    def getPath(self, name):
+        return self.paths.get(name, self.job.filepath)
+
+    def open(self, name):
+        '''
+        Opens a new handle of the dataset planned for an export
+        '''
+        return gdal.Open(self.getPath(name), gdal.GA_ReadOnly)
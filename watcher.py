@@ -0,0 +1,298 @@
+import os
+import gc
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from osgeo import gdal
+
+import params as params
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    # the input folder is polled
+    Observer = None
+
+
+def getRss():
+    '''
+    Current resident memory of the process in bytes, None if it can't be read
+    '''
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def getState(path):
+    '''
+    (size, mtime) of a file, or the sum and latest of the files of a mosaic folder
+    '''
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime
+
+    size = 0
+    mtime = 0
+
+    for subdir, dirs, files in os.walk(path):
+        for file in files:
+            stat = os.stat(os.path.join(subdir, file))
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime)
+
+    return size, mtime
+
+
+def getInputName(entry):
+    '''
+    Name of the input file of an entry of the input folder: the
+    mosaic folders are processed as the VRT built next to them
+    '''
+    if os.path.isdir(os.path.join(params.input_folder, entry)):
+        return f'{entry}.vrt'
+    return entry
+
+
+class Watcher:
+    '''
+    Long running service: watches the input folder and processes the new or
+    changed inputs once they are completely written, with the same GDAL/PROJ
+    state and uploader connections. An input is ready when it has a sentinel
+    file (ex: 12345678.tif.done) or its size and mtime didn't change
+    during `stable_seconds`. The incremental manifest decides what to export
+    '''
+
+    def __init__(self):
+        # GDAL, the exporters and the uploader are imported once, and kept warm
+        from process import ConvertGeotiff
+
+        self.converter = ConvertGeotiff(run=False)
+
+        # a failed input doesn't stop the rest of the batch
+        self.converter.stopOnError = False
+
+        self.seen = {}
+        self.queue = []
+        self.processing = []
+        self.done = {}
+        self.wakeUp = threading.Event()
+        self.lock = threading.Lock()
+
+        self.status = {
+            'started': time.time(),
+            'batches': 0,
+            'failed_batches': 0,
+            'last_batch': None
+        }
+
+    def run(self):
+        config = params.watch
+
+        os.makedirs(params.input_folder, exist_ok=True)
+
+        if config['health_port']:
+            self.startHealthServer(config['health_host'], config['health_port'])
+
+        observer = None
+
+        if (config['inotify'] and Observer):
+            observer = self.startObserver()
+
+        print(f'-> Watching {params.input_folder} '
+              f'({"inotify" if observer else "polling every " + str(config["poll_interval"]) + " s"})')
+
+        try:
+            while True:
+                self.scan()
+
+                if self.queue:
+                    self.processQueue()
+
+                # new events wake up the loop before the next poll
+                self.wakeUp.wait(config['poll_interval'])
+                self.wakeUp.clear()
+
+        except KeyboardInterrupt:
+            print('-> Stopping watcher')
+
+        finally:
+            if observer:
+                observer.stop()
+                observer.join()
+
+    def scan(self):
+        '''
+        Queue the inputs that are completely written and not processed since their last change
+        '''
+        config = params.watch
+        now = time.time()
+
+        entries = os.listdir(params.input_folder)
+        folders = {entry for entry in entries if os.path.isdir(os.path.join(params.input_folder, entry))}
+
+        for entry in entries:
+            path = os.path.join(params.input_folder, entry)
+
+            if (entry.endswith('.tmp') or (config['sentinel_suffix'] and entry.endswith(config['sentinel_suffix']))):
+                continue
+
+            # the VRTs of the mosaics are generated by the batch
+            if (entry.endswith('.vrt') and entry[:-4] in folders):
+                continue
+
+            if (entry not in folders and os.path.splitext(entry)[1].lower() not in params.extensions):
+                continue
+
+            try:
+                state = getState(path)
+            except OSError:
+                # removed while scanning
+                continue
+
+            if (self.done.get(entry) == state):
+                continue
+
+            previous = self.seen.get(entry)
+
+            if (not previous or previous['state'] != state):
+                self.seen[entry] = {'state': state, 'since': now}
+                continue
+
+            if config['sentinel_suffix']:
+                ready = os.path.exists(path + config['sentinel_suffix'])
+            else:
+                ready = now - previous['since'] >= config['stable_seconds']
+
+            with self.lock:
+                if (ready and entry not in self.queue):
+                    print(f'-> Queued {entry}')
+                    self.queue.append(entry)
+
+        # forget the removed inputs
+        for entry in [entry for entry in self.seen if entry not in entries]:
+            del self.seen[entry]
+            self.done.pop(entry, None)
+
+    def processQueue(self):
+        '''
+        Process the queued inputs as one batch, without exiting on errors
+        '''
+        with self.lock:
+            self.processing = self.queue
+            self.queue = []
+
+        entries = self.processing
+        states = {entry: self.seen[entry]['state'] for entry in entries if entry in self.seen}
+
+        params.only_files = [getInputName(entry) for entry in entries]
+
+        start = time.time()
+        status = 'ok'
+
+        try:
+            self.converter.run()
+        except SystemExit as e:
+            # the batch exits with 1 if a file or an upload failed
+            status = 'error' if e.code else 'ok'
+        except Exception as e:
+            print(f'ERROR: Batch failed: {e!r}')
+            status = 'error'
+        finally:
+            params.only_files = None
+            # only before the first batch, the outputs of the next ones are kept
+            params.clean_output_folder = False
+
+        summary = getattr(self.converter, 'summary', [])
+        processed = {result['file'] for result in summary}
+
+        # the failed inputs are processed again when they change. If the batch
+        # stopped before reaching some of them, they are queued again
+        for entry, state in states.items():
+            if (status == 'ok' or getInputName(entry) in processed):
+                self.done[entry] = state
+            else:
+                with self.lock:
+                    if entry not in self.queue:
+                        self.queue.append(entry)
+
+        self.status['batches'] += 1
+        if (status == 'error'):
+            self.status['failed_batches'] += 1
+
+        self.status['last_batch'] = {
+            'status': status,
+            'files': entries,
+            'results': {result['file']: result['status'] for result in summary},
+            'finished': time.time(),
+            'elapsed': round(time.time() - start, 2)
+        }
+
+        with self.lock:
+            self.processing = []
+
+        # the datasets of the batch are closed, free what is left of them before waiting
+        self.converter.manifest = None
+        self.converter.summary = []
+        gc.collect()
+
+    def getHealth(self):
+        with self.lock:
+            return {
+                'status': 'ok',
+                'uptime': round(time.time() - self.status['started']),
+                'queued': list(self.queue),
+                'processing': list(self.processing),
+                'waiting': [entry for entry in self.seen if entry not in self.done and entry not in self.queue],
+                'batches': self.status['batches'],
+                'failed_batches': self.status['failed_batches'],
+                'last_batch': self.status['last_batch'],
+                'rss_bytes': getRss(),
+                'gdal_cache_used_bytes': gdal.GetCacheUsed()
+            }
+
+    def startHealthServer(self, host, port):
+        watcher = self
+
+        class HealthHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if (self.path.split('?')[0] not in ('/', '/health')):
+                    self.send_error(404)
+                    return
+
+                body = json.dumps(watcher.getHealth(), default=str).encode()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # keep the batch output readable
+                pass
+
+        server = ThreadingHTTPServer((host, port), HealthHandler)
+        server.daemon_threads = True
+
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        print(f'-> Health endpoint on http://{host}:{port}/health')
+
+    def startObserver(self):
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+
+            def on_any_event(self, event):
+                watcher.wakeUp.set()
+
+        observer = Observer()
+        observer.schedule(Handler(), params.input_folder, recursive=True)
+        observer.start()
+
+        return observer